@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Timings of the Dhis2Client extractions (extract_data in its batching modes,
+extract_data_db, extract_data_program and the fetch_*_structure calls)
+against the local DHIS2 stand-in, at several instance scales.
+
+Usage: python benchmarks/bench_extraction.py [--scales small,medium]
+       [--latency 0.02] [--failure-rate 0] [--output results.csv]
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from blsq_dqapp.metadata_extraction import Dhis2Client
+from dhis2_standin import SyntheticInstance,serve
+
+
+SCALES={
+    'small':{'branching':(3,5,10),'n_des':10,'n_events':500},
+    'medium':{'branching':(4,10,25),'n_des':50,'n_events':2000},
+    'large':{'branching':(5,10,40),'n_des':100,'n_events':5000},
+}
+
+STRUCTURES=['fetch_organisation_units_structure','fetch_oug_structure','fetch_coc_structure',
+            'fetch_data_elements_structure','fetch_deg_structure','fetch_dataset_structure',
+            'fetch_indicators_structure','fetch_indg_structure']
+
+
+def extraction_scenarios(instance,pe_start_date='202301',pe_end_date='202312'):
+    dx_descriptor={'DX':[de['id'] for de in instance.data_elements]}
+    ou_descriptor={'OU':list(instance.facilities)}
+    analytics_args=lambda: ({'DX':list(dx_descriptor['DX'])},pe_start_date,pe_end_date,'monthly',
+                            {'OU':list(ou_descriptor['OU'])})
+    scenarios={structure:(lambda client,structure=structure: getattr(client,structure)()) for structure in STRUCTURES}
+    scenarios.update({
+        'extract_data':lambda client: client.extract_data(*analytics_args(),silent=True),
+        'extract_data max_workers=8':lambda client: client.extract_data(*analytics_args(),silent=True,max_workers=8),
+        'extract_data streaming max_workers=8':lambda client: client.extract_data(*analytics_args(),silent=True,
+                                                                                   max_workers=8,streaming=True),
+        'extract_data max_url_bytes=4000':lambda client: client.extract_data(*analytics_args(),silent=True,
+                                                                              max_url_bytes=4000,max_workers=8),
+        'extract_data adaptive_batching':lambda client: client.extract_data(*analytics_args(),silent=True,
+                                                                             adaptive_batching=True,target_seconds=2,
+                                                                             batch_state_path=client.bench_state_path),
+        'extract_data_db bulk':lambda client: client.extract_data_db(*analytics_args(),silent=True,bulk=True),
+        #One request per DE x period x OU, run on a slice of the instance
+        'extract_data_db per value (2 DE x 3 pe x 10 OU)':lambda client: client.extract_data_db({'DX':dx_descriptor['DX'][:2]},
+                                                                                               pe_start_date,'202303','monthly',
+                                                                                               {'OU':ou_descriptor['OU'][:10]},
+                                                                                               silent=True),
+        'extract_data_program event':lambda client: client.extract_data_program(instance.programs,[instance.org_units[0]['id']],
+                                                                                 program_type='event',page_size=500,
+                                                                                 fetch_all=True),
+        'fetch_tracked_entity_instances':lambda client: client.fetch_tracked_entity_instances(instance.programs[0],instance.org_units[0]['id'],
+                                                                                              page_size=100,fetch_all=True),
+    })
+    return scenarios
+
+
+def result_rows(result):
+    if isinstance(result,dict):
+        return sum(item.shape[0] for item in result.values())
+    if isinstance(result,list):
+        return len(result)
+    return result.shape[0]
+
+
+def run(scales=('small','medium'),latency=0.02,failure_rate=0,repeat=1,state_path=None):
+    results=[]
+    for scale in scales:
+        instance=SyntheticInstance(**SCALES[scale])
+        server,base_url=serve(instance,latency=latency,failure_rate=failure_rate)
+        try:
+            for scenario,extraction in extraction_scenarios(instance).items():
+                for _ in range(repeat):
+                    client=Dhis2Client(base_url,use_cache=False,log_level='WARNING')
+                    client.executor.backoff_factor=0.1
+                    client.bench_state_path=state_path or '/tmp/blsq_dqapp_bench_batch_sizes.json'
+                    t_start=time.perf_counter()
+                    try:
+                        result=extraction(client)
+                        error=None
+                    except Exception as exception:
+                        result=None
+                        error=exception.__class__.__name__+': '+str(exception)[:80]
+                    seconds=time.perf_counter()-t_start
+                    summary=client.metrics.summary()
+                    results.append({'SCALE':scale,
+                                    'SCENARIO':scenario,
+                                    'SECONDS':seconds,
+                                    'ROWS':result_rows(result) if result is not None else None,
+                                    'REQUESTS':summary['requests'],
+                                    'RETRIES':summary.get('retries',0),
+                                    'LATENCY_P95':summary.get('latency_p95'),
+                                    'MB':summary.get('bytes',0)/1e6,
+                                    'ERROR':error})
+        finally:
+            server.shutdown()
+    return pd.DataFrame(results)
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales',default='small,medium',help='comma separated among '+','.join(SCALES))
+    parser.add_argument('--latency',type=float,default=0.02)
+    parser.add_argument('--failure-rate',type=float,default=0)
+    parser.add_argument('--repeat',type=int,default=1)
+    parser.add_argument('--output',default=None,help='csv file for the results')
+    args=parser.parse_args()
+
+    results=run(args.scales.split(','),latency=args.latency,failure_rate=args.failure_rate,repeat=args.repeat)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output,index=False)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Parse time of the Dhis2Client metadata JSON-to-DataFrame builders versus the
+number of records, on synthetic metadata payloads.
+
+Usage: python benchmarks/bench_metadata_parsers.py [record counts...]
+"""
+import sys
+import time
+
+import pandas as pd
+
+from blsq_dqapp.metadata_extraction import Dhis2Client
+
+
+def org_units_json(n_records,depth=5):
+    org_units=[]
+    for i in range(n_records):
+        level=i%depth+1
+        org_units.append({'id':'OU'+str(i).zfill(9),
+                          'name':'Org unit '+str(i),
+                          'level':level,
+                          'ancestors':[{'id':'AN'+str(lvl).zfill(9),'name':'Ancestor '+str(lvl)}
+                                       for lvl in range(level-1)]})
+    return org_units
+
+
+def data_elements_json(n_records,n_datasets=3):
+    return [{'id':'DE'+str(i).zfill(9),
+             'name':'Data element '+str(i),
+             'domainType':'AGGREGATE',
+             'categoryCombo':{'id':'CC'+str(i%20).zfill(9)},
+             'dataSetElements':[{'dataSet':{'id':'DS'+str(ds).zfill(9)}} for ds in range(i%n_datasets)]}
+            for i in range(n_records)]
+
+
+def cocs_json(n_records):
+    return [{'id':'CO'+str(i).zfill(9),'name':'Option combo '+str(i),'categoryCombo':{'id':'CC'+str(i%20).zfill(9)}}
+            for i in range(n_records)]
+
+
+def groups_json(n_records,child_key,group_size=50):
+    return [{'id':'GR'+str(i).zfill(9),
+             'name':'Group '+str(i),
+             child_key:[{'id':'CH'+str(j).zfill(9),'name':'Child '+str(j)} for j in range(group_size)]}
+            for i in range(max(n_records//group_size,1))]
+
+
+def datasets_json(n_records,n_items=100):
+    return [{'id':'DS'+str(i).zfill(9),
+             'name':'Dataset '+str(i),
+             'periodType':'Monthly',
+             'organisationUnits':[{'id':'OU'+str(j).zfill(9)} for j in range(n_items)],
+             'dataSetElements':[{'dataElement':{'id':'DE'+str(j).zfill(9)}} for j in range(n_items)]}
+            for i in range(max(n_records//n_items,1))]
+
+
+PARSERS={
+    '_outree_json_to_df':org_units_json,
+    '_data_elements_json_to_df':data_elements_json,
+    '_cocs_json_to_df':cocs_json,
+    '_deg_json_to_df':lambda n: groups_json(n,'dataElements'),
+    '_indg_json_to_df':lambda n: groups_json(n,'indicators'),
+    '_oug_json_to_df':lambda n: groups_json(n,'organisationUnits'),
+    '_datasets_json_to_df':datasets_json,
+}
+
+
+def run(record_counts=(1000,5000,10000,30000),repeat=3):
+    client=Dhis2Client('http://localhost',use_cache=False)
+    results=[]
+    for parser_name,payload_generator in PARSERS.items():
+        parser=getattr(client,parser_name)
+        for n_records in record_counts:
+            payload=payload_generator(n_records)
+            timings=[]
+            for _ in range(repeat):
+                t_start=time.perf_counter()
+                parser(payload)
+                timings.append(time.perf_counter()-t_start)
+            results.append({'PARSER':parser_name,
+                            'RECORDS':n_records,
+                            'SECONDS':min(timings),
+                            'RECORDS_PER_SECOND':n_records/min(timings)})
+    return pd.DataFrame(results)
+
+
+if __name__=='__main__':
+    counts=[int(arg) for arg in sys.argv[1:]] or (1000,5000,10000,30000)
+    print(run(counts).to_string(index=False))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Parity and speed of Periods.split, sliced from the calendar tables, against
+the date by date ExtractPeriod.call it replaces, for all the frequencies.
+
+Usage: python benchmarks/bench_periods.py [n_ranges] [repeats]
+"""
+import sys
+import time
+
+import numpy as np
+
+from blsq_dqapp.periods import CLASSES_MAPPING,DateRange,Periods
+
+
+def iterative_split(period,frequency):
+    #Periods.split before the calendar tables
+    date_range=DateRange(Periods.as_date_range(period[0]).start,Periods.as_date_range(period[1]).end)
+    return tuple(CLASSES_MAPPING[frequency]().call(date_range))
+
+
+def random_ranges(n_ranges,seed=0):
+    """Start and end periods, as daily, monthly, quarterly or yearly DHIS2
+    periods, between 1999 and 2031 (ends before starts included)."""
+    rng=np.random.default_rng(seed)
+    days=np.datetime64('1999-01-01')+rng.integers(0,365*32,(n_ranges,2))
+    days[:,1]=np.where(rng.random(n_ranges)<0.9,np.maximum(days[:,0],days[:,1]),days[:,1])
+    formats=rng.integers(0,4,n_ranges)
+    ranges=[]
+    for (start,end),period_format in zip(days.astype(object),formats):
+        if period_format==0:
+            ranges.append((start.strftime('%Y%m%d'),end.strftime('%Y%m%d')))
+        elif period_format==1:
+            ranges.append((start.strftime('%Y%m'),end.strftime('%Y%m')))
+        elif period_format==2:
+            ranges.append((start.strftime('%Y')+'Q'+str((start.month+2)//3),end.strftime('%Y')+'Q'+str((end.month+2)//3)))
+        else:
+            ranges.append((start.strftime('%Y'),end.strftime('%Y')))
+    return ranges
+
+
+def parity_run(n_ranges):
+    mismatches={}
+    for frequency in CLASSES_MAPPING:
+        mismatches[frequency]=sum(Periods.split(list(period),frequency)!=iterative_split(period,frequency)
+                                  for period in random_ranges(n_ranges))
+    return mismatches
+
+
+def speed_run(repeats):
+    """Seconds of repeats splits of 2018-2022, as the extraction does for each
+    batch of DEs."""
+    period=('20180101','20221231')
+    timings={}
+    for frequency in CLASSES_MAPPING:
+        Periods.split(list(period),frequency)
+        t_start=time.perf_counter()
+        for _ in range(repeats):
+            iterative_split(period,frequency)
+        t_iterative=time.perf_counter()-t_start
+        t_start=time.perf_counter()
+        for _ in range(repeats):
+            Periods.split(list(period),frequency)
+        t_table=time.perf_counter()-t_start
+        timings[frequency]=(t_iterative,t_table)
+    return timings
+
+
+if __name__=='__main__':
+    n_ranges=int(sys.argv[1]) if len(sys.argv)>1 else 2000
+    repeats=int(sys.argv[2]) if len(sys.argv)>2 else 100
+    print('MISMATCHES',parity_run(n_ranges))
+    for frequency,(t_iterative,t_table) in speed_run(repeats).items():
+        print(frequency,'ITERATIVE_SECONDS',round(t_iterative,4),'TABLE_SECONDS',round(t_table,4),'SPEEDUP',round(t_iterative/t_table,1))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Speed, memory and error of the quantile sketches against the exact grouped
+quantiles: RobustScaler parameters of grouped values, merge of sharded
+sketches, and outlier_detection_assignment with relative_accuracy.
+
+Usage: python benchmarks/bench_quantile_sketch.py [n_values] [relative_accuracy]
+"""
+import sys
+import time
+
+import numpy as np
+
+from blsq_dqapp.outlier_detection import outlier_detection_assignment,grouped_robust_scaler_parameters
+from blsq_dqapp.quantile_sketch import GroupedQuantileSketch
+from parity_outliers import synthetic_values
+
+
+def grouped_values(n_values,n_groups=1000,seed=0):
+    rng=np.random.default_rng(seed)
+    group_codes=rng.integers(0,n_groups,n_values)
+    values=np.round(rng.lognormal(3,1.5,n_values))
+    values[rng.random(n_values)<0.1]=0
+    values[rng.random(n_values)<0.05]=np.nan
+    return values,group_codes
+
+
+def scaler_parameters_run(n_values,relative_accuracy,n_groups=1000,n_shards=8):
+    values,group_codes=grouped_values(n_values,n_groups)
+    t_start=time.perf_counter()
+    center,scale=grouped_robust_scaler_parameters(values,group_codes,n_groups)
+    t_exact=time.perf_counter()-t_start
+
+    t_start=time.perf_counter()
+    sketch=GroupedQuantileSketch(relative_accuracy).add(values,group_codes)
+    sketch_center,sketch_scale=sketch.robust_scaler_parameters(n_groups)
+    t_sketch=time.perf_counter()-t_start
+    center_bounds,scale_bounds=sketch.error_bounds(n_groups)
+
+    #Shards sketched apart then merged give the sketch of the whole values
+    merged=GroupedQuantileSketch(relative_accuracy)
+    for shard_values,shard_codes in zip(np.array_split(values,n_shards),np.array_split(group_codes,n_shards)):
+        merged.merge(GroupedQuantileSketch(relative_accuracy).add(shard_values,shard_codes))
+
+    center_errors=np.abs(sketch_center-center)
+    scale_errors=np.abs(sketch_scale-scale)
+    return {'VALUES':n_values,
+            'GROUPS':n_groups,
+            'EXACT_SECONDS':t_exact,
+            'SKETCH_SECONDS':t_sketch,
+            'VALUES_MB':values.nbytes/1e6,
+            'SKETCH_MB':sketch.nbytes/1e6,
+            'CENTER_MAX_RELATIVE_ERROR':float(np.nanmax(center_errors/np.maximum(np.abs(center),1e-9))),
+            'SCALE_MAX_RELATIVE_ERROR':float(np.nanmax(scale_errors/np.maximum(np.abs(scale),1e-9))),
+            'WITHIN_BOUNDS':bool(np.all(center_errors<=center_bounds+1e-9) and np.all(scale_errors<=scale_bounds+1e-9)),
+            'MERGED_EQUAL':bool(np.array_equal(merged.keys,sketch.keys) and np.array_equal(merged.counts,sketch.counts))}
+
+
+def outlier_run(n_rows,relative_accuracy,n_des=100):
+    df=synthetic_values(n_rows,n_des)
+    de_uid_vars=['DE_UID','COC_UID']
+    t_start=time.perf_counter()
+    exact=outlier_detection_assignment(df,de_uid_vars)
+    t_exact=time.perf_counter()-t_start
+    t_start=time.perf_counter()
+    approximate=outlier_detection_assignment(df,de_uid_vars,relative_accuracy=relative_accuracy)
+    t_sketch=time.perf_counter()-t_start
+
+    approximate=approximate.loc[exact.index.intersection(approximate.index)]
+    exact=exact.loc[approximate.index]
+    return {'ROWS':n_rows,
+            'EXACT_SECONDS':t_exact,
+            'SKETCH_SECONDS':t_sketch,
+            'BATCH_MEDIAN_AGREEMENT':float((exact.batch_median==approximate.batch_median).mean()),
+            'OUTLIER_RS_AGREEMENT':float((exact.OUTLIER_RS.fillna(-1)==approximate.OUTLIER_RS.fillna(-1)).mean()),
+            'EXTREME_RS_AGREEMENT':float((exact.EXTREME_RS.fillna(-1)==approximate.EXTREME_RS.fillna(-1)).mean())}
+
+
+if __name__=='__main__':
+    n_values=int(sys.argv[1]) if len(sys.argv)>1 else 10000000
+    relative_accuracy=float(sys.argv[2]) if len(sys.argv)>2 else 0.01
+    print('RobustScaler parameters, relative_accuracy',relative_accuracy)
+    for key,value in scaler_parameters_run(n_values,relative_accuracy).items():
+        print(' ',key,value)
+    print('outlier_detection_assignment')
+    for key,value in outlier_run(min(n_values,1000000),relative_accuracy).items():
+        print(' ',key,value)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Speed and parity of the bit packed reporting_style_classifier against the
+grouped means and monotonic checks of reporting_style_classifier_function,
+on a synthetic OU x DE x period availability frame.
+
+Usage: python benchmarks/bench_reporting_style.py [n_rows] [n_periods]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from blsq_dqapp.reporting_style_tools import reporting_style_classifier,reporting_style_classifier_function
+
+
+def synthetic_availability(n_rows,n_periods=36,n_des=40,seed=0):
+    """Availability of OU/DE series started, stopped, irregular, full or
+    empty, with 3% of the rows missing, shuffled."""
+    rng=np.random.default_rng(seed)
+    n_pairs=max(n_rows//n_periods,1)
+    periods=np.array([str(2015+month//12)+str(month%12+1).zfill(2) for month in range(n_periods)])
+    pairs=np.repeat(np.arange(n_pairs),n_periods)
+    period_index=np.tile(np.arange(n_periods),n_pairs)
+    kinds=rng.integers(0,5,n_pairs)[pairs]
+    switch=rng.integers(0,n_periods,n_pairs)[pairs]
+    availability=np.select([kinds==0,kinds==1,kinds==2,kinds==3],
+                           [period_index>=switch,period_index<switch,rng.random(pairs.shape[0])<0.5,True],False)
+    de_codes=pairs%n_des
+    df=pd.DataFrame({'OU_UID':pd.Series(np.char.add('OU',(pairs//n_des).astype(str)),dtype='str'),
+                     'DE_UID':pd.Series(np.char.add('DE',(de_codes//2).astype(str)),dtype='str'),
+                     'COC_UID':pd.Series(np.char.add('COC',(de_codes%2).astype(str)),dtype='str'),
+                     'PERIOD':periods[period_index],
+                     'DE_AVAILABILITY_BOOL':availability.astype('uint8')})
+    df=df[rng.random(df.shape[0])>0.03]
+    return df.sample(frac=1,random_state=seed).reset_index(drop=True)
+
+
+def run(n_rows,n_periods=36):
+    de_uid_vars=['DE_UID','COC_UID']
+    df=synthetic_availability(n_rows,n_periods)
+    t_start=time.perf_counter()
+    reference=reporting_style_classifier_function(df.sort_values('PERIOD',kind='stable')[['OU_UID','DE_AVAILABILITY_BOOL']+de_uid_vars],
+                                                  de_uid_vars)
+    t_reference=time.perf_counter()-t_start
+    t_start=time.perf_counter()
+    packed=reporting_style_classifier(df,de_uid_vars)
+    t_packed=time.perf_counter()-t_start
+    return {'ROWS':df.shape[0],
+            'PERIODS':n_periods,
+            'GROUPED_SECONDS':t_reference,
+            'BITMASK_SECONDS':t_packed,
+            'SPEEDUP':t_reference/t_packed,
+            'IDENTICAL':bool(reference.equals(packed)),
+            'COMPLETENESS':packed.COMPLETENESS.value_counts().to_dict()}
+
+
+if __name__=='__main__':
+    n_rows=int(sys.argv[1]) if len(sys.argv)>1 else 10000000
+    n_periods=int(sys.argv[2]) if len(sys.argv)>2 else 36
+    for key,value in run(n_rows,n_periods).items():
+        print(key,value)
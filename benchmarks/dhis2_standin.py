@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in of a DHIS2 instance serving synthetic data, to measure the
+extractions of Dhis2Client without hitting a production server.
+
+Served endpoints (under /api/): analytics, dataValues, dataValueSets,
+organisationUnits, organisationUnitGroups, categoryOptionCombos,
+categoryCombos, dataElements, dataElementGroups, dataSets, indicators,
+indicatorGroups, events and trackedEntityInstances. The metadata endpoints
+also answer the lastUpdated probes of the metadata cache.
+
+Usage: python benchmarks/dhis2_standin.py [--port 8080] [--latency 0.05]
+       [--failure-rate 0.01] [--padding 0] [--branching 4,10,25] [--des 50]
+"""
+import argparse
+import gzip
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+
+def uid(prefix,index):
+    #DHIS2 uids are 11 characters long
+    return prefix+str(index).zfill(11-len(prefix))
+
+
+class SyntheticInstance(object):
+    """Metadata and values of a synthetic DHIS2 instance.
+    Parameters
+    ----------
+    branching: tuple of int
+        Children per org unit at each level below the root: (4,10,25) gives
+        1 country, 4 regions, 40 districts and 1000 facilities.
+    n_des: int
+        Aggregate data elements, spread over n_ccs category combos.
+    cocs_per_cc: int
+        Category option combos per category combo.
+    density: float
+        Share of the DE x COC x OU x period cells having a value.
+    n_events: int
+        Events per program, spread over the facilities.
+    """
+
+    def __init__(self,branching=(4,10,25),n_des=50,n_ccs=5,cocs_per_cc=2,density=0.8,
+                 n_programs=2,n_events=2000,n_teis=500,last_updated='2024-01-01T00:00:00.000'):
+        self.density=density
+        self.last_updated=last_updated
+
+        #Org unit tree, level by level
+        self.org_units=[{'id':uid('OU',0),'name':'Org unit 0','level':1,'ancestors':[]}]
+        current_level=[self.org_units[0]]
+        for depth,children in enumerate(branching,start=2):
+            next_level=[]
+            for parent in current_level:
+                for _ in range(children):
+                    index=len(self.org_units)
+                    org_unit={'id':uid('OU',index),'name':'Org unit '+str(index),'level':depth,
+                              'ancestors':parent['ancestors']+[{'id':parent['id'],'name':parent['name']}]}
+                    self.org_units.append(org_unit)
+                    next_level.append(org_unit)
+            current_level=next_level
+        self.org_units_by_id={org_unit['id']:org_unit for org_unit in self.org_units}
+        self.facilities=[org_unit['id'] for org_unit in current_level]
+        self.org_unit_groups=[{'id':uid('OUG',group),'name':'Org unit group '+str(group),
+                               'organisationUnits':[{'id':ou,'name':self.org_units_by_id[ou]['name']}
+                                                    for ou in self.facilities[group::3]]}
+                              for group in range(3)]
+
+        #Category combos, the first one being the default one
+        self.category_combos=[]
+        self.cocs=[]
+        for cc_index in range(n_ccs):
+            cc_id=uid('CC',cc_index)
+            coc_count=1 if cc_index==0 else cocs_per_cc
+            cc_cocs=[]
+            for _ in range(coc_count):
+                coc_index=len(self.cocs)
+                coc={'id':uid('COC',coc_index),'name':'default' if coc_index==0 else 'Option combo '+str(coc_index),
+                     'categoryCombo':{'id':cc_id}}
+                self.cocs.append(coc)
+                cc_cocs.append({'id':coc['id']})
+            self.category_combos.append({'id':cc_id,'categoryOptionCombos':cc_cocs})
+        self.cc_cocs={cc['id']:[coc['id'] for coc in cc['categoryOptionCombos']] for cc in self.category_combos}
+
+        self.datasets=[{'id':uid('DS',ds),'name':'Dataset '+str(ds),'periodType':'Monthly',
+                        'organisationUnits':[{'id':ou} for ou in self.facilities],
+                        'dataSetElements':[]} for ds in range(2)]
+        self.data_elements=[]
+        for de_index in range(n_des):
+            de={'id':uid('DE',de_index),'name':'Data element '+str(de_index),'domainType':'AGGREGATE',
+                'categoryCombo':{'id':self.category_combos[de_index%n_ccs]['id']},
+                'dataSetElements':[{'dataSet':{'id':self.datasets[de_index%2]['id']}}]}
+            self.data_elements.append(de)
+            self.datasets[de_index%2]['dataSetElements'].append({'dataElement':{'id':de['id']}})
+        self.de_cc={de['id']:de['categoryCombo']['id'] for de in self.data_elements}
+        self.data_element_groups=[{'id':uid('DEG',0),'name':'Data element group 0',
+                                   'dataElements':[{'id':de['id'],'name':de['name']} for de in self.data_elements]}]
+        self.indicators=[{'id':uid('IN',index),'name':'Indicator '+str(index),
+                          'numerator':'#{'+self.data_elements[index%n_des]['id']+'}+#{'+self.data_elements[(index+1)%n_des]['id']+'.'+self.cocs[0]['id']+'}',
+                          'denominator':'1'}
+                         for index in range(max(n_des//5,1))]
+        self.indicator_groups=[{'id':uid('ING',0),'name':'Indicator group 0',
+                                'indicators':[{'id':ind['id'],'name':ind['name']} for ind in self.indicators]}]
+
+        self.programs=[uid('PR',program) for program in range(n_programs)]
+        self.n_events=n_events
+        self.n_teis=n_teis
+
+    def value(self,*cell):
+        #Deterministic values, a cell has no value with probability 1-density
+        cell_hash=zlib.crc32('|'.join(str(item) for item in cell).encode('utf-8'))
+        if cell_hash%1000>=self.density*1000:
+            return None
+        return str(cell_hash%500)
+
+    def descendants(self,ancestor_uid,level):
+        return [org_unit['id'] for org_unit in self.org_units
+                if org_unit['level']==level and (org_unit['id']==ancestor_uid or
+                                                 any(ancestor['id']==ancestor_uid for ancestor in org_unit['ancestors']))]
+
+    def resolve_ou_dimension(self,items):
+        levels=[int(item.split('-')[1]) for item in items if item.startswith('LEVEL-')]
+        groups=[item.split('-',1)[1] for item in items if item.startswith('OU_GROUP-')]
+        ous=[item for item in items if not item.startswith('LEVEL-') and not item.startswith('OU_GROUP-')]
+        if groups:
+            members=[member['id'] for group in self.org_unit_groups if group['id'] in groups
+                     for member in group['organisationUnits']]
+            return members
+        if levels:
+            return [ou for ancestor in ous for level in levels for ou in self.descendants(ancestor,level)]
+        return ous
+
+    def analytics_rows(self,dx_items,ou_items,pe_items):
+        rows=[]
+        for ou in self.resolve_ou_dimension(ou_items):
+            for dx in dx_items:
+                for pe in pe_items:
+                    value=self.value(dx,ou,pe)
+                    if value is not None:
+                        rows.append([dx,ou,pe,value])
+        return rows
+
+    def data_value_set(self,de_uids,ou_uids,periods,children=False):
+        if children:
+            ou_uids=[ou for parent in ou_uids for ou in self.descendants(parent,max(org_unit['level'] for org_unit in self.org_units))]
+        data_values=[]
+        for de in de_uids:
+            for coc in self.cc_cocs.get(self.de_cc.get(de),[]):
+                for ou in ou_uids:
+                    for pe in periods:
+                        value=self.value(de+'.'+coc,ou,pe)
+                        if value is not None:
+                            data_values.append({'dataElement':de,'period':pe,'orgUnit':ou,
+                                                'categoryOptionCombo':coc,'value':value})
+        return data_values
+
+    def events(self,program):
+        return [{'program':program,'event':uid('EV',index),'programStage':uid('PS',0),
+                 'programType':'WITHOUT_REGISTRATION','status':'COMPLETED',
+                 'orgUnit':self.facilities[index%len(self.facilities)],
+                 'orgUnitName':'Org unit','eventDate':'2024-01-'+str(index%28+1).zfill(2)+'T00:00:00.000',
+                 'completedBy':'admin',
+                 'dataValues':[{'dataElement':de['id'],'value':str(index%97)} for de in self.data_elements[:3]]}
+                for index in range(self.n_events)]
+
+    def tracked_entity_instances(self,program):
+        return [{'trackedEntityInstance':uid('TEI',index),'trackedEntityType':uid('TET',0),
+                 'orgUnit':self.facilities[index%len(self.facilities)],'created':'2024-01-01T00:00:00.000',
+                 'storedBy':'admin','attributes':[],
+                 'enrollments':[{'program':program,'enrollment':uid('EN',index),'enrollmentDate':'2024-01-01',
+                                 'events':[{'event':uid('TEV',index),'programStage':uid('PS',0),
+                                            'eventDate':'2024-01-01T00:00:00.000','dataValues':[]}]}]}
+                for index in range(self.n_teis)]
+
+    def metadata(self,endpoint):
+        return {'organisationUnits':self.org_units,
+                'organisationUnitGroups':self.org_unit_groups,
+                'categoryOptionCombos':self.cocs,
+                'categoryCombos':self.category_combos,
+                'dataElements':self.data_elements,
+                'dataElementGroups':self.data_element_groups,
+                'dataSets':self.datasets,
+                'indicators':self.indicators,
+                'indicatorGroups':self.indicator_groups}.get(endpoint)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        #Headers and body go in separate writes, without TCP_NODELAY the
+        #delayed ACK of the client adds ~40ms to every answer
+        self.connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+    def log_message(self,format,*args):
+        pass
+
+    def do_GET(self):
+        server=self.server
+        if server.latency:
+            time.sleep(server.latency*random.uniform(0.5,1.5))
+        if server.failure_rate and random.random()<server.failure_rate:
+            return self._answer(503,{'httpStatus':'Service Unavailable','httpStatusCode':503})
+
+        url_parts=urllib.parse.urlsplit(self.path)
+        params=urllib.parse.parse_qs(url_parts.query)
+        endpoint=url_parts.path.split('/api/',1)[-1]
+        if endpoint.endswith('.json'):
+            endpoint=endpoint[:-len('.json')]
+        instance=server.instance
+
+        if endpoint=='analytics':
+            dimensions={dimension.split(':',1)[0]:dimension.split(':',1)[1].split(';') for dimension in params.get('dimension',[])}
+            rows=instance.analytics_rows(dimensions.get('dx',[]),dimensions.get('ou',[]),dimensions.get('pe',[]))
+            return self._answer(200,{'headers':[{'name':'dx'},{'name':'ou'},{'name':'pe'},{'name':'value'}],
+                                     'rows':rows,'height':len(rows),'width':4})
+        if endpoint=='dataValues':
+            de=params['de'][0]
+            coc=params.get('co',[instance.cc_cocs[instance.de_cc[de]][0]])[0] if de in instance.de_cc else None
+            value=instance.value(de+'.'+str(coc),params['ou'][0],params['pe'][0])
+            if value is None:
+                return self._answer(409,{'httpStatus':'Conflict','httpStatusCode':409,'message':'Data value does not exist'})
+            return self._answer(200,[value])
+        if endpoint=='dataValueSets':
+            data_values=instance.data_value_set(params.get('dataElement',[]),params.get('orgUnit',[]),
+                                                params.get('period',[]),children=params.get('children',['false'])[0]=='true')
+            return self._answer(200,{'dataValues':data_values})
+        if endpoint in ('events','trackedEntityInstances'):
+            program=params.get('program',[instance.programs[0]])[0]
+            items=instance.events(program) if endpoint=='events' else instance.tracked_entity_instances(program)
+            page_size=int(params.get('pageSize',['50'])[0])
+            page=int(params.get('page',['1'])[0])
+            page_count=max((len(items)+page_size-1)//page_size,1)
+            return self._answer(200,{'pager':{'page':page,'pageCount':page_count,'total':len(items),'pageSize':page_size},
+                                     endpoint:items[(page-1)*page_size:page*page_size]})
+
+        items=instance.metadata(endpoint)
+        if items is None:
+            return self._answer(404,{'httpStatus':'Not Found','httpStatusCode':404})
+        if params.get('fields',[''])[0]=='lastUpdated':
+            #lastUpdated probe of the metadata cache
+            return self._answer(200,{'pager':{'total':len(items)},
+                                     endpoint:[{'lastUpdated':instance.last_updated}][:len(items)]})
+        return self._answer(200,{endpoint:items})
+
+    def _answer(self,status,payload):
+        if self.server.padding and isinstance(payload,dict):
+            payload=dict(payload,padding=' '*self.server.padding)
+        body=json.dumps(payload).encode('utf-8')
+        compressed='gzip' in self.headers.get('Accept-Encoding','')
+        if compressed:
+            body=gzip.compress(body,compresslevel=5)
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        if compressed:
+            self.send_header('Content-Encoding','gzip')
+        if status==503:
+            self.send_header('Retry-After','0')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(instance=None,host='127.0.0.1',port=0,latency=0,failure_rate=0,padding=0):
+    """Start the stand-in in a background thread.
+    Returns
+    -------
+    server: ThreadingHTTPServer
+        To be stopped with server.shutdown().
+    base_url: str
+        Host to give to Dhis2Client.
+    """
+    server=ThreadingHTTPServer((host,port),StandinHandler)
+    server.daemon_threads=True
+    server.instance=instance or SyntheticInstance()
+    server.latency=latency
+    server.failure_rate=failure_rate
+    server.padding=padding
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server,'http://'+host+':'+str(server.server_port)
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port',type=int,default=8080)
+    parser.add_argument('--latency',type=float,default=0,help='mean seconds added to each answer')
+    parser.add_argument('--failure-rate',type=float,default=0,help='share of answers failing with 503')
+    parser.add_argument('--padding',type=int,default=0,help='bytes of padding added to each json answer')
+    parser.add_argument('--branching',default='4,10,25',help='children per org unit at each level')
+    parser.add_argument('--des',type=int,default=50,help='number of data elements')
+    args=parser.parse_args()
+
+    instance=SyntheticInstance(branching=tuple(int(children) for children in args.branching.split(',')),n_des=args.des)
+    server,base_url=serve(instance,port=args.port,latency=args.latency,
+                          failure_rate=args.failure_rate,padding=args.padding)
+    print('DHIS2 stand-in serving',len(instance.org_units),'org units and',len(instance.data_elements),
+          'data elements on',base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Parity and timing of the vectorized outlier_detection_assignment against the
+grouped implementation it replaces (df_median_batching_assignment applied per
+DE, then rs_values_addition per batch_median with a shared sklearn
+RobustScaler), on synthetic values.
+
+The grouped applies are run with explicit loops so the reference does not
+depend on the groupby.apply semantics of the installed pandas.
+
+Usage: python benchmarks/parity_outliers.py [n_rows] [n_des] [max_workers]
+"""
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import RobustScaler
+
+from blsq_dqapp.outlier_detection import (outlier_detection_assignment,df_median_batching_assignment,
+                                          rs_values_addition,outliers_rs_based_generator)
+
+
+OUTLIER_COLUMNS=['batch_median','RS_SCORE','EXTREME_RS','OUTLIER_RS','ZERO']
+
+
+def synthetic_values(n_rows=200000,n_des=40,n_ous=2000,n_periods=24,seed=0):
+    rng=np.random.default_rng(seed)
+    de_scale=rng.lognormal(2,1.5,n_des)
+    de_index=rng.integers(0,n_des,n_rows)
+    df=pd.DataFrame({'DE_UID':np.char.add('DE',de_index.astype(str)),
+                     'COC_UID':rng.choice(['COC0','COC1'],n_rows),
+                     'OU_UID':np.char.add('OU',rng.integers(0,n_ous,n_rows).astype(str)),
+                     'PERIOD':np.char.add('2021',rng.integers(1,n_periods+1,n_rows).astype(str)),
+                     'VALUE':np.round(rng.lognormal(0,0.8,n_rows)*de_scale[de_index])})
+    df.loc[rng.random(n_rows)<0.05,'VALUE']=np.nan
+    df.loc[rng.random(n_rows)<0.05,'VALUE']=0
+    df.loc[rng.random(n_rows)<0.002,'VALUE']=df.VALUE*50
+    #A DE without any value and a few rows without OU
+    df.loc[df.DE_UID=='DE0','VALUE']=np.nan
+    df.loc[rng.random(n_rows)<0.001,'OU_UID']=None
+    return df
+
+
+def grouped_outlier_detection_assignment(df,de_uid_vars):
+    re=RobustScaler()
+    de_groups=[df_median_batching_assignment(de_df.copy(),re=re)
+               for _,de_df in df.groupby(de_uid_vars,sort=True)]
+    data_with_outliers=pd.concat(de_groups)
+    #pandas>=2 labels medians outside of the intervals NaN instead of 'nan'
+    #(astype(str) of a categorical), back to the labels the pipeline was built on
+    de_has_values=data_with_outliers.groupby(de_uid_vars).VALUE.transform(lambda values: values.notna().any())
+    relabel=data_with_outliers.batch_median.isna() & data_with_outliers.OU_UID.notna() & de_has_values
+    data_with_outliers.loc[relabel,'batch_median']='nan'
+    batch_groups=[rs_values_addition(batch_df.copy(),re=re)
+                  for _,batch_df in data_with_outliers.groupby('batch_median',sort=True)]
+    return outliers_rs_based_generator(pd.concat(batch_groups))
+
+
+def compare(reference,vectorized):
+    if not reference.index.equals(vectorized.index):
+        return {'SAME_ROWS':False}
+    result={'SAME_ROWS':True}
+    for column in OUTLIER_COLUMNS:
+        reference_column=reference[column]
+        vectorized_column=vectorized[column]
+        if column=='batch_median':
+            result[column]=bool((reference_column.astype(str)==vectorized_column.astype(str)).all())
+        else:
+            result[column]=bool(np.array_equal(reference_column.to_numpy(dtype='float64'),
+                                               vectorized_column.to_numpy(dtype='float64'),equal_nan=True))
+    return result
+
+
+def run(n_rows=200000,n_des=40,max_workers=None):
+    df=synthetic_values(n_rows,n_des)
+    de_uid_vars=['DE_UID','COC_UID']
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        t_start=time.perf_counter()
+        reference=grouped_outlier_detection_assignment(df,de_uid_vars)
+        t_reference=time.perf_counter()-t_start
+    t_start=time.perf_counter()
+    vectorized=outlier_detection_assignment(df,de_uid_vars,max_workers=max_workers)
+    t_vectorized=time.perf_counter()-t_start
+
+    result=compare(reference,vectorized)
+    result.update({'ROWS':n_rows,'MAX_WORKERS':max_workers,'GROUPED_SECONDS':t_reference,'VECTORIZED_SECONDS':t_vectorized,
+                   'SPEEDUP':t_reference/t_vectorized})
+    return result
+
+
+if __name__=='__main__':
+    n_rows=int(sys.argv[1]) if len(sys.argv)>1 else 200000
+    n_des=int(sys.argv[2]) if len(sys.argv)>2 else 40
+    max_workers=int(sys.argv[3]) if len(sys.argv)>3 else None
+    result=run(n_rows,n_des,max_workers)
+    for key,value in result.items():
+        print(key,value)
+    parity=[key for key in ['SAME_ROWS']+OUTLIER_COLUMNS if key in result]
+    sys.exit(0 if all(result[key] for key in parity) else 1)
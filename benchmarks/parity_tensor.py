@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Parity and timing of quality_auction_container on the QualityTensor
+(full_process_run(tensor=True)) against the frame stages, from the outliers
+to fosa_df: processed_df compared row for row, reporting_style_df and
+fosa_df, on a synthetic OU x DE x period grid with missing rows, rows
+without VALUE, OU/DEs without any value and rows without OU.
+
+Usage: python benchmarks/parity_tensor.py [n_ous] [n_des] [n_periods]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from blsq_dqapp.quality_container import quality_auction_container
+
+
+KEYS=['OU_UID','DE_UID','COC_UID','PERIOD']
+STAGES=['outliers_generation','availability_generation','reporting_style_generation','fosa_df_generation']
+
+
+def synthetic_grid(n_ous=500,n_des=20,n_periods=12,seed=0):
+    rng=np.random.default_rng(seed)
+    ous=np.char.add('OU',np.arange(n_ous).astype(str))
+    des=np.char.add('DE',np.arange(n_des).astype(str))
+    periods=np.array(['2021'+str(month).zfill(2) for month in range(1,n_periods+1)])
+    grid=pd.MultiIndex.from_product([ous,des,['COC0','COC1'],periods],names=KEYS).to_frame(index=False)
+    de_scale=dict(zip(des,rng.lognormal(2,1.5,n_des)))
+    grid['VALUE']=np.round(rng.lognormal(0,0.8,grid.shape[0])*grid.DE_UID.map(de_scale).to_numpy())
+    #Rows missing, rows without VALUE, zeros and spikes
+    grid=grid[rng.random(grid.shape[0])>0.3].reset_index(drop=True)
+    grid.loc[rng.random(grid.shape[0])<0.05,'VALUE']=np.nan
+    grid.loc[rng.random(grid.shape[0])<0.05,'VALUE']=0
+    grid.loc[rng.random(grid.shape[0])<0.002,'VALUE']=grid.VALUE*50
+    #A DE without any value, an OU without any value for a DE and rows without OU
+    grid.loc[grid.DE_UID=='DE0','VALUE']=np.nan
+    grid.loc[(grid.OU_UID=='OU1') & (grid.DE_UID=='DE1'),'VALUE']=np.nan
+    grid.loc[rng.random(grid.shape[0])<0.001,'OU_UID']=None
+    tree=pd.DataFrame({'OU_UID':ous,'LEVEL':5})
+    return grid,tree
+
+
+def staged_container(values_df,tree,tensor):
+    container=quality_auction_container(values_df.copy(),tree,None,'','parity',['DE_UID','COC_UID'])
+    if tensor:
+        container.tensor_generation()
+    t_start=time.perf_counter()
+    for stage in STAGES:
+        getattr(container,stage)()
+    return container,time.perf_counter()-t_start
+
+
+def same_rows(frame_df,tensor_df,keys):
+    columns=list(frame_df.columns)
+    if sorted(columns)!=sorted(tensor_df.columns) or frame_df.shape!=tensor_df.shape:
+        return False
+    frame_df=frame_df.sort_values(keys,ignore_index=True)
+    tensor_df=tensor_df[columns].sort_values(keys,ignore_index=True)
+    for column in columns:
+        if pd.api.types.is_numeric_dtype(frame_df[column]):
+            if not np.array_equal(frame_df[column].to_numpy(dtype='float64'),tensor_df[column].to_numpy(dtype='float64'),
+                                  equal_nan=True):
+                return False
+        elif not (frame_df[column].astype(str)==tensor_df[column].astype(str)).all():
+            return False
+    return True
+
+
+def run(n_ous=500,n_des=20,n_periods=12):
+    values_df,tree=synthetic_grid(n_ous,n_des,n_periods)
+    frame_container,t_frame=staged_container(values_df,tree,tensor=False)
+    tensor_container,t_tensor=staged_container(values_df,tree,tensor=True)
+    return {'ROWS':values_df.shape[0],
+            'PROCESSED_ROWS':tensor_container.processed_df.shape[0],
+            'PROCESSED_DF':same_rows(frame_container.processed_df,tensor_container.processed_df,KEYS),
+            'REPORTING_STYLE_DF':same_rows(frame_container.reporting_style_df,tensor_container.reporting_style_df,
+                                           ['OU_UID','DE_UID','COC_UID']),
+            'FOSA_DF':same_rows(frame_container.fosa_df,tensor_container.fosa_df,['OU_UID','DE_UID','COC_UID']),
+            'FRAME_SECONDS':t_frame,
+            'TENSOR_SECONDS':t_tensor}
+
+
+if __name__=='__main__':
+    n_ous=int(sys.argv[1]) if len(sys.argv)>1 else 500
+    n_des=int(sys.argv[2]) if len(sys.argv)>2 else 20
+    n_periods=int(sys.argv[3]) if len(sys.argv)>3 else 12
+    result=run(n_ous,n_des,n_periods)
+    for key,value in result.items():
+        print(key,value)
+    sys.exit(0 if all(result[key] for key in ['PROCESSED_DF','REPORTING_STYLE_DF','FOSA_DF']) else 1)
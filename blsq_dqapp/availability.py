@@ -6,6 +6,12 @@ Created on Tue Jan 12 21:20:18 2021
 """
 from functools import partial
 
+import numpy as np
+import pandas as pd
+
+from .periods import Periods
+from .reporting_style_tools import BYTE_POPCOUNT,COMPLETENESS_LABELS,MAX_BITMASK_PERIODS,completeness_from_bitmasks,completeness_from_sequences
+
 def cross_join(df_left,df_right):
     df_crossed=df_left.assign(join=1).merge(df_right.assign(join=1)).drop('join',axis=1)
     return df_crossed
@@ -70,4 +76,188 @@ def availability_condition_generator_handler(values_df,tree_df,de_uid_vars):
     ##de_uid_vars=[col for col in values_df.columns if col in ['DE_UID','COC_UID'] ]
     #We attached expected to report values
     data_tree_extended=tree_df.merge(values_df,on=['OU_UID','PERIOD']+de_uid_vars,how='left')
-    return _availability_condition_direct(data_tree_extended)
\ No newline at end of file
+    return _availability_condition_direct(data_tree_extended)
+
+def _category_codes(series,categories):
+    #Position in categories (an Index) of each value, -1 when missing. The
+    #values are factorized first, which keeps Arrow strings out of Python objects
+    codes,uniques=pd.factorize(series)
+    return np.append(categories.get_indexer(uniques),-1)[codes]
+
+
+def _key_codes(df,keys):
+    #Row of keys (unique rows) matching each row of df on the keys columns,
+    #from integer codes of each column
+    row_codes=np.zeros(df.shape[0],dtype=np.int64)
+    key_codes=np.zeros(keys.shape[0],dtype=np.int64)
+    for column in keys.columns:
+        column_values=pd.Index(keys[column].unique())
+        row_codes=row_codes*len(column_values)+_category_codes(df[column],column_values)
+        key_codes=key_codes*len(column_values)+column_values.get_indexer(keys[column])
+    return pd.Index(key_codes).get_indexer(row_codes)
+
+
+class AvailabilityBitmap(object):
+    """Presence of values of each OU/DE pair over the periods, without the
+    OU x DE x period frame: OUs, DEs and periods are integer codes and each
+    pair holds a bitmap of its periods with a VALUE (bit i for periods[i]).
+
+    Only pairs with values, or expected ones, are stored. The expanded frame
+    of availability_condition_generator_handler is built by to_frame, when
+    asked for.
+    Parameters
+    ----------
+    ou_uids: array
+    de_keys: DataFrame
+        One row per DE, de_uid_vars columns.
+    periods: list
+        Periods in chronological order (Periods.chronological).
+    pair_ou_codes,pair_de_codes: array
+        OU and DE codes of each pair.
+    bits: array
+        uint8 array of shape (pairs,ceil(periods/8)), bits packed little endian.
+    """
+
+    def __init__(self,ou_uids,de_keys,periods,pair_ou_codes,pair_de_codes,bits):
+        self.ou_uids=np.asarray(ou_uids,dtype=object)
+        self.de_keys=de_keys.reset_index(drop=True)
+        self.periods=list(periods)
+        self.pair_ou_codes=pair_ou_codes
+        self.pair_de_codes=pair_de_codes
+        self.bits=bits
+
+    @classmethod
+    def from_values(cls,values_df,de_uid_vars,periods=None,expected=None):
+        """
+        Bitmap of the periods with a VALUE of each OU/DE pair of values_df.
+        
+        expected restricts the pairs to the ones expected to report, as the 
+        tree of availability_condition_generator_handler does, and adds the 
+        ones without any value: a frame of OU_UID (crossed with the DEs of the
+        values, as codes) or of OU_UID and de_uid_vars.
+        """
+        periods=Periods.chronological(values_df['PERIOD'] if periods is None else periods)
+        present_df=values_df[values_df['VALUE'].notna()]
+        present_df=present_df[present_df[['OU_UID']+de_uid_vars].notna().all(axis=1)]
+        expected_des=expected is not None and set(de_uid_vars)<=set(expected.columns)
+        
+        de_keys=values_df[de_uid_vars].dropna().drop_duplicates()
+        if expected_des:
+            de_keys=pd.concat([de_keys,expected[de_uid_vars]]).dropna().drop_duplicates()
+        de_keys=de_keys.sort_values(de_uid_vars).reset_index(drop=True)
+        n_des=max(len(de_keys),1)
+        
+        ou_uids=pd.Index((present_df if expected is None else expected)['OU_UID'].dropna().unique())
+        ou_codes=_category_codes(present_df['OU_UID'],ou_uids)
+        de_codes=_key_codes(present_df,de_keys)
+        period_codes=_category_codes(present_df['PERIOD'],pd.Index(periods))
+        #Values of OUs not expected, or out of the periods, are left out as by the merge on the tree
+        kept=(ou_codes>=0) & (period_codes>=0)
+        pair_keys=ou_codes[kept].astype(np.int64)*n_des+de_codes[kept]
+        period_codes=period_codes[kept]
+        
+        if expected is None:
+            expected_pairs=np.sort(pd.unique(pair_keys))
+        elif expected_des:
+            expected_pairs=np.sort(pd.unique(_category_codes(expected['OU_UID'],ou_uids).astype(np.int64)*n_des
+                                             +_key_codes(expected,de_keys)))
+            kept=np.isin(pair_keys,expected_pairs)
+            pair_keys,period_codes=pair_keys[kept],period_codes[kept]
+        else:
+            expected_pairs=np.arange(len(ou_uids)*n_des,dtype=np.int64)
+        
+        pair_rows=pair_keys if expected_des is False and expected is not None else np.searchsorted(expected_pairs,pair_keys)
+        presence=np.zeros(expected_pairs.shape[0]*len(periods),dtype=bool)
+        presence[pair_rows*len(periods)+period_codes]=True
+        bits=np.packbits(presence.reshape(-1,len(periods)),axis=1,bitorder='little')
+        return cls(ou_uids,de_keys,periods,(expected_pairs//n_des).astype(np.intp),(expected_pairs%n_des).astype(np.intp),bits)
+
+    @classmethod
+    def from_presence(cls,ou_uids,de_keys,periods,pair_ou_codes,pair_de_codes,presence,expected=None):
+        """
+        Bitmap of a boolean presence array (pairs,periods) of OU/DE pairs
+        given as codes of ou_uids and de_keys, restricted to and completed
+        with the expected pairs as from_values does, without going back to
+        the values frame.
+        """
+        ou_uids=pd.Index(ou_uids)
+        de_keys=de_keys.reset_index(drop=True)
+        if expected is None:
+            return cls(ou_uids,de_keys,periods,pair_ou_codes,pair_de_codes,np.packbits(presence,axis=1,bitorder='little'))
+        expected_des=set(de_keys.columns)<=set(expected.columns)
+
+        #Codes of the pairs in the codebooks of the expected OUs (and DEs)
+        de_uid_vars=list(de_keys.columns)
+        expected_de_keys=de_keys
+        if expected_des:
+            expected_de_keys=pd.concat([de_keys,expected[de_uid_vars]]).dropna().drop_duplicates()
+            expected_de_keys=expected_de_keys.sort_values(de_uid_vars).reset_index(drop=True)
+        n_des=max(len(expected_de_keys),1)
+        expected_ou_uids=pd.Index(expected['OU_UID'].dropna().unique())
+        ou_codes=_category_codes(pd.Series(ou_uids),expected_ou_uids)[pair_ou_codes]
+        de_codes=_key_codes(de_keys,expected_de_keys)[pair_de_codes]
+        kept=ou_codes>=0
+        pair_keys=ou_codes[kept].astype(np.int64)*n_des+de_codes[kept]
+
+        if expected_des:
+            expected_pairs=np.sort(pd.unique(_category_codes(expected['OU_UID'],expected_ou_uids).astype(np.int64)*n_des
+                                             +_key_codes(expected,expected_de_keys)))
+            in_expected=np.isin(pair_keys,expected_pairs)
+            pair_keys=pair_keys[in_expected]
+            kept[kept]=in_expected
+        else:
+            expected_pairs=np.arange(len(expected_ou_uids)*n_des,dtype=np.int64)
+
+        bits=np.zeros((expected_pairs.shape[0],(len(periods)+7)//8),dtype=np.uint8)
+        bits[np.searchsorted(expected_pairs,pair_keys)]=np.packbits(presence[kept],axis=1,bitorder='little')
+        return cls(expected_ou_uids,expected_de_keys,periods,(expected_pairs//n_des).astype(np.intp),
+                   (expected_pairs%n_des).astype(np.intp),bits)
+
+    def presence(self):
+        """Boolean array (pairs,periods)."""
+        return np.unpackbits(self.bits,axis=1,count=len(self.periods),bitorder='little').astype(bool)
+
+    def reporting_counts(self):
+        return BYTE_POPCOUNT[self.bits].sum(axis=1,dtype=np.int64)
+
+    def pairs_frame(self):
+        pairs_df=self.de_keys.iloc[self.pair_de_codes].reset_index(drop=True)
+        pairs_df.insert(0,'OU_UID',self.ou_uids[self.pair_ou_codes])
+        return pairs_df
+
+    def presence_frame(self):
+        """Periods reported by each pair: REPORTING_MONTHS_COUNT and the share
+        of the periods, DE_AVAILABILITY_BOOL as its mean over the expanded frame."""
+        reporting_counts=self.reporting_counts()
+        return self.pairs_frame().assign(REPORTING_MONTHS_COUNT=reporting_counts,
+                                         DE_AVAILABILITY_BOOL=reporting_counts/max(len(self.periods),1))
+
+    def reporting_style(self):
+        """COMPLETENESS of each pair as reporting_style_classifier gives it on
+        the expanded frame: ALWAYS, NEVER, SINCE_FULL (started reporting),
+        STOPPED or INCONSISTENT."""
+        n_periods=len(self.periods)
+        if n_periods<=MAX_BITMASK_PERIODS:
+            #The packed bytes of each pair, little endian, read as one uint64
+            words=np.zeros((self.bits.shape[0],8),dtype=np.uint8)
+            words[:,:self.bits.shape[1]]=self.bits
+            masks=words.view('<u8').ravel().astype(np.uint64)
+            completeness=completeness_from_bitmasks(masks,np.full(masks.shape[0],(1<<n_periods)-1,dtype=np.uint64))
+        else:
+            n_pairs=self.bits.shape[0]
+            completeness=completeness_from_sequences(self.presence().reshape(-1),np.repeat(np.arange(n_pairs),n_periods),n_pairs)
+        summary=COMPLETENESS_LABELS[completeness]
+        reporting_style_df=self.pairs_frame().assign(COMPLETENESS=summary)
+        return reporting_style_df.sort_values(list(reporting_style_df.columns[:-1]),kind='stable').reset_index(drop=True)
+
+    def to_frame(self,values_df=None):
+        """Expanded OU x DE x period frame with DE_AVAILABILITY_BOOL, joined
+        to the values_df columns as availability_condition_generator_handler."""
+        pairs_df=self.pairs_frame()
+        expanded_df=pairs_df.loc[pairs_df.index.repeat(len(self.periods))].reset_index(drop=True)
+        expanded_df['PERIOD']=np.tile(np.asarray(self.periods,dtype=object),len(pairs_df))
+        if values_df is None:
+            expanded_df['DE_AVAILABILITY_BOOL']=self.presence().reshape(-1).astype('uint8')
+            return expanded_df
+        expanded_df=expanded_df.merge(values_df,on=['OU_UID','PERIOD']+list(self.de_keys.columns),how='left')
+        return _availability_condition_direct(expanded_df)
@@ -26,16 +26,44 @@ def fosa_stats_generator(df,grouping_cols):
     
     return df_mean
 
+def fosa_stats_from_availability(df,availability,grouping_cols):
+    #Same stats as fosa_stats_generator, the reporting months coming from the
+    #availability bitmap instead of the expanded OU x DE x period frame
+    grouped=df[['VALUE','OUTLIER_RS','ZERO']+grouping_cols].groupby(grouping_cols)
+    return fosa_stats_from_aggregates(grouped[['OUTLIER_RS','ZERO']].sum(),grouped[['VALUE','OUTLIER_RS']].mean(),
+                                      availability,grouping_cols)
+
+def fosa_stats_from_aggregates(df_sum,df_mean,availability,grouping_cols):
+    #OUTLIER_RS and ZERO sums, VALUE and OUTLIER_RS means of each OU/DE (indexed
+    #by grouping_cols) completed with the reporting months of the bitmap. Pairs
+    #not expected to report are left out as by the expansion
+    presence_df=availability.presence_frame().set_index(grouping_cols)
+    
+    df_sum=df_sum.reindex(presence_df.index).fillna(0)
+    df_sum.insert(0,'REPORTING_MONTHS_COUNT',presence_df['REPORTING_MONTHS_COUNT'])
+    df_sum=df_sum.astype('uint8').rename(columns={'OUTLIER_RS':'OUTLIER_RS_COUNT'})
+    df_mean=df_mean.reindex(presence_df.index)
+    df_mean.insert(1,'DE_AVAILABILITY_BOOL',presence_df['DE_AVAILABILITY_BOOL'])
+    df_mean['OUTLIER_FOSA']=(df_mean['OUTLIER_RS']>0).astype('uint8')
+    df_mean=df_mean.drop('OUTLIER_RS',axis=1)
+    df_mean=df_mean.join(df_sum)
+    
+    return df_mean
+
 def reporting_style_df_extension(df,added_de_uid_vars):
     df.COMPLETENESS=np.where(df.COMPLETENESS=='SINCE_FULL','ALWAYS',df.COMPLETENESS)
     reporting_matrix=pd.get_dummies(df.COMPLETENESS)
     df=pd.concat([df.drop('COMPLETENESS',axis=1),reporting_matrix],axis=1)
     return df
 
-def fosa_level_df_generation(df,df_reporting_style,added_de_uid_vars):
+def fosa_level_df_generation(df,df_reporting_style,added_de_uid_vars,availability=None,fosa_stats_df=None):
     grouping_cols=['OU_UID']+added_de_uid_vars
     
-    fosa_stats_df=fosa_stats_generator(df,grouping_cols)
+    #Stats already computed (e.g. QualityTensor.fosa_stats) are taken as given
+    if fosa_stats_df is None and availability is not None:
+        fosa_stats_df=fosa_stats_from_availability(df,availability,grouping_cols)
+    elif fosa_stats_df is None:
+        fosa_stats_df=fosa_stats_generator(df,grouping_cols)
     df_reporting_style=reporting_style_df_extension(df_reporting_style,added_de_uid_vars)
     
     return df_reporting_style.join(fosa_stats_df,on=grouping_cols)
@@ -1,6 +1,9 @@
 
 from shapely.geometry import LineString, Point, shape
 import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def as_geometry(coordinates):
@@ -19,7 +22,7 @@ def as_geometry(coordinates):
         try:
             return Point(float(x[0]), float(x[1]))
         except ValueError as err:
-            print("WARN couldn't parse coordinates", coordinates, err)
+            logger.warning("couldn't parse coordinates %s %s", coordinates, err)
             return None
     
         
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP layer of Dhis2Client: timeouts, retries with exponential backoff and
+jitter, Retry-After support, a token bucket rate limiter shared by the
+threads of an extraction, connection pools and transfer statistics.
+"""
+import email.utils
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger=logging.getLogger(__name__)
+
+RETRY_STATUSES=(429,502,503,504)
+#Methods sent again on failure, a POST may have been applied before failing
+IDEMPOTENT_METHODS=('get','head','options','put','delete')
+
+
+def redacted_url(url):
+    """url without its user:password@ part, for logs and metrics."""
+    url_parts=urllib.parse.urlsplit(url)
+    if '@' not in url_parts.netloc:
+        return url
+    return urllib.parse.urlunsplit(url_parts._replace(netloc=url_parts.netloc.rsplit('@',1)[1]))
+
+
+def mount_pools(session,pool_size=10):
+    """Mount http/https adapters keeping up to pool_size alive connections per
+    host, and ask for compressed answers."""
+    for prefix in ('http://','https://'):
+        session.mount(prefix,HTTPAdapter(pool_connections=10,pool_maxsize=pool_size))
+    session.headers['Accept-Encoding']='gzip, deflate'
+    session.headers['Connection']='keep-alive'
+
+
+def session_connections(session):
+    """Number of connections opened so far by the pools of a session."""
+    connections=0
+    for adapter in getattr(session,'adapters',{}).values():
+        pools=getattr(getattr(adapter,'poolmanager',None),'pools',None)
+        if pools is None:
+            continue
+        for pool_key in list(pools.keys()):
+            try:
+                connections +=pools[pool_key].num_connections
+            except KeyError:
+                #Evicted in the meantime by another thread
+                pass
+    return connections
+
+
+class TransferStats(object):
+    """Counters of the answers received: bytes on the wire (compressed, as read
+    from the socket), decoded body bytes and answers sent uncompressed."""
+
+    def __init__(self):
+        self.responses=0
+        self.wire_bytes=0
+        self.body_bytes=0
+        self.uncompressed=0
+        self._lock=threading.Lock()
+
+    def record(self,resp):
+        raw=getattr(resp,'raw',None)
+        wire_bytes=raw.tell() if hasattr(raw,'tell') else 0
+        #Streamed bodies are decoded by the caller, their decoded size is unknown
+        body_bytes=len(resp._content) if isinstance(getattr(resp,'_content',None),bytes) else 0
+        headers=getattr(resp,'headers',None) or {}
+        with self._lock:
+            self.responses +=1
+            self.wire_bytes +=wire_bytes
+            self.body_bytes +=body_bytes
+            if 'Content-Encoding' not in headers:
+                self.uncompressed +=1
+
+    def snapshot(self):
+        with self._lock:
+            return {'responses':self.responses,
+                    'wire_bytes':self.wire_bytes,
+                    'body_bytes':self.body_bytes,
+                    'uncompressed':self.uncompressed}
+
+
+class TokenBucket(object):
+    """Thread safe token bucket: acquire() blocks until a request can be sent
+    at the current rate.
+
+    The rate is adapted to the server: it is halved when the server answers
+    429/503 and recovers by rate_step requests/s per successful request, up to
+    max_rate, so the throughput settles just under what the server sustains.
+    Parameters
+    ----------
+    rate: float
+        Requests per second.
+    capacity: float, optional
+        Burst size, rate by default (at least 1).
+    min_rate: float
+        Floor of the adapted rate.
+    """
+
+    def __init__(self,rate,capacity=None,min_rate=0.1,rate_step=0.05):
+        self.max_rate=float(rate)
+        self.rate=float(rate)
+        self.capacity=float(capacity or max(rate,1))
+        self.min_rate=min(min_rate,self.max_rate)
+        self.rate_step=rate_step
+        self.tokens=self.capacity
+        self.updated_at=time.monotonic()
+        self._lock=threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens>=1:
+                    self.tokens -=1
+                    return
+                wait=(1-self.tokens)/self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self._lock:
+            self._refill()
+            self.rate=max(self.rate/2,self.min_rate)
+
+    def speed_up(self):
+        with self._lock:
+            self._refill()
+            self.rate=min(self.rate+self.rate_step,self.max_rate)
+
+    def _refill(self):
+        now=time.monotonic()
+        self.tokens=min(self.tokens+(now-self.updated_at)*self.rate,self.capacity)
+        self.updated_at=now
+
+
+def retry_after_seconds(resp):
+    """Seconds asked by a Retry-After header (delay or HTTP date), or None."""
+    retry_after=resp.headers.get('Retry-After') if resp.headers else None
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after),0)
+    except ValueError:
+        pass
+    try:
+        retry_date=email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError,ValueError):
+        return None
+    return max(retry_date.timestamp()-time.time(),0)
+
+
+class RequestExecutor(object):
+    """Sends the requests of a session with a timeout, retrying connection
+    errors, timeouts and the RETRY_STATUSES answers of the IDEMPOTENT_METHODS.
+    Other methods are sent once.
+
+    The wait before retry n is drawn in [0,backoff_factor*2**n] (full jitter),
+    capped at max_backoff, unless the server sends a Retry-After. A Retry-After
+    over max_retry_after (max_backoff by default) is not waited for, the
+    answer is returned as is. Once the retries are exhausted the last answer
+    is returned, or the last exception raised.
+    Parameters
+    ----------
+    session: requests.Session
+    timeout: float or (connect,read) tuple
+        Used when the call does not give its own.
+    max_retries: int
+    max_retry_after: float, optional
+        Longest Retry-After waited for, in seconds.
+    rate_limiter: TokenBucket, optional
+    metrics: RequestMetrics, optional
+        Collector receiving one record per request.
+    """
+
+    def __init__(self,session,timeout=(10,300),max_retries=5,backoff_factor=1,max_backoff=60,
+                 rate_limiter=None,retry_statuses=RETRY_STATUSES,metrics=None,max_retry_after=None):
+        self.session=session
+        self.timeout=timeout
+        self.max_retries=max_retries
+        self.backoff_factor=backoff_factor
+        self.max_backoff=max_backoff
+        self.max_retry_after=max_backoff if max_retry_after is None else max_retry_after
+        self.rate_limiter=rate_limiter
+        self.retry_statuses=retry_statuses
+        self.transfer_stats=TransferStats()
+        self.metrics=metrics
+
+    def get(self,url,**kwargs):
+        return self.request('get',url,**kwargs)
+
+    def post(self,url,**kwargs):
+        return self.request('post',url,**kwargs)
+
+    def request(self,method,url,defer_metrics=False,retry_read_timeouts=True,**kwargs):
+        """Send the request with retries. With defer_metrics the metrics record
+        is attached to the answer (resp.metrics_record) for the caller to add
+        the parsing measures and emit it. Without retry_read_timeouts a read
+        timeout is raised at once, for requests the caller would rather split
+        than send again."""
+        kwargs.setdefault('timeout',self.timeout)
+        max_retries=self.max_retries if method.lower() in IDEMPOTENT_METHODS else 0
+        record=None
+        if self.metrics is not None:
+            record=self.metrics.new_record(self._endpoint(url),url)
+        t_start=time.perf_counter()
+        attempt=0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                resp=getattr(self.session,method)(url,**kwargs)
+            except (requests.ConnectionError,requests.Timeout) as error:
+                if attempt>=max_retries or (isinstance(error,requests.ReadTimeout) and not retry_read_timeouts):
+                    self._close_record(record,None,t_start,attempt,None,emit=True)
+                    raise
+                logger.warning('request failed error=%s retry=%s/%s url=%s',error.__class__.__name__,
+                               attempt+1,self.max_retries,redacted_url(url))
+                time.sleep(self._backoff(attempt))
+                attempt +=1
+                continue
+
+            retry=resp.status_code in self.retry_statuses and attempt<max_retries
+            wait=retry_after_seconds(resp) if retry else None
+            if wait is not None and wait>self.max_retry_after:
+                #Not worth holding a worker and its connection that long
+                logger.warning('http status=%s retry_after=%.1fs over max_retry_after=%.1fs, not retried url=%s',
+                               resp.status_code,wait,self.max_retry_after,redacted_url(url))
+                retry=False
+            if self.rate_limiter is not None and resp.status_code in (429,503):
+                self.rate_limiter.slow_down()
+            if not retry:
+                if resp.status_code not in self.retry_statuses and self.rate_limiter is not None:
+                    self.rate_limiter.speed_up()
+                if not kwargs.get('stream'):
+                    self.transfer_stats.record(resp)
+                self._close_record(record,resp,t_start,attempt,kwargs.get('stream'),emit=not defer_metrics)
+                return resp
+
+            if wait is None:
+                wait=self._backoff(attempt)
+            logger.warning('http status=%s retry=%s/%s wait=%.1fs url=%s',resp.status_code,
+                           attempt+1,self.max_retries,wait,redacted_url(url))
+            resp.close()
+            time.sleep(wait)
+            attempt +=1
+
+    def record_stream(self,resp):
+        """Count a streamed answer once its body has been consumed."""
+        self.transfer_stats.record(resp)
+        record=getattr(resp,'metrics_record',None)
+        if record is not None:
+            record['bytes']=self._response_bytes(resp)
+
+    def stats(self):
+        """Transfer counters and connections opened, to be diffed per run."""
+        stats=self.transfer_stats.snapshot()
+        stats['connections']=session_connections(self.session)
+        return stats
+
+    def _close_record(self,record,resp,t_start,attempt,stream,emit):
+        if record is None:
+            return
+        record['latency']=time.perf_counter()-t_start
+        record['retries']=attempt
+        if resp is not None:
+            record['status']=resp.status_code
+            if not stream:
+                record['bytes']=self._response_bytes(resp)
+            resp.metrics_record=record
+        if emit:
+            self.metrics.emit(record)
+
+    @staticmethod
+    def _response_bytes(resp):
+        raw=getattr(resp,'raw',None)
+        return raw.tell() if hasattr(raw,'tell') else None
+
+    @staticmethod
+    def _endpoint(url):
+        url_path=urllib.parse.urlsplit(url).path
+        if '/api/' in url_path:
+            return url_path.split('/api/',1)[1]
+        return url_path
+
+    def _backoff(self,attempt):
+        return random.uniform(0,min(self.backoff_factor*2**attempt,self.max_backoff))
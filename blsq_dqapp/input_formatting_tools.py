@@ -37,5 +37,24 @@ def de_batch_selector(df,de_present_data,managable_row_size=5000000):
 
 
 
+def de_count_batch_selector(de_row_counts,managable_row_size=5000000):
+    #Same kind of batches as de_batch_selector but built from the number of rows
+    #of each DE, so the values do not have to be in memory. DEs are packed in 
+    #their order, a DE over the threshold gets a batch of its own
+    de_batches_list=[]
+    de_batch=[]
+    batch_rows=0
+    for de_uid,de_rows in de_row_counts.items():
+        if de_batch and batch_rows+de_rows>managable_row_size:
+            de_batches_list.append(de_batch)
+            de_batch=[]
+            batch_rows=0
+        de_batch.append(de_uid)
+        batch_rows+=de_rows
+    if de_batch:
+        de_batches_list.append(de_batch)
+    
+    return de_batches_list
+
 
 #TODO filter on time and DE present
\ No newline at end of file
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk stores of extracted values: the batch spool used to checkpoint and
+resume extract_data runs, and the DX item/period partitioned store behind
+the incremental extractions.
+"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+def _parquet_check():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is needed to write the local Parquet stores')
+
+
+def _sorted_uid_lists(item):
+    if isinstance(item,dict):
+        return {key:_sorted_uid_lists(value) for key,value in item.items()}
+    if isinstance(item,(list,tuple)):
+        if all(isinstance(value,str) for value in item):
+            return sorted(item)
+        return [_sorted_uid_lists(value) for value in item]
+    return item
+
+
+class BatchSpool(object):
+    """Spool of completed analytics batches, one Parquet file per batch named
+    after the hash of the batch descriptors.
+
+    A batch that answered without data is recorded with an empty marker file
+    so it is not requested again either. The descriptors of a batch can be 
+    saved with it, for runs that do not cut the same batches again (adaptive
+    batching) to find the cells already extracted through entries(). The 
+    spool is meant to resume an interrupted run and is cleared once the run
+    completes.
+    """
+
+    def __init__(self,spool_dir):
+        _parquet_check()
+        self.spool_dir=spool_dir
+        os.makedirs(self.spool_dir,exist_ok=True)
+
+    @staticmethod
+    def batch_key(*descriptors):
+        #UID lists are sorted, the key does not depend on the order of a batch
+        descriptor_text=json.dumps([_sorted_uid_lists(descriptor) for descriptor in descriptors],sort_keys=True,default=str)
+        return hashlib.sha1(descriptor_text.encode('utf-8')).hexdigest()
+
+    def load(self,key):
+        """Return (found,df), df being None for a batch without data."""
+        if os.path.exists(self._path(key,'.empty')):
+            return True,None
+        if os.path.exists(self._path(key,'.parquet')):
+            return True,pd.read_parquet(self._path(key,'.parquet'))
+        return False,None
+
+    def save(self,key,df,descriptors=None):
+        if descriptors is not None:
+            #Written before the batch, only batches with a data file are taken as done
+            with open(self._path(key,'.json'),'w') as descriptors_file:
+                json.dump(descriptors,descriptors_file,default=str)
+        if df is None:
+            open(self._path(key,'.empty'),'w').close()
+            return
+        #Written aside and renamed so an interrupted run never leaves a partial file
+        tmp_path=self._path(key,'.parquet.tmp')
+        df.to_parquet(tmp_path,index=False)
+        os.replace(tmp_path,self._path(key,'.parquet'))
+
+    def entries(self):
+        """(descriptors,df) of the batches saved with their descriptors, df
+        being None for a batch without data."""
+        for file_name in self._batch_files():
+            key=file_name.rsplit('.',1)[0]
+            if not os.path.exists(self._path(key,'.json')):
+                continue
+            with open(self._path(key,'.json')) as descriptors_file:
+                descriptors=json.load(descriptors_file)
+            yield descriptors,self.load(key)[1]
+
+    def clear(self):
+        """Remove the spooled batches, and the spool directory once empty."""
+        for file_name in self._batch_files()+[file_name for file_name in os.listdir(self.spool_dir) 
+                                              if file_name.endswith('.json')]:
+            os.remove(os.path.join(self.spool_dir,file_name))
+        if not os.listdir(self.spool_dir):
+            os.rmdir(self.spool_dir)
+
+    def __len__(self):
+        return len(self._batch_files())
+
+    def _batch_files(self):
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return [file_name for file_name in os.listdir(self.spool_dir)
+                if file_name.endswith('.parquet') or file_name.endswith('.empty')]
+
+    def _path(self,key,suffix):
+        return os.path.join(self.spool_dir,key+suffix)
+
+
+class PartitionedValueStore(object):
+    """Store of extracted values partitioned by requested DX item and period,
+    one Parquet file per partition under DX=<item>/PERIOD=<period>. An item is
+    a DE (all its COCs), a DE.COC or an indicator, as in dx_descriptor, so a
+    DE stored for some of its COCs is not taken as stored for the others.
+
+    A partition is written for every extracted item x period, empty if the
+    extraction found no data, so that it is known as extracted.
+    """
+
+    def __init__(self,store_dir):
+        _parquet_check()
+        self.store_dir=store_dir
+        os.makedirs(self.store_dir,exist_ok=True)
+
+    def stored_periods(self,dx):
+        dx_dir=self._dx_dir(dx)
+        if not os.path.isdir(dx_dir):
+            return set()
+        return {file_name[len('PERIOD='):-len('.parquet')] for file_name in os.listdir(dx_dir)
+                if file_name.startswith('PERIOD=') and file_name.endswith('.parquet')}
+
+    def write(self,df,dx_items,periods):
+        """Replace the partitions of dx_items x periods with the rows of df."""
+        empty_df=df.iloc[0:0]
+        for dx in dx_items:
+            dx_df=df[self._dx_rows(df,dx)]
+            partitions={period:partition_df for period,partition_df in dx_df.groupby('PERIOD',sort=False)}
+            os.makedirs(self._dx_dir(dx),exist_ok=True)
+            for period in periods:
+                partition_df=partitions.get(period,empty_df)
+                partition_path=self._partition_path(dx,period)
+                partition_df.to_parquet(partition_path+'.tmp',index=False)
+                os.replace(partition_path+'.tmp',partition_path)
+
+    def read(self,dx_items,periods):
+        stored_dfs=[pd.read_parquet(self._partition_path(dx,period))
+                    for dx in dx_items for period in periods
+                    if os.path.exists(self._partition_path(dx,period))]
+        stored_dfs=[stored_df for stored_df in stored_dfs if not stored_df.empty]
+        if not stored_dfs:
+            return pd.DataFrame(columns=['OU_UID','PERIOD','DE_UID','COC_UID','VALUE'])
+        #A DE.COC also requested with its whole DE is stored twice
+        return pd.concat(stored_dfs,ignore_index=True).drop_duplicates(['DE_UID','COC_UID','OU_UID','PERIOD'],ignore_index=True)
+
+    @staticmethod
+    def _dx_rows(df,dx):
+        de_uid,_,coc_uid=str(dx).partition('.')
+        dx_rows=df['DE_UID']==de_uid
+        if coc_uid:
+            dx_rows &=df['COC_UID']==coc_uid
+        return dx_rows
+
+    def _dx_dir(self,dx):
+        return os.path.join(self.store_dir,'DX='+str(dx))
+
+    def _partition_path(self,dx,period):
+        return os.path.join(self._dx_dir(dx),'PERIOD='+str(period)+'.parquet')
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Metadata cache used by Dhis2Client to avoid downloading the same metadata
+structures (COCs, data elements, indicators, org units...) on every call.
+
+Entries live in memory and, if a cache_dir is given, in a Parquet store
+keyed by host and metadata type.
+"""
+import json
+import logging
+import os
+import re
+import time
+
+import pandas as pd
+
+
+logger=logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    """In-memory and on-disk store of metadata DataFrames for one DHIS2 host.
+    Parameters
+    ----------
+    host_key: str
+        Identifier of the DHIS2 instance (without credentials).
+    cache_dir: str, optional
+        Root folder of the Parquet store. Memory only if None.
+    ttl: int
+        Seconds during which an entry is used without revalidation.
+    """
+
+    def __init__(self,host_key,cache_dir=None,ttl=3600):
+        self.host_key=re.sub(r'[^\w.-]','_',host_key)
+        self.cache_dir=cache_dir
+        self.ttl=ttl
+        self._memory={}
+
+        if self.cache_dir:
+            try:
+                import pyarrow
+            except ImportError:
+                logger.warning('pyarrow is not installed, metadata cache kept in memory only')
+                self.cache_dir=None
+
+    def get(self,metadata_type):
+        """Return the cached entry of a metadata type, or None.
+
+        The entry is a dict with the data ('data'), its age in seconds ('age')
+        and the server signature it was fetched with ('last_updated').
+        """
+        entry=self._memory.get(metadata_type)
+        if entry is None:
+            entry=self._disk_read(metadata_type)
+            if entry is None:
+                return None
+            self._memory[metadata_type]=entry
+
+        return {'data':self._copy(entry['data']),
+                'age':time.time()-entry['fetched_at'],
+                'last_updated':entry['last_updated']}
+
+    def put(self,metadata_type,data,last_updated=None):
+        entry={'data':self._copy(data),'fetched_at':time.time(),'last_updated':last_updated}
+        self._memory[metadata_type]=entry
+        self._disk_write(metadata_type,entry)
+
+    def touch(self,metadata_type):
+        """Restart the TTL of an entry after a successful revalidation."""
+        entry=self._memory.get(metadata_type)
+        if entry is not None:
+            entry['fetched_at']=time.time()
+            self._disk_write(metadata_type,entry,index_only=True)
+
+    def clear(self,metadata_type=None):
+        metadata_types=[metadata_type] if metadata_type else list(self._memory.keys())
+        for m_type in metadata_types:
+            self._memory.pop(m_type,None)
+        if self.cache_dir:
+            host_dir=self._host_dir()
+            if os.path.isdir(host_dir):
+                for file_name in os.listdir(host_dir):
+                    if not metadata_type or file_name.split('__')[0].split('.')[0]==metadata_type:
+                        os.remove(os.path.join(host_dir,file_name))
+
+    def _copy(self,data):
+        #Callers are free to modify what they get, the cache keeps its own copy
+        if isinstance(data,dict):
+            return {key:item.copy() for key,item in data.items()}
+        return data.copy()
+
+    def _host_dir(self):
+        return os.path.join(self.cache_dir,self.host_key)
+
+    def _disk_read(self,metadata_type):
+        if not self.cache_dir:
+            return None
+        index_path=os.path.join(self._host_dir(),metadata_type+'.json')
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path) as index_file:
+            index=json.load(index_file)
+        try:
+            if index['keys'] is None:
+                data=pd.read_parquet(os.path.join(self._host_dir(),metadata_type+'.parquet'))
+            else:
+                data={key:pd.read_parquet(os.path.join(self._host_dir(),metadata_type+'__'+key+'.parquet'))
+                      for key in index['keys']}
+        except (OSError,ValueError):
+            return None
+        return {'data':data,'fetched_at':index['fetched_at'],'last_updated':index['last_updated']}
+
+    def _disk_write(self,metadata_type,entry,index_only=False):
+        if not self.cache_dir:
+            return
+        os.makedirs(self._host_dir(),exist_ok=True)
+        data=entry['data']
+        keys=list(data.keys()) if isinstance(data,dict) else None
+        if not index_only:
+            if keys is None:
+                data.to_parquet(os.path.join(self._host_dir(),metadata_type+'.parquet'),index=False)
+            else:
+                for key,item in data.items():
+                    item.to_parquet(os.path.join(self._host_dir(),metadata_type+'__'+key+'.parquet'),index=False)
+        with open(os.path.join(self._host_dir(),metadata_type+'.json'),'w') as index_file:
+            json.dump({'fetched_at':entry['fetched_at'],
+                       'last_updated':entry['last_updated'],
+                       'keys':keys},index_file)
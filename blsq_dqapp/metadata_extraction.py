@@ -9,51 +9,156 @@ import urllib
 from datetime import datetime
 from.periods import Periods
 from .geometry import geometrify
+from .metadata_cache import MetadataCache
+from .query_planning import AdaptiveBatchController,url_batch_planner,ou_hierarchy_compressor
+from .local_store import BatchSpool,PartitionedValueStore
+from .http_executor import RequestExecutor,TokenBucket,mount_pools
+from .metrics import RequestMetrics,configure_logging
 import geopandas
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+import re
+import os
+import logging
+
+
+logger=logging.getLogger(__name__)
+
+ANALYTICS_ROWS_KEY=re.compile(r'"rows"\s*:\s*\[')
+
+
+class ColumnarFrameBuilder(object):
+    """Accumulates records column by column to build a single DataFrame at the 
+    end, instead of building and concatenating one-row DataFrames.
+    
+    Columns first seen after some records are backfilled with None, and columns 
+    missing in a record are filled with None.
+    """
+    def __init__(self,columns=None):
+        self.columns={}
+        self.n_rows=0
+        if columns:
+            for column in columns:
+                self.columns[column]=[]
+    
+    def append(self,record):
+        for column,value in record.items():
+            if column not in self.columns:
+                self.columns[column]=[None]*self.n_rows
+            self.columns[column].append(value)
+        self.n_rows +=1
+        if len(record)<len(self.columns):
+            for column_values in self.columns.values():
+                if len(column_values)<self.n_rows:
+                    column_values.append(None)
+    
+    def to_frame(self):
+        return pd.DataFrame(self.columns)
 
 
 class Dhis2Client(object):
-    def __init__(self,host,full_url=False,optional_prefix=None,agent_name='dqapp'):
+    def __init__(self,host,full_url=False,optional_prefix=None,agent_name='dqapp',
+                 use_cache=False,cache_dir=None,cache_ttl=3600,
+                 timeout=(10,300),max_retries=5,rate_limit=None,pool_size=10,
+                 metrics_hooks=None,log_level=None):
         
+        #Credentials go to the session auth, never in baseurl, which ends up
+        #in logs and metrics
+        auth=None
         if host.startswith('http'):
+            url_parts=urllib.parse.urlsplit(host)
+            if url_parts.username is not None:
+                auth=(urllib.parse.unquote(url_parts.username),urllib.parse.unquote(url_parts.password or ''))
+                host=urllib.parse.urlunsplit(url_parts._replace(netloc=url_parts.netloc.rsplit('@',1)[1]))
             self.baseurl = host
         else:
             API_USER = getpass.getpass("API User")
             API_PWD = getpass.getpass("API Password")
-            
-            user = urllib.parse.quote(API_USER)
-            pwd = urllib.parse.quote(API_PWD)
+            auth=(API_USER,API_PWD)
 
-            self.baseurl = "https://"+user+":"+pwd+"@"+host
+            self.baseurl = "https://"+host
         
+        self.auth=auth
         self.session = requests.Session()
+        #Kept alive connections per host, raised to max_workers by concurrent extractions
+        self.pool_size=pool_size
+        mount_pools(self.session,pool_size=self.pool_size)
+        #Every call goes through the executor: timeouts, retries of the GETs with
+        #backoff on connection errors and 429/502/503/504 (POSTs are sent once),
+        #and a rate limit (requests/s) shared by the extraction threads
+        #One metrics record per request, passed to metrics_hooks and summarised
+        #at the end of the extractions
+        self.metrics=RequestMetrics(hooks=metrics_hooks)
+        self.executor=RequestExecutor(self.session,timeout=timeout,max_retries=max_retries,
+                                      rate_limiter=TokenBucket(rate_limit) if rate_limit else None,
+                                      metrics=self.metrics)
+        #Progress is logged at INFO, each request url at DEBUG. The logging 
+        #configuration is left to the application unless log_level is given
+        if log_level:
+            configure_logging(log_level)
         self.optional_prefix=optional_prefix
         self.agent_name=agent_name
         self.s_cookies=None
+        
+        #With use_cache, metadata structures are cached in memory (and on disk
+        #with cache_dir) and revalidated against the server lastUpdated once
+        #cache_ttl expires
+        if use_cache:
+            self.metadata_cache=MetadataCache(self._host_key(),cache_dir=cache_dir,ttl=cache_ttl)
+        else:
+            self.metadata_cache=None
+
+    @property
+    def session(self):
+        return self._session
+    
+    @session.setter
+    def session(self,session):
+        #A session set on the client (authentication, proxies...) is the one the
+        #executor sends the requests with, authenticated as the client
+        if session.auth is None and getattr(self,'auth',None) is not None:
+            session.auth=self.auth
+        self._session=session
+        if getattr(self,'executor',None) is not None:
+            self.executor.session=session
+
+    def _host_key(self):
+        url_parts=urllib.parse.urlsplit(self.baseurl)
+        host_key=url_parts.hostname or ''
+        if url_parts.port:
+            host_key=host_key+'_'+str(url_parts.port)
+        host_key=host_key+url_parts.path
+        if self.optional_prefix:
+            host_key=host_key+self.optional_prefix
+        return host_key
 
     def get(self, path, params=None,silent=False,verify=True):
+        return self._get_response(path,params=params,silent=silent,verify=verify).json()
+    
+    def _get_response(self, path, params=None,silent=False,verify=True):
         if self.optional_prefix:
             url = self.baseurl+self.optional_prefix+"/api/"+path
         else:
             url = self.baseurl+"/api/"+path
         if self.s_cookies:
-            resp = self.session.get(url, 
-                                    params=params,
-                                    headers={'user-agent':self.agent_name },
-                                    cookies=self.s_cookies
-                                    )
+            resp = self.executor.get(url, 
+                                     params=params,
+                                     headers={'user-agent':self.agent_name },
+                                     cookies=self.s_cookies
+                                     )
         if not self.s_cookies:
-            resp = self.session.get(url, 
-                                    params=params,
-                                    verify=verify,
-                                    headers={'user-agent':self.agent_name }
-                                    )
+            resp = self.executor.get(url, 
+                                     params=params,
+                                     verify=verify,
+                                     headers={'user-agent':self.agent_name }
+                                     )
             self.s_cookies=resp.cookies
         if not silent:
-            print(resp.request.path_url)
-        return resp.json()
+            logger.debug('%s',resp.request.path_url)
+        return resp
     
     def post(self, path, data=None,json=None,silent=False,verify=True):
         if self.optional_prefix:
@@ -61,14 +166,17 @@ class Dhis2Client(object):
         else:
             url = self.baseurl+"/api/"+path
         if verify:
-            resp = self.session.post(url, data=data,json=json)
+            resp = self.executor.post(url, data=data,json=json)
         if not verify:
-            resp = self.session.post(url, data=data,json=json,verify=False)
+            resp = self.executor.post(url, data=data,json=json,verify=False)
         if not silent:
-            print(resp.request.path_url)
+            logger.debug('%s',resp.request.path_url)
         return resp.json()
     
-    def fetch_organisation_units_structure(self):
+    def fetch_organisation_units_structure(self,refresh_cache=False):
+        return self._cached_metadata('organisationUnits',self._fetch_organisation_units_structure,['organisationUnits'],refresh=refresh_cache)
+    
+    def _fetch_organisation_units_structure(self):
         organisationUnitsStructure=self.get("organisationUnits.json", 
                                              params={
                                                      "paging":False, 
@@ -80,7 +188,10 @@ class Dhis2Client(object):
         organisationUnitsStructure=self._outree_json_to_df(organisationUnitsStructure)
         return organisationUnitsStructure
     
-    def fetch_data_elements_structure(self):
+    def fetch_data_elements_structure(self,refresh_cache=False):
+        return self._cached_metadata('dataElements',self._fetch_data_elements_structure,['dataElements','categoryOptionCombos','categoryCombos'],refresh=refresh_cache)
+    
+    def _fetch_data_elements_structure(self):
         dataElementsStructure = self.get("dataElements.json", 
                                          params={
                                                 "paging":False,                                                          
@@ -97,7 +208,12 @@ class Dhis2Client(object):
         
         return dataElementsStructure
     
-    def fetch_indicators_structure(self,coc_default_name="default"):
+    def fetch_indicators_structure(self,coc_default_name="default",refresh_cache=False):
+        return self._cached_metadata('indicators_'+coc_default_name,
+                                     partial(self._fetch_indicators_structure,coc_default_name=coc_default_name),
+                                     ['indicators','categoryOptionCombos'],refresh=refresh_cache)
+    
+    def _fetch_indicators_structure(self,coc_default_name="default"):
         indicatorsStructure = self.get("indicators.json", 
                                          params={
                                                 "paging":False,                                                          
@@ -111,7 +227,10 @@ class Dhis2Client(object):
         
         return indicatorsStructure
     
-    def fetch_dataset_structure(self):
+    def fetch_dataset_structure(self,refresh_cache=False):
+        return self._cached_metadata('dataSets',self._fetch_dataset_structure,['dataSets'],refresh=refresh_cache)
+    
+    def _fetch_dataset_structure(self):
         dataSetsStructure = self.get("dataSets.json", 
                                      params={
                                             "paging":False,                                                          
@@ -124,7 +243,10 @@ class Dhis2Client(object):
         dataSetsStructure=self._datasets_json_to_df(dataSetsStructure)
         return dataSetsStructure
     
-    def fetch_coc_structure(self):
+    def fetch_coc_structure(self,refresh_cache=False):
+        return self._cached_metadata('categoryOptionCombos',self._fetch_coc_structure,['categoryOptionCombos','categoryCombos'],refresh=refresh_cache)
+    
+    def _fetch_coc_structure(self):
         categoryOptionCombosStructure = self.get("categoryOptionCombos.json",
                                                  silent=True,
                                                  params={
@@ -135,20 +257,17 @@ class Dhis2Client(object):
         
         categoryOptionCombosStructure=self._cocs_json_to_df(categoryOptionCombosStructure)
         
-        #Adding current use categories information 
-        categoryCombos_UIDS=categoryOptionCombosStructure.CC_UID.unique().tolist()
-        coc_queries_df_list=[]
-        for coc_unit_uid in categoryCombos_UIDS:
-            categoryComboStructure_UID_unit = self.get(f"categoryCombos/{coc_unit_uid}.json",
-                                                 silent=True,
-                                                 params={                                                        
-                                                         "fields":
-                                                                 "id,categoryOptionCombos"
-                                                         })
-            coc_queries_df_list.append(self._cc_uid_json_to_df(categoryComboStructure_UID_unit))
+        #Adding current use categories information, all the category combos are 
+        #resolved in a single request
+        categoryCombosStructure = self.get("categoryCombos.json",
+                                           silent=True,
+                                           params={
+                                                   "paging":False,
+                                                   "fields":
+                                                           "id,categoryOptionCombos[id]"
+                                                   })['categoryCombos']
             
-        categoryOptionCombosStructure_Current=pd.concat(coc_queries_df_list,
-                                                        ignore_index=True).assign(CURRENT_USE=True)
+        categoryOptionCombosStructure_Current=self._ccs_json_to_df(categoryCombosStructure).assign(CURRENT_USE=True)
         categoryOptionCombosStructure=categoryOptionCombosStructure.merge(categoryOptionCombosStructure_Current,
                                                                             on=['CC_UID','COC_UID'],
                                                                             how='left')
@@ -156,7 +275,10 @@ class Dhis2Client(object):
         
         return categoryOptionCombosStructure
     
-    def fetch_deg_structure(self):
+    def fetch_deg_structure(self,refresh_cache=False):
+        return self._cached_metadata('dataElementGroups',self._fetch_deg_structure,['dataElementGroups'],refresh=refresh_cache)
+    
+    def _fetch_deg_structure(self):
         dataElementGroupsStructure = self.get("dataElementGroups.json", 
                                                      params={
                                                             "paging":False,                                                          
@@ -168,7 +290,10 @@ class Dhis2Client(object):
         dataElementGroupsStructure=self._deg_json_to_df(dataElementGroupsStructure)
         return dataElementGroupsStructure
     
-    def fetch_indg_structure(self):
+    def fetch_indg_structure(self,refresh_cache=False):
+        return self._cached_metadata('indicatorGroups',self._fetch_indg_structure,['indicatorGroups'],refresh=refresh_cache)
+    
+    def _fetch_indg_structure(self):
         indicatorGroupsStructure = self.get("indicatorGroups.json", 
                                                      params={
                                                             "paging":False,                                                          
@@ -180,7 +305,10 @@ class Dhis2Client(object):
         indicatorGroupsStructure=self._indg_json_to_df(indicatorGroupsStructure)
         return indicatorGroupsStructure
     
-    def fetch_oug_structure(self):
+    def fetch_oug_structure(self,refresh_cache=False):
+        return self._cached_metadata('organisationUnitGroups',self._fetch_oug_structure,['organisationUnitGroups'],refresh=refresh_cache)
+    
+    def _fetch_oug_structure(self):
         organisationUnitGroupsStructure = self.get("organisationUnitGroups.json",
                                                      params={
                                                             "paging":False,                                                          
@@ -192,6 +320,47 @@ class Dhis2Client(object):
         organisationUnitGroupsStructure=self._oug_json_to_df(organisationUnitGroupsStructure)
         return organisationUnitGroupsStructure
     
+    def _cached_metadata(self,metadata_type,fetch_function,endpoints,refresh=False):
+        if self.metadata_cache is None:
+            return fetch_function()
+        
+        entry=None
+        if not refresh:
+            entry=self.metadata_cache.get(metadata_type)
+        if entry is not None:
+            if entry['age']<self.metadata_cache.ttl:
+                return entry['data']
+            last_updated=self._metadata_last_updated(endpoints)
+            if last_updated and last_updated==entry['last_updated']:
+                self.metadata_cache.touch(metadata_type)
+                return entry['data']
+        else:
+            last_updated=self._metadata_last_updated(endpoints)
+            
+        metadata_structure=fetch_function()
+        self.metadata_cache.put(metadata_type,metadata_structure,last_updated)
+        return metadata_structure
+    
+    def _metadata_last_updated(self,endpoints):
+        #Signature of the metadata on the server: last update and number of items
+        #for each endpoint, so that updates as well as deletions are detected
+        signatures=[]
+        for endpoint in endpoints:
+            try:
+                answer=self.get(endpoint+'.json',
+                                silent=True,
+                                params={
+                                        "fields":"lastUpdated",
+                                        "order":"lastUpdated:desc",
+                                        "pageSize":1
+                                        })
+                items=answer[endpoint]
+                last_updated=items[0]['lastUpdated'] if items else ''
+                signatures.append(endpoint+':'+last_updated+':'+str(answer['pager']['total']))
+            except (ValueError,KeyError,IndexError):
+                return None
+        return '|'.join(signatures)
+    
     def metadata_country_habari_db_full_refresh(self,iso_code,base_path=None):
         if not base_path:
             metadata_root_path='s3://habari-public/Metadata/'+str(iso_code)+'/'+str(iso_code)+'_'
@@ -214,7 +383,7 @@ class Dhis2Client(object):
         organisationUnits.update({'organisationUnitGroupsStructure':self.fetch_oug_structure()})
         for key,item in organisationUnits.items():
             item.to_csv(ou_path+key+suffix_path,index=False)
-        print('habari_'+str(iso_code)+'_db_updated')
+        logger.info('habari_%s_db_updated',iso_code)
         
     def extract_data_program(self, program_id_list, orgunit_id_list,program_type='event',page_size=40, fetch_all = False):
         programData_json=[]
@@ -243,7 +412,7 @@ class Dhis2Client(object):
             return programData_df
             
         else:
-            print('Not a valid program type')
+            logger.error('Not a valid program type: %s',program_type)
             return
     def fetch_tracked_entity_instances(self, program_id, orgunit_id,page_size=40, fetch_all = False):
         
@@ -256,7 +425,7 @@ class Dhis2Client(object):
         tracked_entity_instances = self.get(tei_url)
         num_pages = tracked_entity_instances["pager"]["pageCount"]
 
-        print(tracked_entity_instances["pager"])
+        logger.info('pager=%s',tracked_entity_instances["pager"])
         if fetch_all :
             for page in range(2, num_pages + 1) : 
                 page_url_suffix="&page="+str(page)
@@ -313,25 +482,37 @@ class Dhis2Client(object):
             return gdf
 
         
-    def extract_reporting(self,datasets,pe_start_date,pe_end_date,frequency,ou_descriptor,report_types=['REPORTING_RATE'],silent=False,dx_batch_size=None,ou_batch_size=None):
+    def extract_reporting(self,datasets,pe_start_date,pe_end_date,frequency,ou_descriptor,report_types=['REPORTING_RATE'],silent=False,dx_batch_size=None,ou_batch_size=None,max_workers=None,streaming=False):
         dx_descriptor_list=[]
         for dataset in datasets:
             for report_type in report_types:
                 dx_descriptor_list.append(dataset+'.'+report_type)
         dx_descriptor={'DX':dx_descriptor_list}
         
-        return self.extract_data(dx_descriptor,pe_start_date,pe_end_date,frequency,ou_descriptor,silent=silent,dx_batch_size=dx_batch_size,ou_batch_size=ou_batch_size).rename(columns={'DE_UID':'DS_UID','COC_UID':'REPORTING_TYPE'})
+        return self.extract_data(dx_descriptor,pe_start_date,pe_end_date,frequency,ou_descriptor,silent=silent,dx_batch_size=dx_batch_size,ou_batch_size=ou_batch_size,max_workers=max_workers,streaming=streaming).rename(columns={'DE_UID':'DS_UID','COC_UID':'REPORTING_TYPE'})
         
     
     def extract_data(self,dx_descriptor,pe_start_date,pe_end_date,frequency,ou_descriptor,
                      coc_default_name="default",silent=False,expand_coc=True,
-                     dx_batch_size=None,ou_batch_size=None,current_usage=True,dx_coc_uids_to_filter=None):
+                     dx_batch_size=None,ou_batch_size=None,current_usage=True,dx_coc_uids_to_filter=None,
+                     max_workers=None,streaming=False,
+                     adaptive_batching=False,target_seconds=30,batch_state_path=None,
+                     max_url_bytes=None,max_rows=None,hierarchy_planning=False,ou_tree_df=None,
+                     checkpoint_dir=None,periods=None,return_unresolved=False):
+        
+        #With return_unresolved, (values,unresolved) is returned, unresolved being
+        #None or the (dx_descriptor,ou_descriptor) of the batches that kept failing
+        if adaptive_batching and 'OUG' in ou_descriptor.keys():
+            raise ValueError('adaptive_batching cannot cut an OUG ou_descriptor, use the batch cycles')
         
         #TODO Filter on valid data type elements
         #Take DE and filter them 
         time_descriptor={'pe_start_date':pe_start_date,
                          'pe_end_date':pe_end_date,
                          'frequency':frequency}
+        if periods:
+            #Explicit period list, used instead of the split of the start/end range
+            time_descriptor['periods']=list(periods)
         
         path="analytics.json"
         if self.optional_prefix:
@@ -350,30 +531,109 @@ class Dhis2Client(object):
                 fetched_dx=[dx_ for dx_ in fetched_dx if not any([_ for _ in dx_coc_uids_to_filter if _ in dx_]) ]
             
             dx_descriptor['DX']=fetched_dx
+        
+        requested_ous=None
+        if hierarchy_planning and ('OU' in ou_descriptor.keys()):
+            #Whole subtrees of the requested units are queried as ancestor;LEVEL-n
+            if ou_tree_df is None:
+                ou_tree_df=self.fetch_organisation_units_structure()
+            requested_ous=ou_descriptor['OU']
+            ou_descriptor=ou_hierarchy_compressor(requested_ous,ou_tree_df)
+            logger.info('OU dimension compressed from %s to %s items',len(requested_ous),
+                        self._max_len_descriptor_estimator(ou_descriptor))
+            
+        #Completed batches are spooled to disk, a rerun with the same arguments
+        #after an interruption restores them instead of requesting them again.
+        #The spool is only for resuming: it is cleared once the run completes
+        batch_spool=None
+        if checkpoint_dir:
+            batch_spool=BatchSpool(checkpoint_dir)
+            logger.info('%s batches already in checkpoint %s',len(batch_spool),checkpoint_dir)
+            
+        if max_workers and max_workers>self.pool_size:
+            self.pool_size=max_workers
+            mount_pools(self.session,pool_size=self.pool_size)
             
         all_extractions_done=False
         analyticsData_df_list_cycles=[]
         
-        print('-- Start requests--',datetime.datetime.now())
+        logger.info('-- Start requests--')
         t_start=time.time()
+        transfer_start=self.executor.stats()
+        metrics_start=self.metrics.emitted
+        
+        if adaptive_batching:
+            #Batch sizes follow the measured cost of each request instead of the 
+            #halving cycles, and are saved for the next run on this host. The 
+            #adaptive path honours max_workers (rounds of concurrent requests), 
+            #max_url_bytes (requests cut to fit, periods split by url_batch_planner),
+            #max_rows (bound of the rows per request), checkpoint_dir, streaming,
+            #hierarchy_planning and periods; dx_batch_size and ou_batch_size are
+            #the starting sizes
+            pe_batchted_descriptors=[time_descriptor]
+            if max_url_bytes:
+                _,_,pe_batches=url_batch_planner(url_analytics_base,dx_descriptor,ou_descriptor,
+                                                 time_descriptor.get('periods') or Periods.split([pe_start_date,pe_end_date],frequency),
+                                                 max_url_bytes=max_url_bytes,max_rows=max_rows)
+                pe_batchted_descriptors=[dict(time_descriptor,periods=pe_batch) for pe_batch in pe_batches]
+            controller_kwargs={'max_rows':max_rows} if max_rows else {}
+            batch_controller=AdaptiveBatchController(self._host_key(),
+                                                     self._max_len_descriptor_estimator(dx_descriptor),
+                                                     self._max_len_descriptor_estimator(ou_descriptor),
+                                                     target_seconds=target_seconds,
+                                                     dx_batch_size=dx_batch_size,
+                                                     ou_batch_size=ou_batch_size,
+                                                     state_path=batch_state_path,
+                                                     **controller_kwargs)
+            dx_uncalled_batchs,ou_uncalled_batchs,analyticsData_df_list_cycles=self._adaptive_query_caller_manager(url_analytics_base,"analytics_extract",
+                                                                                                              dx_descriptor,ou_descriptor,
+                                                                                                              time_descriptor,coc_default_uid,
+                                                                                                              batch_controller,silent=silent,
+                                                                                                              streaming=streaming,
+                                                                                                              max_workers=max_workers,
+                                                                                                              pe_batchted_descriptors=pe_batchted_descriptors,
+                                                                                                              max_url_bytes=max_url_bytes,
+                                                                                                              batch_spool=batch_spool)
+            batch_controller.save()
+            if len(dx_uncalled_batchs)==0 and len(ou_uncalled_batchs)==0:
+                all_extractions_done=True
+            else:
+                dx_descriptor=self._batch_rebuilder(dx_uncalled_batchs)
+                ou_descriptor=self._batch_rebuilder(ou_uncalled_batchs)
+        
         if not dx_batch_size:
             dx_batch_size=self._max_len_descriptor_estimator(dx_descriptor)
         if not ou_batch_size:
             ou_batch_size=self._max_len_descriptor_estimator(ou_descriptor)
         
-        while not all_extractions_done:
-            dx_batchted_descriptors=self._batch_splitter(dx_batch_size,dx_descriptor)
-            ou_batchted_descriptors=self._batch_splitter(ou_batch_size,ou_descriptor)
+        while not all_extractions_done and not adaptive_batching:
+            if max_url_bytes:
+                #Batches packed under the url length limit, splitting the periods if needed
+                dx_batchted_descriptors,ou_batchted_descriptors,pe_batches=url_batch_planner(url_analytics_base,
+                                                                                             dx_descriptor,ou_descriptor,
+                                                                                             time_descriptor.get('periods') or Periods.split([pe_start_date,pe_end_date],frequency),
+                                                                                             max_url_bytes=max_url_bytes,
+                                                                                             dx_batch_size=dx_batch_size,
+                                                                                             ou_batch_size=ou_batch_size,
+                                                                                             max_rows=max_rows)
+                pe_batchted_descriptors=[dict(time_descriptor,periods=pe_batch) for pe_batch in pe_batches]
+            else:
+                dx_batchted_descriptors=self._batch_splitter(dx_batch_size,dx_descriptor)
+                ou_batchted_descriptors=self._batch_splitter(ou_batch_size,ou_descriptor)
+                pe_batchted_descriptors=[time_descriptor]
         
             dx_uncalled_batchs,ou_uncalled_batchs,analyticsData_df_list_cycle=self._query_caller_manager(url_analytics_base,"analytics_extract",
                                                                                                   dx_batchted_descriptors,ou_batchted_descriptors,
-                                                                                                  time_descriptor,coc_default_uid,silent=silent)
+                                                                                                  time_descriptor,coc_default_uid,silent=silent,
+                                                                                                  max_workers=max_workers,streaming=streaming,
+                                                                                                  pe_batchted_descriptors=pe_batchted_descriptors,
+                                                                                                  batch_spool=batch_spool)
             analyticsData_df_list_cycles.extend(analyticsData_df_list_cycle)
             
             if len(dx_uncalled_batchs)==0 and len(ou_uncalled_batchs)==0:
                 all_extractions_done=True        
             else:
-                print("There are still unfinsihed calls. Resetting a new cycle of queries")
+                logger.warning("There are still unfinsihed calls. Resetting a new cycle of queries")
                 
                 #print(dx_uncalled_batchs)
                 dx_descriptor=self._batch_rebuilder(dx_uncalled_batchs)
@@ -386,19 +646,24 @@ class Dhis2Client(object):
                     
                 if dx_batch_size==0 or ou_batch_size==0:
                     break
-                print(f'New cycle dx_batch_size={dx_batch_size} ;ou_batch_size={ou_batch_size}')  
+                logger.info('New cycle dx_batch_size=%s ou_batch_size=%s',dx_batch_size,ou_batch_size)
                 
+        if all_extractions_done and batch_spool is not None:
+            batch_spool.clear()
+        
         try:
             analyticsData_df=pd.concat(analyticsData_df_list_cycles,ignore_index=True)
+            if max_url_bytes:
+                #Failed batches are retried on the whole period range, periods
+                #already extracted in another period batch come twice
+                analyticsData_df=analyticsData_df.drop_duplicates(['DE_UID','COC_UID','OU_UID','PERIOD'],ignore_index=True)
             if not all_extractions_done:
-                print("Unresolved calls")
-                print(dx_descriptor,ou_descriptor)
+                logger.error("Unresolved calls dx=%s ou=%s",dx_descriptor,ou_descriptor)
         except ValueError:
             if all_extractions_done:
-                print("No data has been found for the whole range of metadata")
+                logger.warning("No data has been found for the whole range of metadata")
             else:
-                print("Unresolved calls")
-                print(dx_descriptor,ou_descriptor)
+                logger.error("Unresolved calls dx=%s ou=%s",dx_descriptor,ou_descriptor)
                 
             analyticsData_df=pd.DataFrame(columns=['OU_UID','PERIOD','DE_UID','COC_UID','VALUE'])
             
@@ -407,16 +672,107 @@ class Dhis2Client(object):
         #Make sure we filter on original requested data:
             
         analyticsData_df=self._filter_on_requested_uids(fetched_dx,analyticsData_df)
+        if requested_ous is not None:
+            analyticsData_df=analyticsData_df[analyticsData_df.OU_UID.isin(requested_ous)].reset_index(drop=True)
         
-        print('-- End of requests--',datetime.datetime.now())
+        logger.info('-- End of requests--')
         t_end=time.time()
-        print('Total time:',round((t_end-t_start)/60,2),'min')
+        logger.info('Total time: %s min',round((t_end-t_start)/60,2))
+        self._transfer_report(transfer_start)
+        self._metrics_report(metrics_start)
+        if return_unresolved:
+            return analyticsData_df,None if all_extractions_done else (dx_descriptor,ou_descriptor)
         return analyticsData_df
+    
+    def _transfer_report(self,transfer_start):
+        #Transfer of the run: what came through the wire against the decoded 
+        #size, and how many connections had to be opened for it
+        transfer_end=self.executor.stats()
+        self.last_transfer_stats={key:transfer_end[key]-transfer_start[key] for key in transfer_end}
+        stats=self.last_transfer_stats
+        logger.info('responses=%s wire_mb=%.2f decoded_mb=%.2f uncompressed_responses=%s connections_opened=%s',
+                    stats['responses'],stats['wire_bytes']/1e6,stats['body_bytes']/1e6,
+                    stats['uncompressed'],stats['connections'])
+        return stats
+    
+    def _metrics_report(self,metrics_start):
+        #Summary of the requests of the run, kept in last_metrics_summary
+        self.last_metrics_summary=self.metrics.summary(start=metrics_start)
+        summary=self.last_metrics_summary
+        if not summary['requests']:
+            return summary
+        logger.info('requests=%s failed=%s retries=%s latency_p50=%.2fs latency_p95=%.2fs rows=%s rows_per_second=%.0f parse_seconds=%.2f',
+                    summary['requests'],summary['failed'],summary['retries'],summary['latency_p50'],
+                    summary['latency_p95'],summary['rows'],summary['rows_per_second'],summary['parse_seconds'])
+        for slow_request in summary['slowest'].itertuples():
+            logger.debug('slow request latency=%.2fs rows=%s url=%s',slow_request.latency,slow_request.rows,slow_request.url)
+        return summary
                               
                               
         
         
-    def extract_data_db(self,dx_descriptor,pe_start_date,pe_end_date,frequency,ou_descriptor,coc_default_name="default",silent=False,expand_coc=True,current_usage=True):
+    def extract_data_incremental(self,store_dir,dx_descriptor,pe_start_date,pe_end_date,frequency,ou_descriptor,
+                                 volatile_periods=3,return_unresolved=False,**extract_kwargs):
+        """extract_data backed by a local store of the values already extracted,
+        partitioned by dx_descriptor item (DE, DE.COC or indicator) and period.
+        
+        Only the periods missing from the store for an item, and the last 
+        volatile_periods of the range (still open to late reporting), are 
+        requested. The answers replace their partitions in the store and the 
+        whole range is returned from it. A store is kept per host and 
+        ou_descriptor under store_dir.
+        
+        The partitions of the items of a DE with unresolved batches are not
+        written, they are requested again by the next run. With 
+        return_unresolved, (values,unresolved) is returned, unresolved mapping
+        these items to their periods not extracted.
+        """
+        value_store=PartitionedValueStore(os.path.join(store_dir,BatchSpool.batch_key(self._host_key(),ou_descriptor)))
+        periods=list(Periods.split([pe_start_date,pe_end_date],frequency))
+        volatile=set(periods[-volatile_periods:]) if volatile_periods else set()
+        
+        dx_uids=list(dict.fromkeys([str(dx) for dx_items in dx_descriptor.values() for dx in dx_items]))
+        
+        #Items missing the same periods are extracted together
+        dx_groups={}
+        for dx in dx_uids:
+            stored_periods=value_store.stored_periods(dx)
+            missing_periods=tuple(pe for pe in periods if pe not in stored_periods or pe in volatile)
+            if missing_periods:
+                dx_groups.setdefault(missing_periods,[]).append(dx)
+        
+        partitions_fetched=sum(len(missing_periods)*len(group_dx_uids) for missing_periods,group_dx_uids in dx_groups.items())
+        logger.info('Incremental extraction: %s of %s DX x period partitions to fetch',partitions_fetched,len(periods)*len(dx_uids))
+        
+        unresolved={}
+        for missing_periods,group_dx_uids in dx_groups.items():
+            group_dx_descriptor={key:[dx for dx in dx_items if str(dx) in group_dx_uids]
+                                 for key,dx_items in dx_descriptor.items()}
+            group_dx_descriptor={key:dx_items for key,dx_items in group_dx_descriptor.items() if dx_items}
+            analyticsData_df,group_unresolved=self.extract_data(group_dx_descriptor,missing_periods[0],missing_periods[-1],frequency,
+                                                                ou_descriptor.copy(),periods=missing_periods,return_unresolved=True,
+                                                                **extract_kwargs)
+            resolved_dx_uids=group_dx_uids
+            if group_unresolved is not None:
+                #Any OU of a DE failing leaves its items out, an empty partition would be taken as extracted
+                unresolved_de_uids={str(dx).split('.')[0] for dx_items in group_unresolved[0].values() for dx in dx_items}
+                resolved_dx_uids=[dx for dx in group_dx_uids if dx.split('.')[0] not in unresolved_de_uids]
+                unresolved.update({dx:list(missing_periods) for dx in group_dx_uids if dx.split('.')[0] in unresolved_de_uids})
+            value_store.write(analyticsData_df,resolved_dx_uids,missing_periods)
+        
+        if unresolved:
+            logger.error('Incremental extraction: %s DX items with unresolved batches left out of the store: %s',
+                         len(unresolved),sorted(unresolved))
+        if return_unresolved:
+            return value_store.read(dx_uids,periods),unresolved or None
+        return value_store.read(dx_uids,periods)
+        
+    def extract_data_db(self,dx_descriptor,pe_start_date,pe_end_date,frequency,ou_descriptor,coc_default_name="default",silent=False,expand_coc=True,current_usage=True,
+                        bulk=False,de_batch_size=50,ou_batch_size=100,children=False,return_unresolved=False):
+        #With bulk and return_unresolved, (values,unresolved) is returned, unresolved 
+        #being None or the (dx_descriptor,ou_descriptor) of the calls that kept failing
+        if return_unresolved and not bulk:
+            raise ValueError('return_unresolved is only available with bulk=True')
         path="dataValues.json"
         periods=Periods.split([pe_start_date,pe_end_date],frequency)
         
@@ -428,6 +784,23 @@ class Dhis2Client(object):
         ous=ou_descriptor['OU']
         de_list=dx_descriptor['DX']
         
+        metrics_start=self.metrics.emitted
+        if bulk:
+            logger.info('-- Start requests--')
+            t_start=time.time()
+            database_Data_df,unresolved=self._db_extract_bulk_query_composer(de_list,periods,ous,
+                                                                             coc_default_name=coc_default_name,
+                                                                             de_batch_size=de_batch_size,
+                                                                             ou_batch_size=ou_batch_size,
+                                                                             children=children,silent=silent)
+            logger.info('-- End of requests--')
+            t_end=time.time()
+            logger.info('Total time: %s min',round((t_end-t_start)/60,2))
+            self._metrics_report(metrics_start)
+            if return_unresolved:
+                return database_Data_df,unresolved
+            return database_Data_df
+        
         if self.optional_prefix:
             url_db_base = self.baseurl+self.optional_prefix+"/api/"+path
         else:
@@ -436,25 +809,26 @@ class Dhis2Client(object):
         database_Data_df=[]
         de_list_len=len(de_list)
         de_index=1
-        print('-- Start requests--',datetime.datetime.now())
+        logger.info('-- Start requests--')
         t_start=time.time()
         for de in de_list:
-            print(f'{de} requested {de_index}/{de_list_len} of DE list')
+            logger.info('%s requested %s/%s of DE list',de,de_index,de_list_len)
             de_start=time.time()
             database_Data_df.append(self._db_extract_de_query_subcomposer(url_db_base,de,periods,ous,silent=silent))
             de_end=time.time()
             de_index +=1
-            print('Batch query took:',round((de_end-de_start)/60,2),'min')
+            logger.info('Batch query took: %s min',round((de_end-de_start)/60,2))
             
         if not database_Data_df:
-            print("No Data in DB for any combination")
+            logger.warning("No Data in DB for any combination")
             database_Data_df=pd.DataFrame(columns=['DE_UID','PERIOD','OU_UID','VALUE','COC_UID'])
         else:
             database_Data_df=pd.concat(database_Data_df,ignore_index=True)
 
-        print('-- End of requests--',datetime.datetime.now())
+        logger.info('-- End of requests--')
         t_end=time.time()
-        print('Total time:',round((t_end-t_start)/60,2),'min')
+        logger.info('Total time: %s min',round((t_end-t_start)/60,2))
+        self._metrics_report(metrics_start)
         return database_Data_df
             
     def post_data_aggregate(self,df,endpoint="dataValues",data_label='VALUE',postDataset=True):
@@ -466,7 +840,7 @@ class Dhis2Client(object):
         
         postAnswers=[]
         for http in http_list:
-            postAnswers.append([http['period'],http['orgUnit'],self.session.post(endpoint,json=http)])
+            postAnswers.append([http['period'],http['orgUnit'],self.executor.post(endpoint,json=http)])
         return postAnswers
     
     def _ou_composer_feed(self,ou_descriptor):
@@ -481,6 +855,8 @@ class Dhis2Client(object):
 
                 else:
                     return 'ou:'+ou_descriptor['OU'][0]
+            if key.startswith('LEVEL-'):
+                return 'ou:'+';'.join(ou_descriptor[key])+';'+key
                 
     def _dx_composer_feed(self,dx_descriptor):
         for key in dx_descriptor.keys():
@@ -492,8 +868,11 @@ class Dhis2Client(object):
                 else:
                     return 'dx:'+dx_descriptor['DX'][0]
                 
-    def _pe_composer_feed(self,pe_start_date,pe_end_date,frequency):
-        pe_list=Periods.split([pe_start_date,pe_end_date],frequency)
+    def _pe_composer_feed(self,pe_start_date,pe_end_date,frequency,periods=None):
+        if periods:
+            pe_list=periods
+        else:
+            pe_list=Periods.split([pe_start_date,pe_end_date],frequency)
         if len(pe_list)>1:
             return 'pe:'+';'.join(pe_list)
         else:
@@ -511,58 +890,101 @@ class Dhis2Client(object):
             de_uid_splitted=de_uid_splitted.rename(columns={0:'DE_UID',1:'COC_UID'})
             de_uid_splitted['COC_UID']=de_uid_splitted['COC_UID'].fillna(coc_default_uid)
         else:
-            print('No Data')
-            pass
+            logger.debug('No Data')
         df=pd.concat([df.drop('DE_UID',axis=1),de_uid_splitted],axis=1)
                      
         return df
     
         
 
+    def _analytics_stream_to_df(self,resp,coc_default_uid,chunk_size=65536):
+        #The rows are decoded one by one while the body is read, straight into
+        #column buffers with the DE.COC split done on ingestion, so the decoded 
+        #json and the intermediate frames are never held in memory
+        decoder=json.JSONDecoder()
+        data_columns={'OU_UID':[],'PERIOD':[],'VALUE':[],'DE_UID':[],'COC_UID':[]}
+        
+        if resp.encoding is None:
+            resp.encoding='utf-8'
+        chunks=resp.iter_content(chunk_size=chunk_size,decode_unicode=True)
+        try:
+            buffer=''
+            rows_match=None
+            for chunk in chunks:
+                buffer=buffer+chunk
+                rows_match=ANALYTICS_ROWS_KEY.search(buffer)
+                if rows_match:
+                    break
+                #The key could be split between two chunks
+                buffer=buffer[-32:]
+            if not rows_match:
+                raise KeyError('rows')
+            
+            buffer=buffer[rows_match.end():]
+            position=0
+            while True:
+                while position<len(buffer) and buffer[position] in ' \t\r\n,':
+                    position +=1
+                if position<len(buffer):
+                    if buffer[position]==']':
+                        break
+                    try:
+                        row,position=decoder.raw_decode(buffer,position)
+                    except ValueError:
+                        #Incomplete row, we need the next chunk
+                        pass
+                    else:
+                        de_coc=row[0].split('.',1)
+                        data_columns['DE_UID'].append(de_coc[0])
+                        data_columns['COC_UID'].append(de_coc[1] if len(de_coc)>1 else coc_default_uid)
+                        data_columns['OU_UID'].append(row[1])
+                        data_columns['PERIOD'].append(row[2])
+                        data_columns['VALUE'].append(row[3])
+                        continue
+                chunk=next(chunks,None)
+                if chunk is None:
+                    raise ValueError('Truncated analytics answer')
+                buffer=buffer[position:]+chunk
+                position=0
+        finally:
+            resp.close()
+        
+        return pd.DataFrame(data_columns)
+    
     ##################  AUXILIAR FUNCTIONS  ########################
 
     def _data_elements_json_to_df(self,df):
-        df_list=[]
+        de_builder=ColumnarFrameBuilder(['DE_UID','DE_NAME','CC_UID','DS_UID','DOMAIN'])
         for de in df:
-            cc_default=[None]
-            de_name=[None]
-            domain=[None]
-            de_uid=[de['id']]
+            cc_default=None
+            de_name=None
+            domain=None
+            de_uid=de['id']
             if 'domainType' in de.keys():
-                domain=[de['domainType']]
+                domain=de['domainType']
             if 'name' in de.keys():
-                de_name=[de['name']]
+                de_name=de['name']
             if 'categoryCombo' in de.keys():
                 if de['categoryCombo']:
-                    cc_default=[de['categoryCombo']['id']]
-            if 'dataSetElements' in de.keys():
-                if de['dataSetElements']:
-                    for ds_de in de['dataSetElements']:
-                        if 'categoryCombo' in ds_de.keys():
-                            df_list.append(pd.DataFrame({'DE_UID':de_uid,
-                                                         'DE_NAME':de_name,
-                                                         'CC_UID':[ds_de['categoryCombo']['id']],
-                                                         'DS_UID':[ds_de['dataSet']['id']],
-                                                         'DOMAIN':domain}))
-                        else:
-                            df_list.append(pd.DataFrame({'DE_UID':de_uid,
-                                                         'DE_NAME':de_name,
-                                                         'CC_UID':cc_default,
-                                                         'DS_UID':[ds_de['dataSet']['id']],
-                                                         'DOMAIN':domain}))
-                else:
-                    df_list.append(pd.DataFrame({'DE_UID':de_uid,
-                                                 'DE_NAME':de_name,
-                                                 'CC_UID':cc_default,
-                                                 'DS_UID':[None],
-                                                 'DOMAIN':domain}))
+                    cc_default=de['categoryCombo']['id']
+            if 'dataSetElements' in de.keys() and de['dataSetElements']:
+                for ds_de in de['dataSetElements']:
+                    if 'categoryCombo' in ds_de.keys():
+                        cc_uid=ds_de['categoryCombo']['id']
+                    else:
+                        cc_uid=cc_default
+                    de_builder.append({'DE_UID':de_uid,
+                                       'DE_NAME':de_name,
+                                       'CC_UID':cc_uid,
+                                       'DS_UID':ds_de['dataSet']['id'],
+                                       'DOMAIN':domain})
             else:
-                df_list.append(pd.DataFrame({'DE_UID':de_uid,
-                                             'DE_NAME':de_name,
-                                             'CC_UID':cc_default,
-                                             'DS_UID':[None],
-                                             'DOMAIN':domain}))
-        return pd.concat(df_list,ignore_index=True)
+                de_builder.append({'DE_UID':de_uid,
+                                   'DE_NAME':de_name,
+                                   'CC_UID':cc_default,
+                                   'DS_UID':None,
+                                   'DOMAIN':domain})
+        return de_builder.to_frame()
     
     def _num_den_text_processator(self,text,coc_default_uid):
         from functools import partial
@@ -605,129 +1027,122 @@ class Dhis2Client(object):
         return united_df.assign(IND_UID=ind_uid).assign(IND_NAME=ind_name)
     
     def _datasets_json_to_df(self,df):
-        df_list_ou=[]
-        df_list_de=[]  
+        ou_builder=ColumnarFrameBuilder(['DS_UID','DS_NAME','OU_UID','FREQUENCY'])
+        de_builder=ColumnarFrameBuilder(['DS_UID','DS_NAME','DE_UID','FREQUENCY'])
         for ds in df:
-            ou=[None]
-            ds_name=[None]
-            ds_uid=[ds['id']]
-            frequency=[None]
+            ds_name=None
+            ds_uid=ds['id']
+            frequency=None
             if 'periodType' in ds.keys():
-                frequency=[ds['periodType']]
+                frequency=ds['periodType']
             if 'name' in ds.keys():
-                ds_name=[ds['name']]
+                ds_name=ds['name']
             if 'organisationUnits' in ds.keys():
                 if ds['organisationUnits']:
                     for ou in ds['organisationUnits']:
-                        df_list_ou.append(pd.DataFrame({'DS_UID':ds_uid,'DS_NAME':ds_name,'OU_UID':[ou['id']],'FREQUENCY':frequency}))
+                        ou_builder.append({'DS_UID':ds_uid,'DS_NAME':ds_name,'OU_UID':ou['id'],'FREQUENCY':frequency})
             else:
-                df_list_ou.append(pd.DataFrame({'DS_UID':ds_uid,'DS_NAME':ds_name,'OU_UID':[None],'FREQUENCY':frequency}))
+                ou_builder.append({'DS_UID':ds_uid,'DS_NAME':ds_name,'OU_UID':None,'FREQUENCY':frequency})
             if 'dataSetElements' in ds.keys():
                 if ds['dataSetElements']:
                     for ds_de in ds['dataSetElements']:
-                        df_list_de.append(pd.DataFrame({'DS_UID':ds_uid,'DS_NAME':ds_name,'DE_UID':[ds_de['dataElement']['id']],'FREQUENCY':frequency}))
+                        de_builder.append({'DS_UID':ds_uid,'DS_NAME':ds_name,'DE_UID':ds_de['dataElement']['id'],'FREQUENCY':frequency})
             else:
-                df_list_de.append(pd.DataFrame({'DS_UID':ds_uid,'DS_NAME':ds_name,'DE_UID':[None],'FREQUENCY':frequency}))
+                de_builder.append({'DS_UID':ds_uid,'DS_NAME':ds_name,'DE_UID':None,'FREQUENCY':frequency})
         
-        return {"dataSetsStructure_dataElements":pd.concat(df_list_de,ignore_index=True),"dataSetsStructure_organisationUnits":pd.concat(df_list_ou,ignore_index=True)}
+        return {"dataSetsStructure_dataElements":de_builder.to_frame(),"dataSetsStructure_organisationUnits":ou_builder.to_frame()}
 
     def _cocs_json_to_df(self,df):
-        coc_df_list=[]
+        coc_builder=ColumnarFrameBuilder(['COC_UID','COC_NAME','CC_UID'])
         for coc in df:
-            cc=[None]
-            coc_name=[None]
-            coc_uid=[coc['id']]
+            cc=None
+            coc_name=None
+            coc_uid=coc['id']
             if 'name' in coc.keys():
-                coc_name=[coc['name']]
+                coc_name=coc['name']
             if 'categoryCombo' in coc.keys():
                 if coc['categoryCombo']:
-                    cc=[coc['categoryCombo']['id']]
+                    cc=coc['categoryCombo']['id']
 
-            coc_df_list.append(pd.DataFrame({'COC_UID':coc_uid,'COC_NAME':coc_name,'CC_UID':cc}))
+            coc_builder.append({'COC_UID':coc_uid,'COC_NAME':coc_name,'CC_UID':cc})
 
-
-        return pd.concat(coc_df_list,ignore_index=True)
-    
-    def _cc_uid_json_to_df(self,cc_json):
-        cc_coc_df_list=[]
-        cc_uid=[None]
-        coc_uid=[None]
-        if 'id' in cc_json.keys():
-            cc_uid=[cc_json['id']]
-        if 'categoryOptionCombos' in cc_json.keys():
-            for coc_option in cc_json['categoryOptionCombos']:
-                coc_uid=[coc_option['id']]
-                cc_coc_df_list.append(pd.DataFrame({'COC_UID':coc_uid,'CC_UID':cc_uid}))
-            
-        else:
-            cc_coc_df_list.append(pd.DataFrame({'COC_UID':coc_uid,'CC_UID':cc_uid}))
+        return coc_builder.to_frame()
+    
+    def _ccs_json_to_df(self,df):
+        cc_coc_uids=[]
+        for cc in df:
+            cc_uid=None
+            if 'id' in cc.keys():
+                cc_uid=cc['id']
+            if 'categoryOptionCombos' in cc.keys():
+                for coc_option in cc['categoryOptionCombos']:
+                    cc_coc_uids.append((coc_option['id'],cc_uid))
+            else:
+                cc_coc_uids.append((None,cc_uid))
             
-        return pd.concat(cc_coc_df_list,ignore_index=True)
+        return pd.DataFrame.from_records(cc_coc_uids,columns=['COC_UID','CC_UID'])
     
     
     def _deg_json_to_df(self,df):
-        deg_df_list=[]
+        deg_builder=ColumnarFrameBuilder(['DEG_UID','DEG_NAME','DE_UID','DE_NAME'])
         for deg in df:
-            deg_name=[None]
-            deg_uid=[deg['id']]
+            deg_name=None
+            deg_uid=deg['id']
             if 'name' in deg.keys():
-                deg_name=[deg['name']]
+                deg_name=deg['name']
             if 'dataElements' in deg.keys():
                 if deg['dataElements']:
-                    for deg_de in deg['dataElements']:
-                        deg_df_list.append(pd.DataFrame({'DEG_UID':deg_uid,'DEG_NAME':deg_name,'DE_UID':[deg_de['id']],'DE_NAME':[deg_de['name']]}))
+                    for deg_item in deg['dataElements']:
+                        deg_builder.append({'DEG_UID':deg_uid,'DEG_NAME':deg_name,'DE_UID':deg_item['id'],'DE_NAME':deg_item['name']})
             else:
-                deg_df_list.append(pd.DataFrame({'DEG_UID':deg_uid,'DEG_NAME':deg_name,'DE_UID':[None],'DE_NAME':[None]}))
+                deg_builder.append({'DEG_UID':deg_uid,'DEG_NAME':deg_name,'DE_UID':None,'DE_NAME':None})
 
-
-        return pd.concat(deg_df_list,ignore_index=True)
+        return deg_builder.to_frame()
     
     
     def _indg_json_to_df(self,df):
-        indg_df_list=[]
+        indg_builder=ColumnarFrameBuilder(['INDG_UID','INDG_NAME','IND_UID','IND_NAME'])
         for indg in df:
-            indg_name=[None]
-            indg_uid=[indg['id']]
+            indg_name=None
+            indg_uid=indg['id']
             if 'name' in indg.keys():
-                indg_name=[indg['name']]
+                indg_name=indg['name']
             if 'indicators' in indg.keys():
                 if indg['indicators']:
-                    for indg_ind in indg['indicators']:
-                        indg_df_list.append(pd.DataFrame({'INDG_UID':indg_uid,'INDG_NAME':indg_name,'IND_UID':[indg_ind['id']],'IND_NAME':[indg_ind['name']]}))
+                    for indg_item in indg['indicators']:
+                        indg_builder.append({'INDG_UID':indg_uid,'INDG_NAME':indg_name,'IND_UID':indg_item['id'],'IND_NAME':indg_item['name']})
             else:
-                indg_df_list.append(pd.DataFrame({'INDG_UID':indg_uid,'INDG_NAME':indg_name,'IND_UID':[None],'IND_NAME':[None]}))
-
+                indg_builder.append({'INDG_UID':indg_uid,'INDG_NAME':indg_name,'IND_UID':None,'IND_NAME':None})
 
-        return pd.concat(indg_df_list,ignore_index=True)
+        return indg_builder.to_frame()
     
     
     def _oug_json_to_df(self,df):
-        oug_df_list=[]
+        oug_builder=ColumnarFrameBuilder(['OUG_UID','OUG_NAME','OU_UID','OU_NAME'])
         for oug in df:
-            oug_name=[None]
-            oug_uid=[oug['id']]
+            oug_name=None
+            oug_uid=oug['id']
             if 'name' in oug.keys():
-                oug_name=[oug['name']]
+                oug_name=oug['name']
             if 'organisationUnits' in oug.keys():
                 if oug['organisationUnits']:
-                    for oug_ou in oug['organisationUnits']:
-                        oug_df_list.append(pd.DataFrame({'OUG_UID':oug_uid,'OUG_NAME':oug_name,'OU_UID':[oug_ou['id']],'OU_NAME':[oug_ou['name']]}))
+                    for oug_item in oug['organisationUnits']:
+                        oug_builder.append({'OUG_UID':oug_uid,'OUG_NAME':oug_name,'OU_UID':oug_item['id'],'OU_NAME':oug_item['name']})
             else:
-                oug_df_list.append(pd.DataFrame({'OUG_UID':oug_uid,'OUG_NAME':oug_name,'OU_UID':[None],'OU_NAME':[None]}))
+                oug_builder.append({'OUG_UID':oug_uid,'OUG_NAME':oug_name,'OU_UID':None,'OU_NAME':None})
 
-
-        return pd.concat(oug_df_list,ignore_index=True)
+        return oug_builder.to_frame()
+    
     
-
     def _outree_json_to_df(self,df):
-        ou_df_list=[]
+        ou_builder=ColumnarFrameBuilder(['OU_UID','OU_NAME'])
         for ou in df:
-            ou_level=[None]
-            ou_name=[None]
-            ou_uid=[ou['id']]
+            ou_level=None
+            ou_name=None
+            ou_uid=ou['id']
             ancestors_list=[]
             if 'name' in ou.keys():
-                ou_name=[ou['name']]
+                ou_name=ou['name']
             ou_dict={'OU_UID':ou_uid,
                      'OU_NAME':ou_name}
             
@@ -737,8 +1152,8 @@ class Dhis2Client(object):
                     for ancestor_lvl in range(0,len(ancestors_list)):
                         ancestor_dict=ancestors_list[ancestor_lvl]
                         ou_dict.update({
-                                       'LEVEL_'+str(ancestor_lvl+1)+'_UID':[ancestor_dict['id']],
-                                       'LEVEL_'+str(ancestor_lvl+1)+'_NAME':[ancestor_dict['name']]
+                                       'LEVEL_'+str(ancestor_lvl+1)+'_UID':ancestor_dict['id'],
+                                       'LEVEL_'+str(ancestor_lvl+1)+'_NAME':ancestor_dict['name']
                                       })
             
             if (('level' in ou.keys()) or (ancestors_list)):
@@ -748,15 +1163,14 @@ class Dhis2Client(object):
                     ou_level=len(ancestors_list)+1
                     
                 ou_dict.update({
-                                'LEVEL':[ou_level],
+                                'LEVEL':ou_level,
                                 'LEVEL_'+str(ou_level)+'_UID':ou_uid,
                                 'LEVEL_'+str(ou_level)+'_NAME':ou_name
                                })
                 
-            ou_df_list.append(pd.DataFrame(ou_dict))
-
+            ou_builder.append(ou_dict)
 
-        return pd.concat(ou_df_list,ignore_index=True)
+        return ou_builder.to_frame()
 
     def _program_tei_json_to_df(self,json):
     
@@ -919,8 +1333,9 @@ class Dhis2Client(object):
                 existing_keys.append(b_key)
                 full_build_batch[b_key]=list(batch[b_key])
         
+        #Sorted, so the batches of a resumed run hash to the same spool keys
         for key,item in full_build_batch.items():
-            full_build_batch[key]=list(set(item))
+            full_build_batch[key]=sorted(set(item))
         return full_build_batch
     
     def _max_len_descriptor_estimator(self,descriptor):
@@ -964,12 +1379,14 @@ class Dhis2Client(object):
     
     def _query_caller_manager(self,url_analytics_base,formula_key,
                               dx_batchted_descriptors,ou_batchted_descriptors,
-                              time_descriptor,coc_default_uid,silent=False):
+                              time_descriptor,coc_default_uid,silent=False,max_workers=None,streaming=False,
+                              pe_batchted_descriptors=None,batch_spool=None):
         analyticsData_df_list=[]
         dx_uncalled_batchs=[]
         ou_uncalled_batchs=[]
-        batch_index=1
-        total_queries=len(dx_batchted_descriptors)*len(ou_batchted_descriptors)
+        if not pe_batchted_descriptors:
+            pe_batchted_descriptors=[time_descriptor]
+        total_queries=len(dx_batchted_descriptors)*len(ou_batchted_descriptors)*len(pe_batchted_descriptors)
         
         if total_queries<=30:
             printing_batching_denominator=1
@@ -986,44 +1403,252 @@ class Dhis2Client(object):
         else:
             printedText="Call processing"
         
-        for dx_batch_descriptor in dx_batchted_descriptors:
-            for ou_batch_descriptor in ou_batchted_descriptors:
+        batch_jobs=[(dx_batch_descriptor,ou_batch_descriptor,pe_batch_descriptor) 
+                    for dx_batch_descriptor in dx_batchted_descriptors 
+                    for ou_batch_descriptor in ou_batchted_descriptors
+                    for pe_batch_descriptor in pe_batchted_descriptors]
+        url_queries=[self._formula_query_text_maker(url_analytics_base,formula_key,
+                                                    dx_batch_descriptor,ou_batch_descriptor,pe_batch_descriptor)
+                     for dx_batch_descriptor,ou_batch_descriptor,pe_batch_descriptor in batch_jobs]
+        batch_descriptors=[[self._host_key(),coc_default_uid,dx_batch_descriptor,ou_batch_descriptor,pe_batch_descriptor]
+                           for dx_batch_descriptor,ou_batch_descriptor,pe_batch_descriptor in batch_jobs]
+        if batch_spool is not None:
+            batch_keys=[batch_spool.batch_key(*batch_descriptor) for batch_descriptor in batch_descriptors]
+        else:
+            batch_keys=[None]*len(batch_jobs)
+        def batch_caller(url_query,batch_key,batch_descriptor):
+            return self._analytics_batch_caller(url_query,coc_default_uid,batch_key=batch_key,silent=silent,
+                                                streaming=streaming,batch_spool=batch_spool,
+                                                batch_descriptors=batch_descriptor)
+        
+        #With max_workers the calls go through a bounded pool of threads, so at 
+        #most max_workers requests are in flight. Answers are consumed in submission
+        #order, the resulting DataFrame is the same as the sequential one
+        if max_workers and max_workers>1 and total_queries>1:
+            executor=ThreadPoolExecutor(max_workers=max_workers)
+            batch_answers=executor.map(batch_caller,url_queries,batch_keys,batch_descriptors)
+        else:
+            executor=None
+            batch_answers=map(batch_caller,url_queries,batch_keys,batch_descriptors)
+        
+        try:
+            for batch_index,(batch_job,batch_answer) in enumerate(zip(batch_jobs,batch_answers),start=1):
+                dx_batch_descriptor,ou_batch_descriptor,pe_batch_descriptor=batch_job
+                batch_called,analyticsData_batch_df=batch_answer
                 
                 if batch_index % printing_batching_denominator == 0:
-                    print(printedText, f' : {batch_index}/{total_queries}')
+                    logger.info('%s : %s/%s',printedText,batch_index,total_queries)
                 
-                url_query=self._formula_query_text_maker(url_analytics_base,formula_key,
-                                                         dx_batch_descriptor,ou_batch_descriptor,time_descriptor)
-                batch_index +=1
-
-                try:
-                    resp_analytics = self.session.get(url_query)
-                    if not silent:
-                        print(resp_analytics.request.path_url)
-                    analyticsData_batch=resp_analytics.json()['rows']
-                except (ValueError, KeyError):
-                    
+                if not batch_called:
                     #We save the failed calls to be recycle in new future calls with smaller batches 
                     dx_uncalled_batchs.append(dx_batch_descriptor)
                     ou_uncalled_batchs.append(ou_batch_descriptor)
+                elif analyticsData_batch_df is None:
+                    logger.debug("No Data in DB for: dx=%s ou=%s",dx_batch_descriptor,ou_batch_descriptor)
                 else:
-                    if not analyticsData_batch:
-                        print( "No Data in DB for:",dx_batch_descriptor,ou_batch_descriptor)
-                        pass 
-                    else:
-                        analyticsData_df_list.append(
-                                                     self._analytics_json_to_df(analyticsData_batch,
-                                                                                coc_default_uid=coc_default_uid)
-                                                     )
+                    analyticsData_df_list.append(analyticsData_batch_df)
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
 
         return dx_uncalled_batchs,ou_uncalled_batchs,analyticsData_df_list
+    
+    def _adaptive_query_caller_manager(self,url_analytics_base,formula_key,
+                                       dx_descriptor,ou_descriptor,
+                                       time_descriptor,coc_default_uid,batch_controller,
+                                       silent=False,streaming=False,max_workers=None,
+                                       pe_batchted_descriptors=None,max_url_bytes=None,batch_spool=None):
+        #Blocks of the dx x ou grid of each period batch still to extract. Each 
+        #request is cut from the corner of a block with the current controller 
+        #sizes, reduced until its url fits max_url_bytes, and the rest of the block
+        #is queued back; a failed request is queued back whole to be cut again 
+        #with the reduced sizes. With max_workers, rounds of max_workers requests
+        #are cut with the same sizes and sent together. Single dx x ou requests
+        #failing get one more cycle once the rest of the grid is done. 
+        #Cells found in batch_spool are not requested again.
+        analyticsData_df_list=[]
+        dx_uncalled_batchs=[]
+        ou_uncalled_batchs=[]
+        if not pe_batchted_descriptors:
+            pe_batchted_descriptors=[time_descriptor]
+        pending_blocks=[]
+        for pe_batch_descriptor in pe_batchted_descriptors:
+            done_cells=set()
+            if batch_spool is not None:
+                done_cells=self._spooled_cells(batch_spool,coc_default_uid,dx_descriptor,ou_descriptor,
+                                               pe_batch_descriptor,analyticsData_df_list)
+            for dx_key,dx_items in dx_descriptor.items():
+                for ou_key,ou_items in ou_descriptor.items():
+                    #dx items missing the same ous make a block
+                    remaining_blocks={}
+                    for dx in dx_items:
+                        remaining_ous=tuple(ou for ou in ou_items if (dx_key,dx,ou_key,ou) not in done_cells)
+                        if remaining_ous:
+                            remaining_blocks.setdefault(remaining_ous,[]).append(dx)
+                    pending_blocks.extend([(dx_key,block_dx_items,ou_key,list(remaining_ous),pe_batch_descriptor)
+                                           for remaining_ous,block_dx_items in remaining_blocks.items()])
+        if batch_spool is not None and analyticsData_df_list:
+            logger.info('%s batches restored from the checkpoint',len(analyticsData_df_list))
+        
+        def request_cutter():
+            dx_key,dx_items,ou_key,ou_items,pe_batch_descriptor=pending_blocks.pop()
+            dx_size=min(batch_controller.dx_batch_size,len(dx_items))
+            ou_size=min(batch_controller.ou_batch_size,len(ou_items))
+            while True:
+                url_query=self._formula_query_text_maker(url_analytics_base,formula_key,{dx_key:dx_items[:dx_size]},
+                                                         {ou_key:ou_items[:ou_size]},pe_batch_descriptor)
+                if not max_url_bytes or len(url_query.encode('utf-8'))<=max_url_bytes or dx_size*ou_size==1:
+                    break
+                if dx_size>ou_size:
+                    dx_size=(dx_size+1)//2
+                else:
+                    ou_size=(ou_size+1)//2
+            if ou_items[ou_size:]:
+                pending_blocks.append((dx_key,dx_items[:dx_size],ou_key,ou_items[ou_size:],pe_batch_descriptor))
+            if dx_items[dx_size:]:
+                pending_blocks.append((dx_key,dx_items[dx_size:],ou_key,ou_items,pe_batch_descriptor))
+            return (dx_key,dx_items[:dx_size],ou_key,ou_items[:ou_size],pe_batch_descriptor),url_query
+        
+        def batch_caller(batch_job):
+            (dx_key,dx_items,ou_key,ou_items,pe_batch_descriptor),url_query=batch_job
+            batch_descriptors=[self._host_key(),coc_default_uid,{dx_key:dx_items},{ou_key:ou_items},pe_batch_descriptor]
+            batch_key=batch_spool.batch_key(*batch_descriptors) if batch_spool is not None else None
+            t_batch_start=time.time()
+            batch_called,analyticsData_batch_df=self._analytics_batch_caller(url_query,coc_default_uid,batch_key=batch_key,
+                                                                             silent=silent,streaming=streaming,
+                                                                             batch_spool=batch_spool,
+                                                                             batch_descriptors=batch_descriptors)
+            return batch_called,analyticsData_batch_df,time.time()-t_batch_start
+        
+        round_size=max_workers if max_workers and max_workers>1 else 1
+        executor=ThreadPoolExecutor(max_workers=round_size) if round_size>1 else None
+        retry_blocks=[]
+        last_cycle=False
+        batch_index=1
+        try:
+            while pending_blocks or retry_blocks:
+                if not pending_blocks:
+                    logger.info('Last cycle for %s failed single calls',len(retry_blocks))
+                    pending_blocks,retry_blocks=retry_blocks,[]
+                    last_cycle=True
+                batch_jobs=[]
+                while pending_blocks and len(batch_jobs)<round_size:
+                    batch_jobs.append(request_cutter())
+                batch_answers=executor.map(batch_caller,batch_jobs) if executor else map(batch_caller,batch_jobs)
+                
+                for (batch_block,_),(batch_called,analyticsData_batch_df,batch_seconds) in zip(batch_jobs,batch_answers):
+                    dx_key,dx_items,ou_key,ou_items,_=batch_block
+                    dx_size=len(dx_items)
+                    ou_size=len(ou_items)
+                    if not batch_called:
+                        batch_controller.observe(dx_size,ou_size,batch_seconds,failed=True)
+                        if dx_size==1 and ou_size==1:
+                            if last_cycle:
+                                dx_uncalled_batchs.append({dx_key:dx_items})
+                                ou_uncalled_batchs.append({ou_key:ou_items})
+                            else:
+                                retry_blocks.append(batch_block)
+                        else:
+                            pending_blocks.append(batch_block)
+                            logger.warning('Failed call, new dx_batch_size=%s ou_batch_size=%s',
+                                           batch_controller.dx_batch_size,batch_controller.ou_batch_size)
+                        continue
+                    
+                    batch_rows=0
+                    if analyticsData_batch_df is None:
+                        logger.debug("No Data in DB for: dx=%s ou=%s",{dx_key:dx_items},{ou_key:ou_items})
+                    else:
+                        batch_rows=analyticsData_batch_df.shape[0]
+                        analyticsData_df_list.append(analyticsData_batch_df)
+                    batch_controller.observe(dx_size,ou_size,batch_seconds,rows=batch_rows)
+                    
+                    if batch_index % 10 == 0:
+                        logger.info('Batch processing : %s done, %s blocks pending, dx_batch_size=%s ou_batch_size=%s',
+                                    batch_index,len(pending_blocks),batch_controller.dx_batch_size,batch_controller.ou_batch_size)
+                    batch_index +=1
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
+            
+        return dx_uncalled_batchs,ou_uncalled_batchs,analyticsData_df_list
+    
+    def _spooled_cells(self,batch_spool,coc_default_uid,dx_descriptor,ou_descriptor,pe_batch_descriptor,analyticsData_df_list):
+        #(dx_key,dx,ou_key,ou) cells of the spooled batches of this period batch,
+        #their values appended to analyticsData_df_list. Batches with cells out 
+        #of the descriptors (another run in the same spool) are left aside
+        batch_header=json.loads(json.dumps([self._host_key(),coc_default_uid,pe_batch_descriptor],default=str))
+        requested_cells={(dx_key,dx,ou_key,ou) for dx_key,dx_items in dx_descriptor.items() for dx in dx_items
+                         for ou_key,ou_items in ou_descriptor.items() for ou in ou_items}
+        done_cells=set()
+        for batch_descriptors,analyticsData_batch_df in batch_spool.entries():
+            host_key,batch_coc_default_uid,dx_batch_descriptor,ou_batch_descriptor,batch_pe_descriptor=batch_descriptors
+            if [host_key,batch_coc_default_uid,batch_pe_descriptor]!=batch_header:
+                continue
+            batch_cells={(dx_key,dx,ou_key,ou) for dx_key,dx_items in dx_batch_descriptor.items() for dx in dx_items
+                         for ou_key,ou_items in ou_batch_descriptor.items() for ou in ou_items}
+            if not batch_cells<=requested_cells or batch_cells & done_cells:
+                continue
+            done_cells |=batch_cells
+            if analyticsData_batch_df is not None:
+                analyticsData_df_list.append(analyticsData_batch_df)
+        return done_cells
+    
+    def _analytics_batch_caller(self,url_query,coc_default_uid,batch_key=None,silent=False,streaming=False,batch_spool=None,
+                                batch_descriptors=None):
+        if batch_spool is not None:
+            batch_found,analyticsData_batch_df=batch_spool.load(batch_key)
+            if batch_found:
+                return True,analyticsData_batch_df
+        
+        batch_called,analyticsData_batch_df=self._analytics_batch_request(url_query,coc_default_uid,
+                                                                          silent=silent,streaming=streaming)
+        if batch_called and batch_spool is not None:
+            batch_spool.save(batch_key,analyticsData_batch_df,descriptors=batch_descriptors)
+        return batch_called,analyticsData_batch_df
+    
+    def _analytics_batch_request(self,url_query,coc_default_uid,silent=False,streaming=False):
+        #Returns (called,df): called is False when the batch has to be recycled 
+        #with smaller batches, df is None when no data was found for the batch
+        try:
+            #A batch too slow to answer is split by the next cycle, not sent again
+            resp_analytics = self.executor.get(url_query,stream=streaming,defer_metrics=True,
+                                               retry_read_timeouts=False)
+        except requests.RequestException:
+            return False,None
+        if not silent:
+            logger.debug('%s',resp_analytics.request.path_url)
+        
+        t_parse=time.perf_counter()
+        analyticsData_batch_df=None
+        try:
+            if streaming:
+                analyticsData_batch_df=self._analytics_stream_to_df(resp_analytics,coc_default_uid=coc_default_uid)
+                self.executor.record_stream(resp_analytics)
+                if analyticsData_batch_df.empty:
+                    analyticsData_batch_df=None
+            else:
+                analyticsData_batch=resp_analytics.json()['rows']
+                if analyticsData_batch:
+                    analyticsData_batch_df=self._analytics_json_to_df(analyticsData_batch,coc_default_uid=coc_default_uid)
+            batch_called=True
+        except (ValueError, KeyError, requests.RequestException):
+            batch_called=False
+        
+        metrics_record=getattr(resp_analytics,'metrics_record',None)
+        if metrics_record is not None:
+            metrics_record['parse_seconds']=time.perf_counter()-t_parse
+            if batch_called:
+                metrics_record['rows']=0 if analyticsData_batch_df is None else analyticsData_batch_df.shape[0]
+            self.metrics.emit(metrics_record)
+        return batch_called,analyticsData_batch_df
 
                     
     def _formula_query_text_maker(self,url_analytics_base,formula_key,dx_batch_descriptor,ou_batch_descriptor,time_descriptor):
         if formula_key=="analytics_extract":
             url_analytics =url_analytics_base+'?dimension='+self._dx_composer_feed(dx_batch_descriptor)
             url_analytics =url_analytics+'&dimension='+self._ou_composer_feed(ou_batch_descriptor)
-            url_analytics =url_analytics+'&dimension='+self._pe_composer_feed(time_descriptor['pe_start_date'],time_descriptor['pe_end_date'],time_descriptor['frequency'])
+            url_analytics =url_analytics+'&dimension='+self._pe_composer_feed(time_descriptor['pe_start_date'],time_descriptor['pe_end_date'],time_descriptor['frequency'],
+                                                                              periods=time_descriptor.get('periods'))
         return url_analytics
         
     def _db_extract_de_query_subcomposer(self,url_db_base,de,periods,ous,silent=True):
@@ -1038,16 +1663,16 @@ class Dhis2Client(object):
         for period in periods:
             for ou in ous:
                 if sub_index % 500 == 0:
-                    print(f'------- {sub_index}/{total_sub_len}')
+                    logger.info('------- %s/%s',sub_index,total_sub_len)
                 sub_index +=1
                 url_db =url_db_base+'?de='+de+'&pe='+period+'&ou='+ou
                 if coc:
                     url_db=url_db+'&co='+coc
                 
-                resp_db = self.session.get(url_db)
+                resp_db = self.executor.get(url_db)
                 
                 if not silent:
-                    print(resp_db.request.path_url)
+                    logger.debug('%s',resp_db.request.path_url)
                 try:
                     value_dict={'DE_UID':[de],
                                 'PERIOD':[period],
@@ -1059,7 +1684,7 @@ class Dhis2Client(object):
                 except:
                     pass
         if not database_decycle_Data:
-            print(f"No data has been found for the whole range of metadata in this batch for {de}")
+            logger.warning("No data has been found for the whole range of metadata in this batch for %s",de)
             database_decycle_Data_df=pd.DataFrame(columns=['DE_UID','PERIOD','OU_UID','VALUE','COC_UID'])
         else:
             database_decycle_Data_df=[]
@@ -1068,6 +1693,95 @@ class Dhis2Client(object):
             database_decycle_Data_df=pd.concat(database_decycle_Data_df,ignore_index=True)
         return database_decycle_Data_df
     
+    def _db_extract_bulk_query_composer(self,de_list,periods,ous,coc_default_name="default",
+                                        de_batch_size=50,ou_batch_size=100,children=False,silent=True):
+        #One dataValueSets call per DE batch x OU batch covering all the periods, 
+        #instead of one dataValues call per DE x period x OU. A failed call is 
+        #split in two along its larger batch until single DE x OU calls, which are
+        #returned as unresolved (dx_descriptor,ou_descriptor), None if all answered
+        path="dataValueSets.json"
+        
+        de_coc_requested={}
+        for de in de_list:
+            de_uid=de.split('.')[0]
+            coc=de.split('.')[1] if '.' in de else None
+            de_coc_requested.setdefault(de_uid,[]).append(coc)
+        de_uids=list(de_coc_requested.keys())
+        
+        pending_batches=[(de_uids[i:i+de_batch_size],ous[j:j+ou_batch_size])
+                         for i in range(0,len(de_uids),de_batch_size) for j in range(0,len(ous),ou_batch_size)]
+        dx_uncalled_batchs=[]
+        ou_uncalled_batchs=[]
+        
+        data_columns={'DE_UID':[],'PERIOD':[],'OU_UID':[],'VALUE':[],'COC_UID':[]}
+        batch_index=1
+        while pending_batches:
+            de_batch,ou_batch=pending_batches.pop(0)
+            logger.info('------- %s/%s',batch_index,batch_index+len(pending_batches))
+            batch_index +=1
+            params=[('dataElement',de_uid) for de_uid in de_batch]
+            params.extend([('orgUnit',ou) for ou in ou_batch])
+            params.extend([('period',period) for period in periods])
+            if children:
+                params.append(('children','true'))
+            try:
+                resp=self._get_response(path,params=params,silent=silent)
+                #An error answer is JSON too, without dataValues, it must not pass for no data
+                resp.raise_for_status()
+                dataValues=resp.json().get('dataValues',[])
+            except (ValueError,requests.RequestException) as error:
+                if len(de_batch)==1 and len(ou_batch)==1:
+                    logger.warning("Failed call (%s) for: de=%s ou=%s",error.__class__.__name__,de_batch,ou_batch)
+                    dx_uncalled_batchs.append({'DX':[de for de in de_list if de.split('.')[0]==de_batch[0]]})
+                    ou_uncalled_batchs.append({'OU':ou_batch})
+                elif len(de_batch)>=len(ou_batch):
+                    half=len(de_batch)//2
+                    logger.warning("Failed call (%s), split into DE batches of %s",error.__class__.__name__,half)
+                    pending_batches[0:0]=[(de_batch[:half],ou_batch),(de_batch[half:],ou_batch)]
+                else:
+                    half=len(ou_batch)//2
+                    logger.warning("Failed call (%s), split into OU batches of %s",error.__class__.__name__,half)
+                    pending_batches[0:0]=[(de_batch,ou_batch[:half]),(de_batch,ou_batch[half:])]
+                continue
+            for data_value in dataValues:
+                data_columns['DE_UID'].append(data_value['dataElement'])
+                data_columns['PERIOD'].append(data_value['period'])
+                data_columns['OU_UID'].append(data_value['orgUnit'])
+                data_columns['VALUE'].append(data_value.get('value'))
+                data_columns['COC_UID'].append(data_value.get('categoryOptionCombo'))
+        database_Data_df=pd.DataFrame(data_columns)
+        
+        unresolved=None
+        if dx_uncalled_batchs:
+            unresolved=(self._batch_rebuilder(dx_uncalled_batchs),self._batch_rebuilder(ou_uncalled_batchs))
+            logger.error("Unresolved calls dx=%s ou=%s",unresolved[0],unresolved[1])
+        
+        if database_Data_df.empty:
+            if unresolved is None:
+                logger.warning("No Data in DB for any combination")
+            return pd.DataFrame(columns=['DE_UID','PERIOD','OU_UID','VALUE','COC_UID']),unresolved
+        
+        #Keeping only the requested DE.COC pairs. As in dataValues.json, a DE
+        #without a COC stands for its default COC value and is returned without COC_UID
+        requested_pairs=[(de_uid,coc) for de_uid,cocs in de_coc_requested.items() for coc in cocs if coc]
+        requested_default=[de_uid for de_uid,cocs in de_coc_requested.items() if None in cocs]
+        pairs_filter=pd.MultiIndex.from_frame(database_Data_df[['DE_UID','COC_UID']]).isin(requested_pairs)
+        if requested_default:
+            coc_default_uid=self.fetch_coc_structure().query('COC_NAME=="'+coc_default_name+'"').COC_UID.values[0]
+            default_filter=(database_Data_df.DE_UID.isin(requested_default) & 
+                            (database_Data_df.COC_UID==coc_default_uid))
+            database_Data_df=pd.concat([database_Data_df[pairs_filter],
+                                        database_Data_df[default_filter].assign(COC_UID=np.nan)],
+                                       ignore_index=True)
+        else:
+            database_Data_df=database_Data_df[pairs_filter]
+        
+        database_Data_df=database_Data_df[database_Data_df.PERIOD.isin(periods)]
+        if not children:
+            database_Data_df=database_Data_df[database_Data_df.OU_UID.isin(ous)]
+        
+        return database_Data_df.reset_index(drop=True),unresolved
+    
     def _filter_on_requested_uids(self,dx_list,df):
         indicators_uids=[dx for dx in dx_list if '.' not in dx]
         decoc_uids=[dx for dx in dx_list if '.' in dx]
@@ -1115,7 +1829,7 @@ class Dhis2Client(object):
         events = self.get(event_url)
         num_pages = events["pager"]["pageCount"]
     
-        print(events["pager"])
+        logger.info('pager=%s',events["pager"])
         if fetch_all :
             for page in range(2, num_pages + 1) : 
                 page_url_suffix="&page="+str(page)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Request metrics of Dhis2Client and logging setup of the package.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from .http_executor import redacted_url
+
+
+RECORD_FIELDS=['endpoint','url','status','latency','bytes','retries','rows','parse_seconds','started_at']
+
+
+def configure_logging(level='INFO'):
+    """Send the blsq_dqapp logs to stderr at the given level, for scripts 
+    without a logging configuration of their own. The handler is added once,
+    later calls only change the level; the records still propagate to the
+    application handlers."""
+    package_logger=logging.getLogger('blsq_dqapp')
+    if not package_logger.handlers:
+        handler=logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        package_logger.addHandler(handler)
+    package_logger.setLevel(level)
+    return package_logger
+
+
+class RequestMetrics(object):
+    """Collector of one record per request sent by a Dhis2Client: endpoint,
+    url, status, latency (s), response bytes, retries and, for the answers
+    parsed into data, rows and parse time.
+
+    Each finished record is passed to the hooks, callables taking the record
+    dict, e.g. to push it to a monitoring system. Only the last max_records
+    records are kept for to_frame and summary, so a long lived client does
+    not grow without limit; emitted counts all of them.
+    Parameters
+    ----------
+    hooks: list of callable, optional
+    max_records: int
+    """
+
+    def __init__(self,hooks=None,max_records=100000):
+        self.records=deque(maxlen=max_records)
+        self.emitted=0
+        self.hooks=list(hooks or [])
+        self._lock=threading.Lock()
+
+    def add_hook(self,hook):
+        self.hooks.append(hook)
+
+    def new_record(self,endpoint,url):
+        #Credentials of the url are never kept
+        return {'endpoint':endpoint,'url':redacted_url(url),'status':None,'latency':None,'bytes':None,
+                'retries':0,'rows':None,'parse_seconds':None,'started_at':time.time()}
+
+    def emit(self,record):
+        with self._lock:
+            self.records.append(record)
+            self.emitted +=1
+        for hook in self.hooks:
+            hook(record)
+
+    def to_frame(self,start=0):
+        """Records from the start-th emitted one (emitted before a run gives
+        the records of the run), the ones dropped by max_records left out."""
+        with self._lock:
+            records=list(itertools.islice(self.records,max(start-(self.emitted-len(self.records)),0),None))
+        return pd.DataFrame.from_records(records,columns=RECORD_FIELDS)
+
+    def summary(self,start=0,slowest=5):
+        """Aggregates of the records from the start-th emitted one: latency
+        percentiles, rows/s over the wall time of the requests and the
+        slowest requests. Over the last max_records when more were emitted."""
+        records_df=self.to_frame(start)
+        if records_df.empty:
+            return {'requests':0}
+        latencies=records_df.latency.astype(float).to_numpy()
+        ended_at=(records_df.started_at+records_df.latency).max()
+        wall_seconds=max(ended_at-records_df.started_at.min(),1e-9)
+        rows=records_df.rows.fillna(0).sum()
+        return {'requests':len(records_df),
+                'failed':int((records_df.status.fillna(600)>=400).sum()),
+                'retries':int(records_df.retries.sum()),
+                'latency_p50':float(np.percentile(latencies,50)),
+                'latency_p95':float(np.percentile(latencies,95)),
+                'latency_max':float(latencies.max()),
+                'bytes':int(records_df.bytes.fillna(0).sum()),
+                'rows':int(rows),
+                'parse_seconds':float(records_df.parse_seconds.fillna(0).sum()),
+                'wall_seconds':float(wall_seconds),
+                'rows_per_second':float(rows/wall_seconds),
+                'slowest':records_df.nlargest(slowest,'latency')[['endpoint','url','latency','rows','retries']]}
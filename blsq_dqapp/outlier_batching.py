@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core outlier detection: the values are read from a Parquet or CSV
+file, cut into batches of whole DEs, scored batch by batch and streamed to an
+output file, so only one batch is in memory at a time.
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .input_formatting_tools import de_count_batch_selector
+from .outlier_detection import (NO_BATCH,batch_median_codes,batch_median_code_labels,
+                                grouped_robust_scaler_parameters,scored_outlier_frame)
+from .quantile_sketch import GroupedQuantileSketch
+
+
+logger=logging.getLogger(__name__)
+
+#Peak memory of scoring a batch relative to the memory of its values (label
+#and score columns, the sorted copy, the flag columns and the Arrow buffers),
+#measured on DHIS2 value frames
+SCORING_MEMORY_FACTOR=10
+
+SPOOL_PREFIXES=('de_batch_','batch_codes_','bucket_codes_','bucket_values_')
+
+
+def _is_parquet(path):
+    return path.endswith('.parquet') or path.endswith('.pq')
+
+
+def _source_chunks(source_path,chunk_rows,columns=None):
+    """Chunks of the source file: pyarrow Tables for Parquet, DataFrames for CSV."""
+    if _is_parquet(source_path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        for record_batch in pq.ParquetFile(source_path).iter_batches(batch_size=chunk_rows,columns=columns):
+            yield pa.Table.from_batches([record_batch])
+    else:
+        for chunk in pd.read_csv(source_path,chunksize=chunk_rows,usecols=columns):
+            yield chunk
+
+
+def _chunk_column(chunk,column):
+    if isinstance(chunk,pd.DataFrame):
+        return chunk[column]
+    return chunk.column(column).to_pandas()
+
+
+def _chunk_rows(chunk,mask):
+    if isinstance(chunk,pd.DataFrame):
+        return chunk[mask]
+    import pyarrow as pa
+    return chunk.filter(pa.array(mask))
+
+
+def de_row_counts(source_path,chunk_rows=1000000):
+    """Rows of each DE_UID of the source, in order of appearance."""
+    row_counts={}
+    for chunk in _source_chunks(source_path,chunk_rows,columns=['DE_UID']):
+        for de_uid,de_rows in _chunk_column(chunk,'DE_UID').value_counts(sort=False).items():
+            row_counts[de_uid]=row_counts.get(de_uid,0)+de_rows
+    return row_counts
+
+
+def managable_row_size_for(source_path,memory_budget,sample_rows=10000):
+    """Batch size in rows keeping the scoring of a batch under memory_budget
+    bytes, from the memory taken by the first rows of the source."""
+    sample_df=next(iter(_source_chunks(source_path,sample_rows)))
+    if not isinstance(sample_df,pd.DataFrame):
+        sample_df=sample_df.to_pandas()
+    row_bytes=max(sample_df.memory_usage(index=False,deep=True).sum()/max(sample_df.shape[0],1),1)
+    return max(int(memory_budget/(row_bytes*SCORING_MEMORY_FACTOR)),1)
+
+
+class DeBatchFiles(object):
+    """Rows of the source split into one file per DE batch, in the format of
+    the source.
+    Parameters
+    ----------
+    spool_dir: str
+    parquet: bool
+    """
+
+    def __init__(self,spool_dir,parquet):
+        self.spool_dir=spool_dir
+        self.parquet=parquet
+        self._writers={}
+
+    def append(self,batch_index,chunk):
+        batch_path=self._path(batch_index)
+        if self.parquet:
+            if batch_index not in self._writers:
+                import pyarrow.parquet as pq
+                self._writers[batch_index]=pq.ParquetWriter(batch_path,chunk.schema)
+            self._writers[batch_index].write_table(chunk)
+        else:
+            chunk.to_csv(batch_path,mode='a',header=not os.path.exists(batch_path),index=False)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers={}
+
+    def read(self,batch_index):
+        batch_path=self._path(batch_index)
+        if not os.path.exists(batch_path):
+            return None
+        if self.parquet:
+            return pd.read_parquet(batch_path)
+        return pd.read_csv(batch_path)
+
+    def _path(self,batch_index):
+        return os.path.join(self.spool_dir,'de_batch_'+str(batch_index)+('.parquet' if self.parquet else '.csv'))
+
+
+class _OutputWriter(object):
+    #Appends the scored batches to a Parquet or CSV file
+
+    def __init__(self,output_path):
+        self.output_path=output_path
+        self._writer=None
+        self._schema=None
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    def write(self,df):
+        if _is_parquet(self.output_path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._writer is None:
+                table=pa.Table.from_pandas(df,preserve_index=False)
+                self._schema=table.schema
+                self._writer=pq.ParquetWriter(self.output_path,self._schema)
+            else:
+                table=pa.Table.from_pandas(df,schema=self._schema,preserve_index=False)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.output_path,mode='a',header=not os.path.exists(self.output_path),index=False)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def _keyed_rows(df,de_uid_vars):
+    #Rows with DE keys and their DE codes, as in outlier_detection_assignment
+    data_with_outliers=df[df[de_uid_vars].notna().all(axis=1)]
+    de_codes=data_with_outliers.groupby(de_uid_vars,sort=True).ngroup().to_numpy(dtype=np.intp)
+    return data_with_outliers,de_codes
+
+
+def outlier_detection_out_of_core(source_path,output_path,de_uid_vars,managable_row_size=5000000,
+                                  memory_budget=None,spool_dir=None,relative_accuracy=None):
+    """
+    Outlier columns of the values of a Parquet or CSV file, written to a
+    Parquet or CSV output file (after its extension), with the same scores
+    as outlier_detection_assignment on the whole file.
+
+    The source is cut into batches of about managable_row_size rows without
+    splitting a DE (de_count_batch_selector). With memory_budget (bytes) the
+    batch size is derived from the memory the rows take, the budget being for
+    the batches on top of the memory of the loaded libraries. A DE bigger 
+    than the batch size is scored alone.
+
+    batch_median groups mix DEs, so the run goes in passes over the batches:
+    the batch_median codes of each batch first, with the values spilled per
+    group, then the RobustScaler parameters of each batch_median group, then
+    the scores of each batch streamed to the output. The values of a
+    batch_median group are needed together for its exact quantiles: the
+    largest group takes 12 bytes per row during that step. Rows come ordered
+    by batch_median and DE within each batch.
+
+    With relative_accuracy the statistics come from quantile sketches (see
+    outlier_detection_assignment): the sketches of the batches are merged
+    instead of spilling the values, in memory bounded by the buckets in use.
+    Parameters
+    ----------
+    source_path: str
+        .parquet/.pq or .csv file with the de_uid_vars, OU_UID and VALUE columns.
+    output_path: str
+    de_uid_vars: list
+    managable_row_size: int
+    memory_budget: int, optional
+    spool_dir: str, optional
+        Directory of the intermediate files, a temporary one by default.
+    relative_accuracy: float, optional
+    Returns
+    -------
+    Number of scored rows written.
+    """
+    if memory_budget is not None:
+        managable_row_size=managable_row_size_for(source_path,memory_budget)
+    chunk_rows=max(managable_row_size//SCORING_MEMORY_FACTOR,1)
+
+    de_counts=de_row_counts(source_path,chunk_rows)
+    de_batches=de_count_batch_selector(de_counts,managable_row_size)
+    de_batch_index=pd.Series({de_uid:batch_index for batch_index,de_batch in enumerate(de_batches) for de_uid in de_batch},
+                             dtype='float64')
+    total_rows=sum(de_counts.values())
+    logger.info('outliers out of core: %s rows, %s DE batches of up to %s rows',total_rows,len(de_batches),managable_row_size)
+
+    own_spool=spool_dir is None
+    spool_dir=spool_dir or tempfile.mkdtemp(prefix='blsq_dqapp_outliers_')
+    os.makedirs(spool_dir,exist_ok=True)
+    #Files of a previous run would be appended to
+    for file_name in os.listdir(spool_dir):
+        if file_name.startswith(SPOOL_PREFIXES):
+            os.remove(os.path.join(spool_dir,file_name))
+    try:
+        #Pass 0: rows split by DE batch
+        batch_files=DeBatchFiles(spool_dir,_is_parquet(source_path))
+        try:
+            for chunk in _source_chunks(source_path,chunk_rows):
+                chunk_batches=_chunk_column(chunk,'DE_UID').map(de_batch_index).to_numpy()
+                for batch_index in np.unique(chunk_batches[~np.isnan(chunk_batches)]).astype(int):
+                    batch_files.append(batch_index,_chunk_rows(chunk,chunk_batches==batch_index))
+        finally:
+            batch_files.close()
+
+        #Pass 1: batch_median codes, values spilled to buckets of whole batch_median groups
+        n_buckets=max(int(np.ceil(total_rows/managable_row_size)),1)
+        batch_sketch=GroupedQuantileSketch(relative_accuracy) if relative_accuracy is not None else None
+        max_code=NO_BATCH
+        for batch_index in range(len(de_batches)):
+            batch_df=batch_files.read(batch_index)
+            if batch_df is None:
+                continue
+            data_with_outliers,de_codes=_keyed_rows(batch_df,de_uid_vars)
+            n_des=int(de_codes.max())+1 if de_codes.shape[0] else 0
+            ou_codes,_=pd.factorize(data_with_outliers['OU_UID'])
+            values=data_with_outliers['VALUE'].to_numpy(dtype='float64')
+            batch_codes=batch_median_codes(de_codes,ou_codes,values,n_des,relative_accuracy)
+            np.save(os.path.join(spool_dir,'batch_codes_'+str(batch_index)+'.npy'),batch_codes)
+            kept_rows=batch_codes!=NO_BATCH
+            batch_codes=batch_codes[kept_rows].astype(np.int32)
+            values=values[kept_rows]
+            max_code=max(max_code,int(batch_codes.max(initial=NO_BATCH)))
+            if batch_sketch is not None:
+                batch_sketch.add(values,batch_codes+2)
+                del batch_df,data_with_outliers
+                continue
+            buckets=(batch_codes+2)%n_buckets
+            for bucket in np.unique(buckets):
+                with open(os.path.join(spool_dir,'bucket_codes_'+str(bucket)),'ab') as codes_file:
+                    batch_codes[buckets==bucket].tofile(codes_file)
+                with open(os.path.join(spool_dir,'bucket_values_'+str(bucket)),'ab') as values_file:
+                    values[buckets==bucket].tofile(values_file)
+            del batch_df,data_with_outliers
+
+        #RobustScaler parameters of the batch_median groups, indexed by code+2
+        n_codes=max_code+3
+        center=np.full(n_codes,np.nan)
+        scale=np.full(n_codes,np.nan)
+        if batch_sketch is not None:
+            center,scale=batch_sketch.robust_scaler_parameters(n_codes)
+        for bucket in range(n_buckets):
+            codes_path=os.path.join(spool_dir,'bucket_codes_'+str(bucket))
+            if not os.path.exists(codes_path):
+                continue
+            bucket_codes=np.fromfile(codes_path,dtype=np.int32)+2
+            bucket_values=np.fromfile(os.path.join(spool_dir,'bucket_values_'+str(bucket)),dtype='float64')
+            bucket_center,bucket_scale=grouped_robust_scaler_parameters(bucket_values,bucket_codes,n_codes)
+            in_bucket=np.bincount(bucket_codes,minlength=n_codes)>0
+            center[in_bucket]=bucket_center[in_bucket]
+            scale[in_bucket]=bucket_scale[in_bucket]
+            del bucket_codes,bucket_values
+        code_labels=batch_median_code_labels(np.arange(-2,max_code+1))
+        code_order=np.argsort([str(label) for label in code_labels],kind='stable')
+        code_ranks=np.empty(n_codes,dtype=np.intp)
+        code_ranks[code_order]=np.arange(n_codes)
+
+        #Pass 2: scores of each batch streamed to the output
+        output_writer=_OutputWriter(output_path)
+        written_rows=0
+        try:
+            for batch_index in range(len(de_batches)):
+                batch_df=batch_files.read(batch_index)
+                if batch_df is None:
+                    continue
+                data_with_outliers,de_codes=_keyed_rows(batch_df,de_uid_vars)
+                batch_codes=np.load(os.path.join(spool_dir,'batch_codes_'+str(batch_index)+'.npy'))
+                kept_rows=batch_codes!=NO_BATCH
+                code_index=batch_codes[kept_rows]+2
+                values=data_with_outliers['VALUE'].to_numpy(dtype='float64')[kept_rows]
+                scored_df=scored_outlier_frame(data_with_outliers[kept_rows],code_labels[code_index],
+                                               (values-center[code_index])/scale[code_index],
+                                               code_ranks[code_index],de_codes[kept_rows])
+                output_writer.write(scored_df)
+                written_rows +=scored_df.shape[0]
+                logger.info('outliers out of core: batch %s/%s scored, %s rows',batch_index+1,len(de_batches),scored_df.shape[0])
+                del batch_df,data_with_outliers,scored_df
+        finally:
+            output_writer.close()
+    finally:
+        if own_spool:
+            shutil.rmtree(spool_dir,ignore_errors=True)
+    return written_rows
@@ -7,6 +7,9 @@ Created on Tue Jan 12 19:45:12 2021
 import pandas as pd
 import numpy as np
 import gc
+from concurrent.futures import ProcessPoolExecutor
+
+from .quantile_sketch import GroupedQuantileSketch,grouped_sketch_robust_scaler_parameters
 
 #Reviewed version
 
@@ -141,24 +144,291 @@ def outliers_rs_based_generator(df):
     return df
 
 
-def outlier_detection_assignment (df,de_uid_vars):
-    from sklearn.preprocessing import RobustScaler
-    from functools import partial
-    re=RobustScaler()
+def _grouped_sorted_percentiles(sorted_values,starts,counts,q):
+    """""
+    Percentile q (in [0,1]) of each group of sorted_values, groups being the
+    contiguous slices [starts,starts+counts). Same linear interpolation as 
+    numpy.percentile, so it gives bit identical results. Empty groups get NaN.
+    """""
+    percentiles=np.full(counts.shape[0],np.nan)
+    present=counts>0
+    n=counts[present]
+    
+    virtual_indexes=q*(n-1)
+    previous_indexes=np.floor(virtual_indexes)
+    next_indexes=previous_indexes+1
+    above_bounds=virtual_indexes>=n-1
+    previous_indexes[above_bounds]=n[above_bounds]-1
+    next_indexes[above_bounds]=n[above_bounds]-1
+    gamma=virtual_indexes-np.floor(virtual_indexes)
+    
+    previous=sorted_values[starts[present]+previous_indexes.astype(np.intp)]
+    following=sorted_values[starts[present]+next_indexes.astype(np.intp)]
+    diff_b_a=following-previous
+    lerp_interpolation=previous+diff_b_a*gamma
+    upper_half=gamma>=0.5
+    lerp_interpolation[upper_half]=following[upper_half]-diff_b_a[upper_half]*(1-gamma[upper_half])
+    
+    percentiles[present]=lerp_interpolation
+    return percentiles
+
+
+def _grouped_sorted_medians(sorted_values,starts,counts):
+    #Middle value, or mean of the two middle values, as numpy.median
+    medians=np.full(counts.shape[0],np.nan)
+    present=counts>0
+    n=counts[present]
+    lower=sorted_values[starts[present]+(n-1)//2]
+    upper=sorted_values[starts[present]+n//2]
+    medians[present]=np.where(n%2==1,lower,(lower+upper)/2)
+    return medians
+
+
+def grouped_robust_scaler_parameters(values,group_codes,n_groups):
+    """""
+    Center and scale that sklearn RobustScaler would fit on the values of each
+    group, computed for all the groups at once: center is the median, scale the
+    25-75 interquartile range, set to 1 when it is (close to) 0. NaN values
+    are ignored as RobustScaler does.
+    
+    group_codes are integers in [0,n_groups) aligned with values.
+    """""
+    values=np.asarray(values,dtype='float64')
+    group_codes=np.asarray(group_codes)
+    present=~np.isnan(values)
+    values=values[present]
+    group_codes=group_codes[present]
+    
+    order=np.lexsort((values,group_codes))
+    sorted_values=values[order]
+    counts=np.bincount(group_codes,minlength=n_groups)
+    starts=np.concatenate(([0],np.cumsum(counts)[:-1]))
+    
+    center=_grouped_sorted_medians(sorted_values,starts,counts)
+    scale=(_grouped_sorted_percentiles(sorted_values,starts,counts,0.75)
+           -_grouped_sorted_percentiles(sorted_values,starts,counts,0.25))
+    scale[scale<10*np.finfo(scale.dtype).eps]=1.0
+    return center,scale
+
+
+#Integer codes of the batch_median labels: intervals are numbered from 1
+NO_BATCH=-1
+ZERO_BATCH=-2
+NAN_BATCH=0
+
+
+def _batch_median_interval_codes(median_units_values,median_units_values_max):
+    """""
+    Vectorized df_median_batching_assignment labelling: each OU median gets 
+    the number of its width-10 interval among the ones pd.interval_range builds
+    up to the max median of its DE, ZERO_BATCH for medians equal to 0 and 
+    NAN_BATCH outside of the intervals.
+    """""
+    max_values=np.unique(median_units_values_max[~np.isnan(median_units_values_max)])
+    n_intervals={max_value:len(pd.interval_range(start=0,freq=10,end=max_value)) for max_value in max_values}
+    de_n_intervals=pd.Series(median_units_values_max).map(n_intervals).fillna(0).to_numpy().astype(np.intp)
+    
+    #Same side as pd.cut on right closed intervals
+    interval_rights=10.0*np.arange(1,max(de_n_intervals.max(initial=0),1)+1)
+    interval_codes=np.searchsorted(interval_rights,median_units_values,side='left')+1
+    in_intervals=(median_units_values>0) & (interval_codes<=de_n_intervals)
+    interval_codes=np.where(in_intervals,interval_codes,NAN_BATCH).astype(np.intp)
+    interval_codes[median_units_values==0]=ZERO_BATCH
+    return interval_codes
+
+
+def batch_median_code_labels(batch_codes):
+    """""
+    batch_median labels of the codes, as df_median_batching_assignment writes
+    them: '(0.0, 10.0]', '(10.0, 20.0]', ..., '0', 'nan', None for NO_BATCH.
+    """""
+    n_intervals=max(int(batch_codes.max()) if batch_codes.shape[0] else 0,1)
+    intervals=pd.interval_range(start=0,freq=10,end=10.0*n_intervals)
+    #Shifted by 2 to index ZERO_BATCH and NO_BATCH from the start
+    code_labels=np.array(['0',None,'nan']+list(intervals.astype(str)),dtype=object)
+    return code_labels[batch_codes+2]
+
+
+def robust_scaler_parameters(values,group_codes,n_groups,relative_accuracy=None):
+    #Exact grouped parameters, or read from quantile sketches with relative_accuracy
+    if relative_accuracy is None:
+        return grouped_robust_scaler_parameters(values,group_codes,n_groups)
+    return grouped_sketch_robust_scaler_parameters(values,group_codes,n_groups,relative_accuracy)
+
+
+def batch_median_codes(de_codes,ou_codes,values,n_des,relative_accuracy=None):
+    """""
+    batch_median codes of each value row, DEs being given as integer codes in
+    [0,n_des) and OUs as integer codes (-1 for rows without OU).
+    
+    OU medians of each DE are labelled by their width-10 interval, the ones of
+    OUs with less than three values that are outliers among the medians of the
+    DE being replaced by the median of medians. Rows without OU and rows of 
+    DEs without any value get NO_BATCH. Only rows of the same DE interact, so 
+    the DEs can be split among processes.
+    
+    With relative_accuracy the medians come from quantile sketches instead of
+    exact grouped quantiles.
+    """""
+    batch_codes=np.full(de_codes.shape[0],NO_BATCH,dtype=np.intp)
+    de_has_values=np.bincount(de_codes[~np.isnan(values)],minlength=n_des)>0
+    
+    keyed_rows=ou_codes>=0
+    de_ou_codes,de_ou_uniques=pd.factorize(de_codes[keyed_rows].astype(np.int64)*(int(ou_codes.max())+1)+ou_codes[keyed_rows])
+    if de_ou_codes.shape[0]==0:
+        return batch_codes
+    ou_de_codes=np.zeros(len(de_ou_uniques),dtype=np.intp)
+    ou_de_codes[de_ou_codes]=de_codes[keyed_rows]
+    
+    ou_values=values[keyed_rows]
+    if relative_accuracy is None:
+        ou_stats=pd.DataFrame({'DE_OU_CODE':de_ou_codes,'VALUE':ou_values}).groupby('DE_OU_CODE',sort=True).VALUE.agg(['median','count'])
+        median_units_values=ou_stats['median'].to_numpy()
+        units_values_count=ou_stats['count'].to_numpy()
+    else:
+        median_units_values=GroupedQuantileSketch(relative_accuracy).add(ou_values,de_ou_codes).quantiles(0.5,len(de_ou_uniques))
+        units_values_count=np.bincount(de_ou_codes[~np.isnan(ou_values)],minlength=len(de_ou_uniques))
+    center,scale=robust_scaler_parameters(median_units_values,ou_de_codes,n_des,relative_accuracy)
+    median_rs_score=np.abs((median_units_values-center[ou_de_codes])/scale[ou_de_codes])
+    scarse_values=(units_values_count<3) & (median_rs_score>=7)
+    median_units_values=np.where(scarse_values,center[ou_de_codes],median_units_values)
+    
+    median_units_values_max=pd.Series(median_units_values).groupby(ou_de_codes).max().reindex(range(n_des)).to_numpy()
+    ou_batch_codes=_batch_median_interval_codes(median_units_values,median_units_values_max[ou_de_codes])
+    ou_batch_codes=np.where(de_has_values[ou_de_codes],ou_batch_codes,NO_BATCH)
+    
+    batch_codes[keyed_rows]=ou_batch_codes[de_ou_codes]
+    return batch_codes
+
+
+def _group_shards(group_codes,n_groups,n_shards):
+    """""
+    Split the groups in at most n_shards contiguous ranges of codes holding 
+    about the same number of rows. Yields (rows,first_group,last_group+1).
+    """""
+    order=np.argsort(group_codes,kind='stable')
+    group_ends=np.cumsum(np.bincount(group_codes,minlength=n_groups))
+    targets=group_ends[-1]*np.arange(1,n_shards)/n_shards
+    group_bounds=np.unique(np.concatenate(([0],np.searchsorted(group_ends,targets,side='right'),[n_groups])))
+    row_bounds=np.concatenate(([0],group_ends))[group_bounds]
+    for i in range(len(group_bounds)-1):
+        if row_bounds[i+1]>row_bounds[i]:
+            yield order[row_bounds[i]:row_bounds[i+1]],group_bounds[i],group_bounds[i+1]
+
+
+def _parallel_batch_median_codes(executor,n_shards,de_codes,ou_codes,values,n_des,relative_accuracy=None):
+    batch_codes=np.full(de_codes.shape[0],NO_BATCH,dtype=np.intp)
+    shards=[]
+    for rows,first_de,end_de in _group_shards(de_codes,n_des,n_shards):
+        future=executor.submit(batch_median_codes,de_codes[rows]-first_de,ou_codes[rows],values[rows],end_de-first_de,
+                               relative_accuracy)
+        shards.append((rows,future))
+    for rows,future in shards:
+        batch_codes[rows]=future.result()
+    return batch_codes
+
+
+def _parallel_robust_scaler_parameters(executor,n_shards,values,group_codes,n_groups,relative_accuracy=None):
+    center=np.full(n_groups,np.nan)
+    scale=np.full(n_groups,np.nan)
+    shards=[]
+    for rows,first_group,end_group in _group_shards(group_codes,n_groups,n_shards):
+        future=executor.submit(robust_scaler_parameters,values[rows],group_codes[rows]-first_group,end_group-first_group,
+                               relative_accuracy)
+        shards.append((first_group,end_group,future))
+    for first_group,end_group,future in shards:
+        center[first_group:end_group],scale[first_group:end_group]=future.result()
+    return center,scale
+
+
+def outlier_score_codes(de_codes,ou_codes,values,n_des,max_workers=None,relative_accuracy=None):
+    """""
+    batch_median code of each value row (see batch_median_codes) and, for the
+    rows with a batch_median (code other than NO_BATCH), its label, the rank
+    of the label and the RS_SCORE of the value within its batch_median group.
+    This is outlier_detection_assignment on integer codes, for callers that
+    hold the values as arrays.
+    """""
+    executor=None
+    if max_workers and max_workers>1 and n_des>1:
+        executor=ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        if executor is not None:
+            batch_codes=_parallel_batch_median_codes(executor,max_workers,de_codes,ou_codes,values,n_des,relative_accuracy)
+        else:
+            batch_codes=batch_median_codes(de_codes,ou_codes,values,n_des,relative_accuracy)
+        
+        kept_rows=batch_codes!=NO_BATCH
+        batch_median=batch_median_code_labels(batch_codes[kept_rows])
+        
+        #RobustScaler of each batch_median group, all groups at once
+        batch_order,batch_uniques=pd.factorize(batch_median,sort=True)
+        batch_values=values[kept_rows]
+        if executor is not None and len(batch_uniques)>1:
+            center,scale=_parallel_robust_scaler_parameters(executor,max_workers,batch_values,batch_order,len(batch_uniques),
+                                                            relative_accuracy)
+        else:
+            center,scale=robust_scaler_parameters(batch_values,batch_order,len(batch_uniques),relative_accuracy)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return batch_codes,batch_median,batch_order,(batch_values-center[batch_order])/scale[batch_order]
+
+
+def outlier_detection_assignment (df,de_uid_vars,max_workers=None,relative_accuracy=None):
+    """""
+    Outlier columns (batch_median, RS_SCORE, EXTREME_RS, OUTLIER_RS, ZERO) of 
+    the values, computed for all the DEs at once. 
+    
+    Gives the same results as applying df_median_batching_assignment on each 
+    DE group and rs_values_addition on each batch_median group, with the
+    medians and RobustScaler parameters taken from grouped quantiles instead 
+    of one scaler fit per group. As with the grouped applies, rows without DE
+    keys, OU or batch_median are left out, and rows come ordered by 
+    batch_median and DE.
+    
+    With max_workers>1 the DEs are sharded among a pool of processes for the
+    batch_median assignment, then the batch_median groups for their scaler
+    parameters. Shards only carry integer codes and float values, so they 
+    travel as raw numpy buffers; the frame itself stays in this process.
+    
+    With relative_accuracy (e.g. 0.01) the OU medians and the scaler 
+    parameters are read from quantile sketches (quantile_sketch) instead of
+    exact quantiles: each within relative_accuracy of its exact value, 
+    faster and lighter on large frames, but OUs whose median is close to an
+    interval bound may change of batch_median.
+    """""
+    data_with_outliers=df[df[de_uid_vars].notna().all(axis=1)]
+    de_codes=data_with_outliers.groupby(de_uid_vars,sort=True).ngroup().to_numpy(dtype=np.intp)
+    n_des=int(de_codes.max())+1 if de_codes.shape[0] else 0
+    ou_codes,_=pd.factorize(data_with_outliers['OU_UID'])
+    values=data_with_outliers['VALUE'].to_numpy(dtype='float64')
+    
+    batch_codes,batch_median,batch_order,rs_score=outlier_score_codes(de_codes,ou_codes,values,n_des,max_workers,relative_accuracy)
+    kept_rows=batch_codes!=NO_BATCH
     
-    data_with_outliers=df.groupby(de_uid_vars,as_index=False).apply(partial(df_median_batching_assignment,re=re))
-    data_with_outliers=data_with_outliers.groupby(['batch_median'],as_index=False).apply(partial(rs_values_addition,re=re))
-    data_with_outliers=outliers_rs_based_generator(data_with_outliers)
+    data_with_outliers=scored_outlier_frame(data_with_outliers[kept_rows],batch_median,rs_score,batch_order,de_codes[kept_rows])
     gc.collect()
     
     return data_with_outliers
 
 
-def outlier_detection_handler (df,de_uid_vars,project_path_processed,files_main_name,save_raw_file=True,file_suffix='_with_outliers_raw'):
-    #TODO include batching
+def scored_outlier_frame(df,batch_median,rs_score,batch_order,de_order):
+    """""
+    Add batch_median and RS_SCORE to the rows, order them by batch_median
+    (batch_order being the rank of each label) and DE, and flag the outliers.
+    """""
+    data_with_outliers=df.assign(batch_median=batch_median,DE_ORDER=de_order,RS_SCORE=rs_score,BATCH_ORDER=batch_order)
+    data_with_outliers=data_with_outliers.sort_values(['BATCH_ORDER','DE_ORDER'],kind='stable')
+    data_with_outliers=data_with_outliers.drop(columns=['BATCH_ORDER','DE_ORDER'])
+    return outliers_rs_based_generator(data_with_outliers)
+
+
+def outlier_detection_handler (df,de_uid_vars,project_path_processed,files_main_name,save_raw_file=True,file_suffix='_with_outliers_raw',max_workers=None,relative_accuracy=None):
+    #Sources that do not fit in memory: outlier_batching.outlier_detection_out_of_core
     #de_uid_vars=[col for col in df.columns if col in ['DE_UID','COC_UID'] ]
     
-    data_with_outliers=outlier_detection_assignment (df,de_uid_vars)
+    data_with_outliers=outlier_detection_assignment (df,de_uid_vars,max_workers=max_workers,relative_accuracy=relative_accuracy)
     
     #if save_raw_file:
     #    data_with_outliers.to_csv(project_path_processed+files_main_name+file_suffix+'.csv',index=False)
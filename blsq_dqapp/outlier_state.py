@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental outlier scoring: the batch_median of each DE/OU and the
+RobustScaler parameters of each batch_median group are saved after a full
+pass, and the values of new periods are scored against them until they
+drift too far from the saved state.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .outlier_detection import outlier_detection_assignment,grouped_robust_scaler_parameters,scored_outlier_frame
+
+
+logger=logging.getLogger(__name__)
+
+
+class OutlierState(object):
+    """batch_median of each DE/OU, and center and scale of each batch_median
+    group, as found by a full outlier pass.
+    Parameters
+    ----------
+    ou_state: DataFrame
+        de_uid_vars, OU_UID and batch_median columns.
+    batch_state: DataFrame
+        batch_median, CENTER, SCALE and COUNT columns.
+    de_uid_vars: list
+    periods: list, optional
+        Periods scored with the state.
+    """
+
+    def __init__(self,ou_state,batch_state,de_uid_vars,periods=None):
+        self.ou_state=ou_state
+        self.batch_state=batch_state
+        self.de_uid_vars=list(de_uid_vars)
+        self.periods=list(periods or [])
+
+    @classmethod
+    def from_scored(cls,data_with_outliers,de_uid_vars):
+        """State of the rows scored by outlier_detection_assignment."""
+        ou_keys=list(de_uid_vars)+['OU_UID']
+        ou_state=data_with_outliers.groupby(ou_keys,sort=False).agg(batch_median=('batch_median','first')).reset_index()
+
+        batch_codes,batch_uniques=pd.factorize(data_with_outliers['batch_median'],sort=True)
+        batch_values=data_with_outliers['VALUE'].to_numpy(dtype='float64')
+        center,scale=grouped_robust_scaler_parameters(batch_values,batch_codes,len(batch_uniques))
+        batch_state=pd.DataFrame({'batch_median':np.asarray(batch_uniques,dtype=object),'CENTER':center,'SCALE':scale,
+                                  'COUNT':np.bincount(batch_codes[~np.isnan(batch_values)],minlength=len(batch_uniques))})
+
+        periods=sorted(data_with_outliers['PERIOD'].astype(str).unique())
+        return cls(ou_state,batch_state,de_uid_vars,periods)
+
+    def save(self,state_dir):
+        os.makedirs(state_dir,exist_ok=True)
+        for name,state_df in (('ou_state',self.ou_state),('batch_state',self.batch_state)):
+            state_path=os.path.join(state_dir,name+'.parquet')
+            state_df.to_parquet(state_path+'.tmp',index=False)
+            os.replace(state_path+'.tmp',state_path)
+        self.save_periods(state_dir)
+
+    def save_periods(self,state_dir):
+        with open(os.path.join(state_dir,'state.json'),'w') as state_file:
+            json.dump({'de_uid_vars':self.de_uid_vars,'periods':self.periods},state_file)
+
+    @classmethod
+    def load(cls,state_dir):
+        """Saved state, or None if state_dir has none."""
+        if not os.path.exists(os.path.join(state_dir,'state.json')):
+            return None
+        with open(os.path.join(state_dir,'state.json')) as state_file:
+            state_info=json.load(state_file)
+        return cls(pd.read_parquet(os.path.join(state_dir,'ou_state.parquet')),
+                   pd.read_parquet(os.path.join(state_dir,'batch_state.parquet')),
+                   state_info['de_uid_vars'],state_info['periods'])
+
+    def score(self,df):
+        """
+        Outlier columns of the rows of df scored against the state, as
+        outlier_detection_assignment would add them, and the drift of the
+        values from the state:
+        - new_share: share of the rows with a value whose DE/OU is not in
+          the state (left out of the scored rows),
+        - center_shift: distance of the median of the new values of each
+          batch_median group to its saved center, in scale units, averaged
+          over the rows.
+        """
+        ou_keys=self.de_uid_vars+['OU_UID']
+        keyed_df=df[df[ou_keys].notna().all(axis=1)]
+        ou_rows=pd.MultiIndex.from_frame(self.ou_state[ou_keys]).get_indexer(pd.MultiIndex.from_frame(keyed_df[ou_keys]))
+        values=keyed_df['VALUE'].to_numpy(dtype='float64')
+        has_value=~np.isnan(values)
+        covered=ou_rows>=0
+        new_share=float((has_value & ~covered).sum()/max(has_value.sum(),1))
+
+        data_with_outliers=keyed_df[covered]
+        values=values[covered]
+        batch_median=self.ou_state['batch_median'].to_numpy(dtype=object)[ou_rows[covered]]
+        batch_rows=pd.Index(self.batch_state['batch_median']).get_indexer(batch_median)
+        center=self.batch_state['CENTER'].to_numpy()[batch_rows]
+        scale=self.batch_state['SCALE'].to_numpy()[batch_rows]
+
+        #Medians of the new values of each batch_median group against the saved centers
+        new_center,_=grouped_robust_scaler_parameters(values,batch_rows,self.batch_state.shape[0])
+        new_counts=np.bincount(batch_rows[~np.isnan(values)],minlength=self.batch_state.shape[0])
+        shifts=np.abs(new_center-self.batch_state['CENTER'].to_numpy())/self.batch_state['SCALE'].to_numpy()
+        center_shift=float(np.sum(shifts[new_counts>0]*new_counts[new_counts>0])/max(new_counts.sum(),1))
+
+        de_order=data_with_outliers.groupby(self.de_uid_vars,sort=True).ngroup().to_numpy()
+        data_with_outliers=scored_outlier_frame(data_with_outliers,batch_median,(values-center)/scale,batch_rows,de_order)
+        return data_with_outliers,{'rows':int(data_with_outliers.shape[0]),'new_share':new_share,'center_shift':center_shift}
+
+
+def incremental_outlier_detection(new_df,state_dir,de_uid_vars,history=None,drift_threshold=0.5,max_new_share=0.05,
+                                  max_workers=None):
+    """
+    Outlier columns of the values of new periods, scored against the state
+    saved in state_dir by the last full pass.
+
+    A full pass is run, and its state saved, when there is no state yet or
+    when the new values drift from it: center_shift above drift_threshold
+    or new_share above max_new_share (see OutlierState.score). The state is
+    only rebuilt from the whole history: on a drift without history the new
+    values are still scored against the saved state, with a warning.
+    Parameters
+    ----------
+    new_df: DataFrame
+        Values of the new periods.
+    state_dir: str
+    de_uid_vars: list
+    history: callable, optional
+        Returns all the values, new periods included, for a full pass, e.g.
+        lambda: PartitionedValueStore(store_dir).read(dx_items,periods). Only
+        called for a full pass; without it the first pass is run on new_df.
+    Returns
+    -------
+    (scored rows of new_df, drift dict with recomputed and drifted flags)
+    """
+    new_periods=sorted(new_df['PERIOD'].astype(str).unique())
+    state=OutlierState.load(state_dir)
+    if state is not None:
+        data_with_outliers,drift=state.score(new_df)
+        drift['drifted']=drift['center_shift']>drift_threshold or drift['new_share']>max_new_share
+        if not drift['drifted'] or history is None:
+            if drift['drifted']:
+                #A state built from the new periods alone would score the next ones against them
+                logger.warning('outlier state drift new_share=%.3f center_shift=%.3f without history, scored against the saved state',
+                               drift['new_share'],drift['center_shift'])
+            state.periods=sorted(set(state.periods)|set(new_periods))
+            state.save_periods(state_dir)
+            drift['recomputed']=False
+            return data_with_outliers,drift
+        logger.info('outlier state drift new_share=%.3f center_shift=%.3f, full pass',drift['new_share'],drift['center_shift'])
+
+    full_df=history() if history is not None else new_df
+    data_with_outliers=outlier_detection_assignment(full_df,de_uid_vars,max_workers=max_workers)
+    OutlierState.from_scored(data_with_outliers,de_uid_vars).save(state_dir)
+    data_with_outliers=data_with_outliers[data_with_outliers['PERIOD'].astype(str).isin(new_periods)]
+    return data_with_outliers,{'rows':int(data_with_outliers.shape[0]),'new_share':0.0,'center_shift':0.0,
+                               'drifted':state is not None,'recomputed':True}
@@ -1,5 +1,7 @@
 import math
 from datetime import date
+import numpy as np
+import pandas as pd
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse as parseDate
 from abc import ABC, abstractmethod
@@ -265,7 +267,7 @@ class YearWeekParser:
 class YearDayParser:
     @staticmethod
     def parse(period):
-        if "W" in period or len(period) != 8 :
+        if not period.isdigit() or len(period) != 8 :
             return
         year = int(period[:4])
         month=int(period[4:6])
@@ -307,9 +309,117 @@ PARSERS = [YearParser,YearSixMonthParser,YearSixMonthAprilParser,
            YearQuarterParser,YearWeekParser,YearDayParser,
            YearMonthParser, FinancialJulyParser,FinancialOctoberParser]
 
+PARSER_FREQUENCIES = {
+    YearParser: "yearly",
+    YearSixMonthParser: "sixmonthly",
+    YearSixMonthAprilParser: "sixmonthly_april",
+    YearQuarterParser: "quarterly",
+    YearWeekParser: "weekly",
+    YearDayParser: "daily",
+    YearMonthParser: "monthly",
+    FinancialJulyParser: "financial_july",
+    FinancialOctoberParser: "financial_october"
+}
+
+# Parsed periods: period -> (DateRange, frequency, ordinal)
 CACHE = {}
 
 
+def period_ordinal(start_date, frequency):
+    # Consecutive periods of a frequency get consecutive integers
+    if frequency == "daily":
+        return start_date.toordinal()
+    if frequency == "weekly":
+        # date(1, 1, 1) is a monday
+        return (start_date.toordinal() - 1) // 7
+    if frequency == "monthly":
+        return start_date.year * 12 + start_date.month - 1
+    if frequency == "quarterly":
+        return start_date.year * 4 + (start_date.month - 1) // 3
+    if frequency == "sixmonthly":
+        return start_date.year * 2 + (start_date.month - 1) // 6
+    if frequency == "sixmonthly_april":
+        return start_date.year * 2 + (start_date.month - 4) // 6
+    return start_date.year
+
+
+def _calendar_parts(dates):
+    years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+    months = dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    days = (dates - dates.astype("datetime64[M]")).astype(np.int64) + 1
+    return years.astype(str), months, days
+
+
+def _iso_weeks(dates):
+    # ISO year and week of each date are the ones of the thursday of its week
+    weekdays = (dates.astype(np.int64) + 3) % 7
+    thursdays = dates - weekdays + 3
+    iso_years = thursdays.astype("datetime64[Y]")
+    iso_weeks = (thursdays - iso_years.astype("datetime64[D]")).astype(np.int64) // 7 + 1
+    return (iso_years.astype(np.int64) + 1970).astype(str), iso_weeks.astype(str)
+
+
+def _calendar(frequency, first_year, last_year):
+    # Dates ExtractPeriod.call steps through, and their dhis2_format
+    first_day = np.datetime64(str(first_year).zfill(4) + "-01-01", "D")
+    end_day = np.datetime64(str(last_year + 1).zfill(4) + "-01-01", "D")
+    if frequency in ("daily", "weekly"):
+        dates = np.arange(first_day, end_day)
+    elif frequency == "quarterly":
+        dates = np.arange(first_day.astype("datetime64[M]"), end_day.astype("datetime64[M]"), 3).astype("datetime64[D]")
+    elif frequency in ("yearly", "financial_july", "financial_october"):
+        # ExtractFinancialOctoberPeriod steps through november 1st (january + 10 months)
+        month = {"yearly": 0, "financial_july": 6, "financial_october": 10}[frequency]
+        dates = (np.arange(first_day.astype("datetime64[Y]"), end_day.astype("datetime64[Y]")).astype("datetime64[M]")
+                 + month).astype("datetime64[D]")
+    else:
+        dates = np.arange(first_day.astype("datetime64[M]"), end_day.astype("datetime64[M]")).astype("datetime64[D]")
+
+    years, months, days = _calendar_parts(dates)
+    if frequency == "daily":
+        labels = np.char.add(np.char.add(years, np.char.zfill(months.astype(str), 2)), np.char.zfill(days.astype(str), 2))
+    elif frequency == "weekly":
+        iso_years, iso_weeks = _iso_weeks(dates)
+        labels = np.char.add(np.char.add(iso_years, "W"), iso_weeks)
+    elif frequency == "monthly":
+        labels = np.char.add(years, np.char.zfill(months.astype(str), 2))
+    elif frequency == "quarterly":
+        labels = np.char.add(np.char.add(years, "Q"), ((months + 2) // 3).astype(str))
+    elif frequency in ("sixmonthly", "sixmonthly_april"):
+        # As ExtractSixMonthlyPeriod.dhis2_format: (month-1//6)+1 is month+1
+        infix = "S" if frequency == "sixmonthly" else "AprilS"
+        labels = np.char.add(np.char.add(years, infix), (months + 1).astype(str))
+    elif frequency == "financial_july":
+        labels = np.char.add(years, "July")
+    elif frequency == "financial_october":
+        labels = np.char.add(years, "Oct")
+    else:
+        labels = years
+    return dates, labels
+
+
+# Days stepped by the weekly periods, months by the six-monthly ones
+CALENDAR_STEPS = {"weekly": 7, "sixmonthly": 6, "sixmonthly_april": 6}
+
+# Calendar tables: frequency -> (first_year, last_year, dates, labels)
+CALENDAR_CACHE = {}
+
+
+def calendar_table(frequency, first_year, last_year):
+    """
+    Sorted dates (datetime64[D]) that ExtractPeriod.call of a frequency steps
+    through over the years, and their periods. Built once, widened when
+    later calls need more years.
+    """
+    cached = CALENDAR_CACHE.get(frequency)
+    if cached is None or cached[0] > first_year or cached[1] < last_year:
+        if cached is not None:
+            first_year, last_year = min(first_year, cached[0]), max(last_year, cached[1])
+        cached = (first_year, last_year) + _calendar(frequency, first_year, last_year)
+        CALENDAR_CACHE[frequency] = cached
+    return cached[2], cached[3]
+
+
 class Periods:
     @staticmethod
     def split(period, frequency):        
@@ -317,15 +427,81 @@ class Periods:
         date_end = Periods.as_date_range(period[1]).end
         date_range=DateRange(date_start, date_end)
         mapper = CLASSES_MAPPING[frequency]
-        periods = tuple(mapper().call(date_range))
+        # Same periods as mapper().call(date_range), sliced from the calendar
+        # table: from the first date, every step, up to the end (at least one)
+        first_date = mapper().first_date(date_range)
+        dates, labels = calendar_table(frequency, first_date.year, max(first_date.year, date_end.year))
+        first = np.searchsorted(dates, np.datetime64(first_date, "D"))
+        last = np.searchsorted(dates, np.datetime64(date_end, "D"), side="right")
+        periods = tuple(labels[first:max(last, first + 1):CALENDAR_STEPS.get(frequency, 1)].tolist())
         return periods
 
 
     @staticmethod
     def as_date_range(period):
-        dateRange = None
-        for parser in PARSERS:
-            dateRange = parser.parse(period)
-            if dateRange:
-                break
-        return dateRange
\ No newline at end of file
+        return Periods.parse(period)[0]
+
+    @staticmethod
+    def parse(period):
+        """(DateRange, frequency, ordinal) of a period, (None, None, None)
+        when no parser takes it. Memoized in CACHE."""
+        parsed = CACHE.get(period)
+        if parsed is None:
+            parsed = (None, None, None)
+            for parser in PARSERS:
+                dateRange = parser.parse(period)
+                if dateRange:
+                    frequency = PARSER_FREQUENCIES[parser]
+                    parsed = (dateRange, frequency, period_ordinal(dateRange.start, frequency))
+                    break
+            CACHE[period] = parsed
+        return parsed
+
+    @staticmethod
+    def _parse_or_none(period):
+        try:
+            return Periods.parse(period)
+        except ValueError:
+            return (None, None, None)
+
+    @staticmethod
+    def encode(periods):
+        """
+        START_DATE, END_DATE (datetime64), FREQUENCY and ORDINAL (-1 when
+        not parsed) of each period of a Series, indexed as it. Each distinct
+        period is parsed once.
+        """
+        periods = pd.Series(periods)
+        codes, uniques = pd.factorize(periods)
+        parsed = [Periods._parse_or_none(str(period)) for period in uniques] + [(None, None, None)]
+        starts = np.array([date_range.start if date_range else None for date_range, _, _ in parsed], dtype="datetime64[D]")
+        ends = np.array([date_range.end if date_range else None for date_range, _, _ in parsed], dtype="datetime64[D]")
+        frequencies = np.array([frequency for _, frequency, _ in parsed], dtype=object)
+        ordinals = np.array([-1 if ordinal is None else ordinal for _, _, ordinal in parsed], dtype=np.int64)
+        return pd.DataFrame({
+            "START_DATE": starts[codes].astype("datetime64[ns]"),
+            "END_DATE": ends[codes].astype("datetime64[ns]"),
+            "FREQUENCY": frequencies[codes],
+            "ORDINAL": ordinals[codes]
+        }, index=periods.index)
+
+    @staticmethod
+    def order_codes(periods):
+        """
+        Codes of the periods of a Series in chronological order (by start
+        then end date, periods not parsed last by their string) and the
+        sorted distinct periods, as pd.factorize(periods, sort=True) but
+        with 2021W2 before 2021W10. Missing periods get -1.
+        """
+        codes, uniques = pd.factorize(pd.Series(periods))
+        encoded = Periods.encode(pd.Series(uniques, dtype=object))
+        not_parsed = encoded["START_DATE"].isna().to_numpy()
+        order = np.lexsort((np.asarray(uniques, dtype=str), encoded["END_DATE"].to_numpy(), encoded["START_DATE"].to_numpy(), not_parsed))
+        ranks = np.empty(len(uniques), dtype=np.intp)
+        ranks[order] = np.arange(len(uniques))
+        return np.where(codes >= 0, ranks[codes], -1), uniques.take(order)
+
+    @staticmethod
+    def chronological(periods):
+        """Distinct periods sorted as order_codes."""
+        return list(Periods.order_codes(pd.Series(periods).dropna())[1])
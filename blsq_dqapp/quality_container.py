@@ -4,11 +4,16 @@ Created on Thu Jan 14 15:16:53 2021
 
 @author: Fernando-Bluesquare
 """
+import logging
 
 from .outlier_detection import outlier_detection_handler
-from .availability import availability_condition_generator_handler,cross_join
+from .availability import availability_condition_generator_handler,cross_join,AvailabilityBitmap
 from .reporting_style_tools import reporting_style_classifier
 from .formatting_tools import fosa_level_df_generation,lvl3_transformation_from_fosa,tableau_format_generator
+from .quality_tensor import QualityTensor
+
+
+logger=logging.getLogger(__name__)
 
 class quality_auction_container(object):
     """Information and metadata about a given DHIS instance.
@@ -28,32 +33,89 @@ class quality_auction_container(object):
         self.de_uid_vars=de_uid_vars
         self.period_table=self.processed_df[['PERIOD']].drop_duplicates()
         self.input_metadata_de=input_metadata_de
+        self.availability=None
+        self.tensor=None
+        
+    def tensor_generation(self):
+        #The values as OU x DE x period arrays for the next stages, the long
+        #frame being built back by self.tensor.to_frame(). A frame the tensor
+        #does not carry row for row (other columns, several rows for an OU, 
+        #DE and period) stays on the frame stages
+        other_columns=[column for column in self.processed_df.columns
+                       if column not in ['OU_UID','PERIOD','VALUE']+self.de_uid_vars]
+        if other_columns:
+            logger.warning('columns %s not carried by the tensor, frame stages used',other_columns)
+            return
+        try:
+            self.tensor=QualityTensor.from_frame(self.processed_df,
+                                                 self.de_uid_vars,
+                                                 periods=self.period_table.PERIOD)
+        except ValueError as error:
+            logger.warning('%s, frame stages used',error)
+            self.tensor=None
         
     def outliers_generation(self):
+        if self.tensor is not None:
+            self.tensor.score_outliers()
+            return
         self.processed_df=outlier_detection_handler(self.processed_df,
                                                     self.de_uid_vars,
                                                     self.project_path_processed,
                                                     self.files_main_name)
             
-    def availability_generation(self,custom_tree_input=None,level_to_filter=5):
+    def availability_generation(self,custom_tree_input=None,level_to_filter=5,materialize=False):
+        #A tree with PERIOD is an expanded OU x DE x period frame to merge on,
+        #else the OUs (or OU/DE pairs) expected to report go to a bitmap of the
+        #periods with values, expanded only with materialize
+        if custom_tree_input is not None and 'PERIOD' in custom_tree_input.columns:
+            self.availability=None
+            if self.tensor is not None:
+                self.processed_df=self.tensor.to_frame()
+                self.tensor=None
+            self.processed_df=availability_condition_generator_handler(self.processed_df,
+                                                                       custom_tree_input,
+                                                                       self.de_uid_vars)
+            return
+        
         if custom_tree_input is None:
             fosa_tree_expected=self.input_metadata_tree.query('LEVEL=='+str(level_to_filter))
-            fosa_tree_expected=fosa_tree_expected[['OU_UID']]
-            custom_tree_input=cross_join(fosa_tree_expected,self.period_table)
-            
-        self.processed_df=availability_condition_generator_handler(self.processed_df,
-                                                                   custom_tree_input,
-                                                                   self.de_uid_vars)
+            custom_tree_input=fosa_tree_expected[['OU_UID']]
+        if self.tensor is not None:
+            self.availability=self.tensor.availability(expected=custom_tree_input)
+        else:
+            self.availability=AvailabilityBitmap.from_values(self.processed_df,
+                                                             self.de_uid_vars,
+                                                             periods=self.period_table.PERIOD,
+                                                             expected=custom_tree_input)
+        if materialize:
+            if self.tensor is not None:
+                self.processed_df=self.tensor.to_frame()
+                self.tensor=None
+            self.processed_df=self.availability.to_frame(self.processed_df)
+        
+    def _bitmap_availability(self):
+        return self.availability is not None and 'DE_AVAILABILITY_BOOL' not in self.processed_df.columns
         
     def reporting_style_generation(self):
+        if self._bitmap_availability():
+            self.reporting_style_df=self.availability.reporting_style()
+            return
         self.reporting_style_df=reporting_style_classifier(self.processed_df,
                                                      self.de_uid_vars)
         
         
     def fosa_df_generation(self):
+        fosa_stats_df=None
+        if self.tensor is not None and self._bitmap_availability():
+            fosa_stats_df=self.tensor.fosa_stats(self.availability)
         self.fosa_df=fosa_level_df_generation(self.processed_df,
                                               self.reporting_style_df,
-                                              self.de_uid_vars)
+                                              self.de_uid_vars,
+                                              availability=self.availability if self._bitmap_availability() else None,
+                                              fosa_stats_df=fosa_stats_df)
+        if self.tensor is not None:
+            #Last stage on the tensor, the scored rows back in processed_df as the frame stages leave them
+            self.processed_df=self.tensor.to_frame()
         
     def lvl_3_generation(self):
         self.lvl_df=lvl3_transformation_from_fosa(self.fosa_df,
@@ -65,9 +127,11 @@ class quality_auction_container(object):
         self.tableau_format_table=tableau_format_generator(self.lvl_df,
                                                            self.de_uid_vars)
         
-    def full_process_run(self,custom_tree_input=None,level_to_filter=5):
+    def full_process_run(self,custom_tree_input=None,level_to_filter=5,materialize=False,tensor=False):
+        if tensor:
+            self.tensor_generation()
         self.outliers_generation()
-        self.availability_generation(custom_tree_input=custom_tree_input,level_to_filter=level_to_filter)
+        self.availability_generation(custom_tree_input=custom_tree_input,level_to_filter=level_to_filter,materialize=materialize)
         self.reporting_style_generation()
         self.fosa_df_generation()
         self.lvl_3_generation()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+OU x DE x period arrays of the values and of the outlier columns, indexed by
+integer codes with codebooks for the UIDs, for the stages of the quality
+container to run on without hashing UID strings again at each stage.
+"""
+import numpy as np
+import pandas as pd
+
+from .availability import AvailabilityBitmap,_category_codes,_key_codes
+from .outlier_detection import NO_BATCH,batch_median_code_labels,outlier_score_codes,outliers_rs_based_generator
+from .formatting_tools import fosa_stats_from_aggregates
+from .periods import Periods
+
+
+#Outlier columns added by score_outliers, as outliers_rs_based_generator
+OUTLIER_LAYERS=('RS_SCORE','EXTREME_RS','OUTLIER_RS','ZERO')
+
+
+class QualityTensor(object):
+    """Values of OU/DE pairs over the periods, as a (pairs,periods) array with
+    NaN where there is no value: dense over the periods and sparse over the
+    OU x DE product, only pairs with rows being stored (dense gives the full
+    OU x DE x period array).
+
+    The outlier columns are further arrays of the same shape (layers), the
+    batch_median code is kept per pair. The rows of the pairs without VALUE
+    are kept in row_mask, so that to_frame builds back the long frame rows,
+    with the outlier columns, as the frame stages keep them.
+    Parameters
+    ----------
+    ou_uids: array
+    de_keys: DataFrame
+        One row per DE, de_uid_vars columns, sorted.
+    periods: list
+        Periods in chronological order (Periods.chronological).
+    pair_ou_codes,pair_de_codes: array
+        OU and DE codes of each pair.
+    layers: dict
+        (pairs,periods) arrays by column name, VALUE at least.
+    batch_codes: array, optional
+        batch_median code of each pair.
+    row_mask: array, optional
+        (pairs,periods) cells with a row, VALUE or not. The cells with a
+        VALUE by default.
+    """
+
+    def __init__(self,ou_uids,de_keys,periods,pair_ou_codes,pair_de_codes,layers,batch_codes=None,row_mask=None):
+        self.ou_uids=np.asarray(ou_uids,dtype=object)
+        self.de_keys=de_keys.reset_index(drop=True)
+        self.periods=list(periods)
+        self.pair_ou_codes=pair_ou_codes
+        self.pair_de_codes=pair_de_codes
+        self.layers=layers
+        self.batch_codes=batch_codes
+        self.row_mask=self.presence() if row_mask is None else row_mask
+
+    @classmethod
+    def from_frame(cls,values_df,de_uid_vars,periods=None):
+        """
+        Tensor of the VALUEs of a long frame with OU_UID, de_uid_vars and
+        PERIOD columns. Pairs are the OU/DEs with rows of a DE with at least
+        one value, their rows without VALUE are kept in row_mask. Rows without
+        keys, out of the periods or of a DE without value are left out, as 
+        the outlier stage leaves them out. An OU, DE and period can only have
+        one row, other columns than the keys and VALUE are not kept.
+        """
+        periods=Periods.chronological(values_df['PERIOD'] if periods is None else periods)
+        keyed_df=values_df[values_df[['OU_UID']+de_uid_vars].notna().all(axis=1)]
+        period_codes=_category_codes(keyed_df['PERIOD'],pd.Index(periods))
+        keyed_df=keyed_df[period_codes>=0]
+        period_codes=period_codes[period_codes>=0]
+
+        de_keys=keyed_df[keyed_df['VALUE'].notna()][de_uid_vars].drop_duplicates().sort_values(de_uid_vars).reset_index(drop=True)
+        n_des=max(len(de_keys),1)
+        de_codes=_key_codes(keyed_df,de_keys)
+        kept=de_codes>=0
+        ou_codes,ou_uids=pd.factorize(keyed_df['OU_UID'][kept],sort=True)
+        pair_codes,pair_keys=pd.factorize(ou_codes.astype(np.int64)*n_des+de_codes[kept],sort=True)
+
+        cells=pair_codes.astype(np.int64)*len(periods)+period_codes[kept]
+        if np.bincount(cells,minlength=1).max(initial=0)>1:
+            raise ValueError('several rows for the same OU, DE and period')
+        values=np.full(len(pair_keys)*len(periods),np.nan)
+        values[cells]=keyed_df['VALUE'].to_numpy(dtype='float64')[kept]
+        row_mask=np.zeros(len(pair_keys)*len(periods),dtype=bool)
+        row_mask[cells]=True
+        return cls(ou_uids,de_keys,periods,(pair_keys//n_des).astype(np.intp),(pair_keys%n_des).astype(np.intp),
+                   {'VALUE':values.reshape(-1,len(periods))},row_mask=row_mask.reshape(-1,len(periods)))
+
+    @property
+    def values(self):
+        return self.layers['VALUE']
+
+    @property
+    def shape(self):
+        """Dense shape (OUs,DEs,periods)."""
+        return (len(self.ou_uids),len(self.de_keys),len(self.periods))
+
+    def presence(self):
+        return ~np.isnan(self.values)
+
+    def valued_pairs(self):
+        """Pairs with at least one value, the others only have rows without VALUE."""
+        return self.presence().any(axis=1)
+
+    def dense(self,layer='VALUE'):
+        """Full OU x DE x period array of a layer, NaN out of the pairs."""
+        dense_values=np.full(self.shape,np.nan,dtype=self.layers[layer].dtype)
+        dense_values[self.pair_ou_codes,self.pair_de_codes]=self.layers[layer]
+        return dense_values
+
+    def pairs_frame(self):
+        pairs_df=self.de_keys.iloc[self.pair_de_codes].reset_index(drop=True)
+        pairs_df.insert(0,'OU_UID',self.ou_uids[self.pair_ou_codes])
+        return pairs_df
+
+    def score_outliers(self,max_workers=None,relative_accuracy=None):
+        """
+        Add the outlier layers (RS_SCORE, EXTREME_RS, OUTLIER_RS, ZERO) and
+        the batch_median codes, as outlier_detection_assignment computes
+        them on the long frame.
+        """
+        #Rows without VALUE get their pair batch_median and NaN scores, as on the frame
+        pair_rows,period_rows=np.nonzero(self.row_mask)
+        values=self.values[pair_rows,period_rows]
+        batch_codes,batch_median,_,rs_score=outlier_score_codes(self.pair_de_codes[pair_rows],self.pair_ou_codes[pair_rows],
+                                                                values,len(self.de_keys),max_workers,relative_accuracy)
+        #All pairs are of DEs with values, so a batch_median ('nan' for the pairs without value)
+        self.batch_codes=np.full(self.values.shape[0],NO_BATCH,dtype=np.intp)
+        self.batch_codes[pair_rows]=batch_codes
+
+        flags_df=outliers_rs_based_generator(pd.DataFrame({'VALUE':values,'batch_median':batch_median,'RS_SCORE':rs_score}))
+        for layer in OUTLIER_LAYERS:
+            layer_values=np.full(self.values.shape,np.nan,dtype=flags_df[layer].dtype)
+            layer_values[pair_rows,period_rows]=flags_df[layer].to_numpy()
+            self.layers[layer]=layer_values
+        return self
+
+    def availability(self,expected=None):
+        """AvailabilityBitmap of the values, restricted to and completed with
+        the expected pairs as AvailabilityBitmap.from_values."""
+        valued=self.valued_pairs()
+        return AvailabilityBitmap.from_presence(self.ou_uids,self.de_keys,self.periods,self.pair_ou_codes[valued],
+                                                self.pair_de_codes[valued],self.presence()[valued],expected=expected)
+
+    def reporting_style(self,expected=None):
+        return self.availability(expected).reporting_style()
+
+    def fosa_stats(self,availability):
+        """fosa_stats_from_availability of the scored values, from the
+        layers summed and averaged over the periods of each pair."""
+        grouping_cols=['OU_UID']+list(self.de_keys.columns)
+        valued=self.valued_pairs()
+        pairs_index=pd.MultiIndex.from_frame(self.pairs_frame()[valued])
+        outlier_rs=self.layers['OUTLIER_RS'][valued].astype('float64')
+        with np.errstate(invalid='ignore'):
+            df_mean=pd.DataFrame({'VALUE':np.nanmean(self.values[valued],axis=1),
+                                  'OUTLIER_RS':np.nanmean(outlier_rs,axis=1)},index=pairs_index)
+        df_sum=pd.DataFrame({'OUTLIER_RS':np.nansum(outlier_rs,axis=1),
+                             'ZERO':np.nansum(self.layers['ZERO'][valued].astype('float64'),axis=1)},index=pairs_index)
+        return fosa_stats_from_aggregates(df_sum,df_mean,availability,grouping_cols)
+
+    def to_frame(self):
+        """Long frame of the rows, with the outlier columns once scored:
+        OU_UID, de_uid_vars, PERIOD, VALUE, then batch_median and the other
+        layers. Rows are ordered by OU, DE and period (not by batch_median
+        and DE as outlier_detection_assignment orders them), with a new
+        index."""
+        pair_rows,period_rows=np.nonzero(self.row_mask)
+        values_df=self.pairs_frame().iloc[pair_rows].reset_index(drop=True)
+        values_df['PERIOD']=np.asarray(self.periods,dtype=object)[period_rows]
+        values_df['VALUE']=self.values[pair_rows,period_rows]
+        if self.batch_codes is not None:
+            values_df['batch_median']=batch_median_code_labels(self.batch_codes[pair_rows])
+        for layer,layer_values in self.layers.items():
+            if layer!='VALUE':
+                values_df[layer]=layer_values[pair_rows,period_rows]
+        return values_df
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Planning of the analytics queries sent by Dhis2Client.extract_data: how
+the dx/ou/pe dimensions are cut into requests.
+"""
+import json
+import logging
+import math
+import os
+
+
+logger=logging.getLogger(__name__)
+
+
+def default_state_path():
+    return os.path.join(os.path.expanduser('~'),'.blsq_dqapp','batch_sizes.json')
+
+
+class AdaptiveBatchController(object):
+    """Batch sizes for analytics requests driven by the observed cost of the
+    previous requests.
+
+    The controller keeps a smoothed estimate of the seconds (and rows) that
+    one dx x ou cell costs and sizes the next request so it takes about
+    target_seconds. Failures halve the larger dimension of the failed request.
+    The sizes it settles on are saved per host in a json file and used as the
+    starting point of the next run.
+    Parameters
+    ----------
+    host_key: str
+        Identifier of the DHIS2 instance the sizes are persisted for.
+    dx_total,ou_total: int
+        Number of items to extract in each dimension (upper size bounds).
+    target_seconds: float
+        Per-request time budget.
+    max_rows: int, optional
+        Upper bound on the rows expected from a request.
+    """
+
+    def __init__(self,host_key,dx_total,ou_total,target_seconds=30,max_rows=100000,
+                 dx_batch_size=None,ou_batch_size=None,growth_factor=2,smoothing=0.3,
+                 state_path=None):
+        self.host_key=host_key
+        self.dx_total=max(dx_total,1)
+        self.ou_total=max(ou_total,1)
+        self.target_seconds=target_seconds
+        self.max_rows=max_rows
+        self.growth_factor=growth_factor
+        self.smoothing=smoothing
+        self.state_path=state_path or default_state_path()
+        self.cell_seconds=None
+        self.cell_rows=None
+
+        saved_state=self._load().get(self.host_key,{})
+        self.dx_batch_size=dx_batch_size or saved_state.get('dx_batch_size',10)
+        self.ou_batch_size=ou_batch_size or saved_state.get('ou_batch_size',50)
+        self.cell_seconds=saved_state.get('cell_seconds')
+        self.cell_rows=saved_state.get('cell_rows')
+        self._clamp()
+
+    def observe(self,dx_size,ou_size,seconds,rows=0,failed=False):
+        """Update the sizes with the outcome of a request of dx_size x ou_size."""
+        if failed:
+            if dx_size>ou_size:
+                dx_size=max(int(round(dx_size/2,0)),1)
+            else:
+                ou_size=max(int(round(ou_size/2,0)),1)
+            self.dx_batch_size=min(self.dx_batch_size,dx_size)
+            self.ou_batch_size=min(self.ou_batch_size,ou_size)
+            return
+
+        cells=dx_size*ou_size
+        self.cell_seconds=self._smooth(self.cell_seconds,seconds/cells)
+        self.cell_rows=self._smooth(self.cell_rows,rows/cells)
+
+        target_cells=cells*self.growth_factor
+        if self.cell_seconds>0:
+            target_cells=min(target_cells,self.target_seconds/self.cell_seconds)
+        if self.max_rows and self.cell_rows>0:
+            target_cells=min(target_cells,self.max_rows/self.cell_rows)
+        self._set_cells(max(target_cells,1))
+
+    def save(self):
+        state=self._load()
+        state[self.host_key]={'dx_batch_size':self.dx_batch_size,
+                              'ou_batch_size':self.ou_batch_size,
+                              'cell_seconds':self.cell_seconds,
+                              'cell_rows':self.cell_rows}
+        state_dir=os.path.dirname(self.state_path)
+        if state_dir:
+            os.makedirs(state_dir,exist_ok=True)
+        with open(self.state_path,'w') as state_file:
+            json.dump(state,state_file,indent=1)
+
+    def _smooth(self,previous,observed):
+        if previous is None:
+            return observed
+        return self.smoothing*observed+(1-self.smoothing)*previous
+
+    def _set_cells(self,cells):
+        #The cells are shared between dimensions following the shape of the
+        #extraction, so both dimensions reach their totals at the same time
+        aspect=self.ou_total/self.dx_total
+        self.ou_batch_size=int(round(math.sqrt(cells*aspect)))
+        self.ou_batch_size=min(max(self.ou_batch_size,1),self.ou_total)
+        self.dx_batch_size=int(cells//self.ou_batch_size)
+        self._clamp()
+        if self.dx_batch_size==self.dx_total:
+            self.ou_batch_size=min(max(int(cells//self.dx_batch_size),1),self.ou_total)
+
+    def _clamp(self):
+        self.dx_batch_size=min(max(int(self.dx_batch_size),1),self.dx_total)
+        self.ou_batch_size=min(max(int(self.ou_batch_size),1),self.ou_total)
+
+    def _load(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except ValueError:
+            return {}
+
+
+def _dimension_bytes(items):
+    #Length of the items once joined with ';' in the query string
+    return sum(len(str(item).encode('utf-8')) for item in items)+max(len(items)-1,0)
+
+
+def _items_packer(items,max_bytes,max_count=None):
+    """Greedy packing of items into consecutive chunks under a byte and count
+    limit. An item longer than max_bytes gets a chunk of its own."""
+    chunks=[]
+    current_chunk=[]
+    current_bytes=0
+    for item in items:
+        item_bytes=len(str(item).encode('utf-8'))
+        needed_bytes=item_bytes if not current_chunk else current_bytes+1+item_bytes
+        if current_chunk and (needed_bytes>max_bytes or (max_count and len(current_chunk)>=max_count)):
+            chunks.append(current_chunk)
+            current_chunk=[]
+            needed_bytes=item_bytes
+        current_chunk.append(item)
+        current_bytes=needed_bytes
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def _items_count_estimator(items,max_bytes):
+    #Number of items of average length fitting in max_bytes
+    if not items:
+        return 0
+    mean_bytes=_dimension_bytes(items)/len(items)
+    return max(int(max_bytes//mean_bytes),1)
+
+
+def url_batch_planner(url_base,dx_descriptor,ou_descriptor,periods,max_url_bytes=8000,
+                      dx_batch_size=None,ou_batch_size=None,max_rows=None):
+    """Cut the dx, ou and pe dimensions of an analytics extraction into batches
+    whose GET urls stay under max_url_bytes and whose expected rows (dx x ou x
+    pe, assuming dense data) stay under max_rows.
+
+    The analytics api only answers GET requests, so when the whole period list
+    does not fit next to one dx and one ou item, the period dimension is split
+    as well.
+    Returns
+    -------
+    dx_batchted_descriptors,ou_batchted_descriptors: list of dict
+        Single key descriptors, as built by Dhis2Client._batch_splitter.
+    pe_batches: list of list
+        Period chunks.
+    """
+    overhead=len(url_base.encode('utf-8'))+len('?dimension=dx:&dimension=ou:&dimension=pe:')
+    overhead=overhead+max([len(key)+1 for key in ou_descriptor.keys() if key.startswith('LEVEL-')] or [0])
+    available=max_url_bytes-overhead
+
+    dx_items=[item for items in dx_descriptor.values() for item in items]
+    ou_items=[item for key,items in ou_descriptor.items() if key!='OUG' for item in items]
+    longest_dx=max([_dimension_bytes([item]) for item in dx_items] or [0])
+    longest_ou=max([_dimension_bytes([item]) for item in ou_items] or [0])
+    if 'OUG' in ou_descriptor:
+        groups,ancestor=ou_descriptor['OUG']
+        longest_ou=max(longest_ou,_dimension_bytes(['OU_GROUP-'+group for group in groups]+[ancestor]))
+
+    #Period dimension: whole if it fits with the longest dx and ou items and 
+    #leaves room for packing, otherwise split
+    pe_budget=available-longest_dx-longest_ou
+    if _dimension_bytes(periods)<=max(pe_budget//3,0):
+        pe_batches=[list(periods)]
+    else:
+        if pe_budget<=0:
+            logger.warning('A single dx/ou item does not fit in %s bytes, requests will exceed the limit',max_url_bytes)
+        pe_batches=_items_packer(periods,max(pe_budget//3,1))
+    pe_count=max(len(pe_batch) for pe_batch in pe_batches)
+    if max_rows and pe_count>max_rows:
+        pe_batches=[pe_chunk for pe_batch in pe_batches for pe_chunk in _items_packer(pe_batch,max_url_bytes,max_count=max_rows)]
+        pe_count=max_rows
+
+    #The bytes left are shared evenly between dx and ou, which gives the most
+    #dx x ou cells per request, unless one of them needs less than its half
+    dx_ou_budget=available-max(_dimension_bytes(pe_batch) for pe_batch in pe_batches)
+    dx_total=_dimension_bytes(dx_items)
+    ou_total=_dimension_bytes(ou_items)
+    dx_budget=max(min(dx_total,dx_ou_budget//2),longest_dx)
+    ou_budget=max(dx_ou_budget-dx_budget,longest_ou)
+    if ou_total<ou_budget:
+        ou_budget=max(ou_total,longest_ou)
+        dx_budget=max(dx_ou_budget-ou_budget,longest_dx)
+
+    dx_count=dx_batch_size
+    ou_count=ou_batch_size
+    if max_rows:
+        dx_fill=min(dx_count or len(dx_items),_items_count_estimator(dx_items,dx_budget)) or 1
+        ou_fill=min(ou_count or len(ou_items),_items_count_estimator(ou_items,ou_budget)) or 1
+        max_cells=max(max_rows//pe_count,1)
+        if dx_fill*ou_fill>max_cells:
+            #The larger dimension is reduced first
+            if ou_fill>=dx_fill:
+                ou_fill=max(max_cells//dx_fill,1)
+                dx_fill=min(dx_fill,max(max_cells//ou_fill,1))
+            else:
+                dx_fill=max(max_cells//ou_fill,1)
+                ou_fill=min(ou_fill,max(max_cells//dx_fill,1))
+        dx_count=dx_fill
+        ou_count=ou_fill
+
+    dx_batchted_descriptors=[{key:dx_chunk} for key,items in dx_descriptor.items()
+                             for dx_chunk in _items_packer(items,dx_budget,max_count=dx_count)]
+    ou_batchted_descriptors=[]
+    for key,items in ou_descriptor.items():
+        if key=='OUG':
+            ou_batchted_descriptors.append({key:items})
+        else:
+            ou_batchted_descriptors.extend([{key:ou_chunk} for ou_chunk in _items_packer(items,ou_budget,max_count=ou_count)])
+    return dx_batchted_descriptors,ou_batchted_descriptors,pe_batches
+
+
+def ou_hierarchy_compressor(ou_uids,ou_tree_df,min_subtree_size=2):
+    """Rewrite a list of org units into LEVEL-n descriptors wherever all the
+    level n units under an ancestor are requested.
+
+    ou_tree_df is the tree built by Dhis2Client.fetch_organisation_units_structure
+    (OU_UID, LEVEL and LEVEL_k_UID columns). The highest ancestor covering a
+    fully requested subtree is used, the units that cannot be grouped are kept
+    as explicit uids.
+    Returns
+    -------
+    ou_descriptor: dict
+        {'LEVEL-n':[ancestor uids],...,'OU':[remaining uids]}, to be used as
+        extract_data ou_descriptor.
+    """
+    requested=set(ou_uids)
+    tree=ou_tree_df.drop_duplicates('OU_UID')
+    requested_levels=tree.loc[tree.OU_UID.isin(requested),'LEVEL'].dropna().unique()
+
+    ou_descriptor={}
+    covered_uids=set()
+    for level in sorted(requested_levels):
+        level=int(level)
+        remaining=tree[tree.LEVEL==level]
+        remaining=remaining.assign(REQUESTED=remaining.OU_UID.isin(requested))
+        for ancestor_level in range(1,level):
+            ancestor_col='LEVEL_'+str(ancestor_level)+'_UID'
+            if ancestor_col not in remaining.columns or remaining.empty:
+                continue
+            grouped=remaining.groupby(ancestor_col).REQUESTED
+            full_subtrees=grouped.all() & (grouped.size()>=min_subtree_size)
+            full_ancestors=full_subtrees[full_subtrees].index.tolist()
+            if full_ancestors:
+                ou_descriptor.setdefault('LEVEL-'+str(level),[]).extend(full_ancestors)
+                in_subtree=remaining[ancestor_col].isin(full_ancestors)
+                covered_uids.update(remaining.loc[in_subtree,'OU_UID'])
+                remaining=remaining[~in_subtree]
+
+    leftover_uids=[ou for ou in ou_uids if ou not in covered_uids]
+    if leftover_uids:
+        ou_descriptor['OU']=leftover_uids
+    return ou_descriptor
@@ -5,6 +5,16 @@ Created on Tue Jan 12 21:30:41 2021
 @author: Fernando-Bluesquare
 """
 import numpy as np
+import pandas as pd
+
+from .periods import Periods
+
+#Labels of the COMPLETENESS codes
+COMPLETENESS_LABELS=np.array(['ALWAYS','NEVER','SINCE_FULL','STOPPED','INCONSISTENT'],dtype=object)
+#Periods packed in one uint64 bitmask, one bit left for the SINCE_FULL carry
+MAX_BITMASK_PERIODS=63
+#Set bits of each byte value
+BYTE_POPCOUNT=np.array([bin(byte).count('1') for byte in range(256)],dtype=np.uint8)
 
 ##Reviewed Version, for DE
 def reporting_style_classifier_function(df,added_de_uid_vars):
@@ -29,8 +39,97 @@ def reporting_style_classifier_function(df,added_de_uid_vars):
     df=full.reset_index().assign(COMPLETENESS=summary).drop('DE_AVAILABILITY_BOOL',axis=1)
     return df
 
+def completeness_from_bitmasks(masks,present):
+    """
+    COMPLETENESS codes (positions in COMPLETENESS_LABELS) of availability 
+    series packed as uint64 bitmasks: bit i of present is set when the 
+    series has the i-th period, bit i of masks when it is available, for up
+    to MAX_BITMASK_PERIODS periods.
+    """
+    masks=np.asarray(masks,dtype=np.uint64)
+    missing=np.asarray(present,dtype=np.uint64) & ~masks
+    full=missing==0
+    never=masks==0
+    #Started reporting: every missing period is before the first available one, 
+    #so lower than the lowest set bit. Stopped reporting: the other way round.
+    since_full=missing<(masks & (~masks+np.uint64(1)))
+    since_empty=masks<(missing & (~missing+np.uint64(1)))
+    return np.select([full,never,since_full,since_empty],[0,1,2,3],4).astype(np.int8)
+
+
+def completeness_from_sequences(availability,group_codes,n_groups):
+    """
+    COMPLETENESS codes of availability series of any length: availability 
+    is 0/1 ordered by group_codes and, within each group, by period.
+    """
+    availability=np.asarray(availability,dtype=np.int8)
+    counts=np.bincount(group_codes,minlength=n_groups)
+    reported=np.bincount(group_codes,weights=availability,minlength=n_groups)
+    same_group=group_codes[1:]==group_codes[:-1]
+    steps=availability[1:]-availability[:-1]
+    rising=np.bincount(group_codes[1:][same_group & (steps>0)],minlength=n_groups)>0
+    falling=np.bincount(group_codes[1:][same_group & (steps<0)],minlength=n_groups)>0
+    return np.select([reported==counts,reported==0,~falling,~rising],[0,1,2,3],4).astype(np.int8)
+
+
 def reporting_style_classifier(df,de_uid_vars):
-    #de_uid_vars=[col for col in df.columns if col in ['DE_UID','COC_UID'] ]
-    ##Sorting of periods on the df
-    df=df.sort_values('PERIOD')    
-    return reporting_style_classifier_function(df[['OU_UID','DE_AVAILABILITY_BOOL']+de_uid_vars],de_uid_vars)
+    """
+    COMPLETENESS of each OU/DE of df, from its DE_AVAILABILITY_BOOL (0/1) 
+    in chronological order of the periods, as reporting_style_classifier_function
+    gives it on the df sorted by period (the string sort is chronological 
+    except for weekly periods).
+    
+    The OU/DE keys and the periods are factorized, in sorted order, and the 
+    periods and available periods of each OU/DE packed into uint64 bitmasks
+    classified by bit operations, instead of the grouped means and monotonic
+    checks. Over MAX_BITMASK_PERIODS periods, or for OU/DEs with a period 
+    repeated, the sorted series are classified from their steps.
+    """
+    keys=['OU_UID']+de_uid_vars
+    #Sorted codes of each key, combined so that the groups keep the order of the groupby
+    group_codes=np.zeros(df.shape[0],dtype=np.int64)
+    missing=np.zeros(df.shape[0],dtype=bool)
+    key_uniques=[]
+    for key in keys:
+        key_codes,uniques=pd.factorize(df[key],sort=True)
+        group_codes=group_codes*len(uniques)+key_codes
+        missing|=key_codes<0
+        key_uniques.append(uniques)
+    #Rows with missing keys are left out, as by the groupby
+    keyed=~missing
+    group_codes,groups=pd.factorize(group_codes[keyed],sort=True)
+    #Chronological codes, weekly periods included (2021W2 before 2021W10)
+    period_codes,periods=Periods.order_codes(df['PERIOD'])
+    period_codes=period_codes[keyed]
+    availability=df['DE_AVAILABILITY_BOOL'].to_numpy()[keyed].astype(np.uint8)
+    n_groups=len(groups)
+    
+    lengths=np.bincount(group_codes,minlength=n_groups)
+    
+    completeness=np.zeros(n_groups,dtype=np.int8)
+    sequenced=np.ones(n_groups,dtype=bool)
+    if len(periods)<=MAX_BITMASK_PERIODS:
+        #Bit of the period of each row, ORed into the periods of each OU/DE and the available ones
+        period_bits=np.left_shift(np.uint64(1),period_codes.astype(np.uint64))
+        present=np.zeros(n_groups,dtype=np.uint64)
+        masks=np.zeros(n_groups,dtype=np.uint64)
+        np.bitwise_or.at(present,group_codes,period_bits)
+        np.bitwise_or.at(masks,group_codes,period_bits*availability)
+        #OU/DEs with a period repeated are left to the series
+        sequenced=BYTE_POPCOUNT[present.view(np.uint8)].reshape(n_groups,8).sum(axis=1,dtype=np.int64)!=lengths
+        completeness[~sequenced]=completeness_from_bitmasks(masks[~sequenced],present[~sequenced])
+    if sequenced.any():
+        rows=sequenced[group_codes]
+        #Rows ordered by group then period
+        order=np.argsort(group_codes[rows].astype(np.int64)*len(periods)+period_codes[rows],kind='stable')
+        completeness[sequenced]=completeness_from_sequences(availability[rows][order],group_codes[rows][order],n_groups)[sequenced]
+    
+    #Keys of each group back from the combined codes
+    reporting_style_df=pd.DataFrame(index=pd.RangeIndex(n_groups))
+    remaining=np.asarray(groups,dtype=np.int64)
+    for key,uniques in zip(keys[::-1],key_uniques[::-1]):
+        reporting_style_df[key]=uniques.take(remaining%len(uniques))
+        remaining=remaining//len(uniques)
+    reporting_style_df=reporting_style_df[keys]
+    reporting_style_df['COMPLETENESS']=COMPLETENESS_LABELS[completeness]
+    return reporting_style_df